@@ -0,0 +1,200 @@
+"""Process pool the service decodes and fingerprints audio in, off the event loop."""
+import multiprocessing
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from time import time
+from typing import Any, Callable, List
+
+
+class ExecutorBusy(Exception):
+    """
+    Raised on submit when every worker is busy and the queue is full, the request should be
+    retried after retry_after seconds.
+    """
+    def __init__(self, retry_after: int):
+        super().__init__(f"Every fingerprinting worker is busy, retry in {retry_after} seconds.")
+        self.retry_after = retry_after
+
+
+class FingerprintExecutor(Executor):
+    """
+    Process pool with a bounded queue. Tasks beyond the ones the workers run plus queue_size are
+    rejected with ExecutorBusy instead of piling up, so bursts get a quick answer and the latency of
+    accepted requests stays predictable.
+
+    Workers are spawned, and import the fingerprinting modules, when the executor is created. A pool
+    broken by a dead worker (e.g. killed for running out of memory) fails the tasks it had with
+    BrokenProcessPool and is replaced on the next submit.
+
+    # Use as the executor of Dejavu
+    djv.executor = FingerprintExecutor(4, 16, 5)
+    """
+    def __init__(self, max_workers: int, queue_size: int, retry_after: int):
+        """
+        :param max_workers: number of worker processes.
+        :param queue_size: number of tasks waiting for a worker at most.
+        :param retry_after: seconds rejected requests are told to wait before retrying.
+        """
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+
+        self._lock = threading.Lock()
+        # tasks submitted and not finished yet, running or queued.
+        self._pending = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._failed = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+        self._pool = self._new_pool()
+        self._broken = False
+        # every worker is started (and warmed up) right away rather than by the first requests, a pool that
+        # can't start its workers fails here instead of on every request.
+        try:
+            for future in [self._pool.submit(_noop) for _ in range(max_workers)]:
+                future.result()
+        except BaseException:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # spawned rather than forked, the service process runs threads (e.g. the event loop ones)
+        # which may hold locks at the time of the fork.
+        return ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_warm_up)
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        """
+        Schedules fn(*args, **kwargs) on a worker, fn and its arguments must be picklable.
+
+        :return: a future with the result of the call.
+        """
+        pool = self._reserve(1)
+        return self._start(pool, fn, args, kwargs)
+
+    def submit_all(self, calls: List[Callable[[], Any]]) -> List[Future]:
+        """
+        Schedules several calls at once, either all of them or, raising ExecutorBusy, none. A request made
+        of several tasks is so never left with part of them running for nothing.
+
+        :param calls: picklable callables without arguments, e.g. partials.
+        :return: a future with the result of each call.
+        """
+        pool = self._reserve(len(calls))
+        futures = []
+        try:
+            for call in calls:
+                futures.append(self._start(pool, call, (), {}))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            # the places of the calls never started.
+            for _ in range(len(calls) - len(futures) - 1):
+                self._finish(None)
+            raise
+        return futures
+
+    def _reserve(self, count: int) -> ProcessPoolExecutor:
+        """
+        Takes places in the queue for count tasks.
+
+        :param count: number of tasks.
+        :return: the pool the tasks are to be submitted to.
+        """
+        with self._lock:
+            if self._pending + count > self.max_workers + self.queue_size:
+                self._rejected += 1
+                raise ExecutorBusy(self.retry_after)
+
+            if self._broken:
+                self._pool.shutdown(wait=False)
+                self._pool, self._broken = self._new_pool(), False
+
+            self._pending += count
+            self._submitted += count
+            return self._pool
+
+    def _start(self, pool: ProcessPoolExecutor, fn, args: tuple, kwargs: dict) -> Future:
+        # submits a task which already has its place in the queue.
+        future = Future()
+        submitted = time()
+        try:
+            task = pool.submit(_timed, fn, *args, **kwargs)
+        except BaseException:
+            self._finish(None)
+            raise
+
+        # a cancelled request frees its place in the queue, if its task did not start yet.
+        future.add_done_callback(lambda f: f.cancelled() and task.cancel())
+        task.add_done_callback(partial(self._done, future, submitted))
+        return future
+
+    def _done(self, future: Future, submitted: float, task: Future) -> None:
+        if task.cancelled():
+            self._finish(None)
+            future.cancel()
+            return
+
+        exception = task.exception()
+        if exception is not None:
+            self._finish(None, broken=isinstance(exception, BrokenProcessPool))
+            if future.set_running_or_notify_cancel():
+                future.set_exception(exception)
+            return
+
+        started, result = task.result()
+        self._finish(max(started - submitted, 0.0))
+        if future.set_running_or_notify_cancel():
+            future.set_result(result)
+
+    def _finish(self, wait_time: float = None, broken: bool = False) -> None:
+        with self._lock:
+            self._pending -= 1
+            if wait_time is None:
+                self._failed += 1
+            else:
+                self._wait_time += wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+            self._broken = self._broken or broken
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        self._pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    def stats(self) -> dict:
+        """
+        :return: a dictionary with the tasks running and queued, and how many were submitted, rejected
+        and failed, and how long the submitted ones waited for a worker.
+        """
+        with self._lock:
+            completed = self._submitted - self._pending - self._failed
+            return {
+                "workers": self.max_workers,
+                "running": min(self._pending, self.max_workers),
+                "queued": max(self._pending - self.max_workers, 0),
+                "queue_size": self.queue_size,
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "failed": self._failed,
+                "wait_time": self._wait_time,
+                "average_wait_time": self._wait_time / completed if completed else 0.0,
+                "max_wait_time": self._max_wait_time
+            }
+
+
+def _warm_up():
+    # the fingerprinting modules are imported once per worker, not on its first task.
+    import dejavu  # noqa: F401
+    import dejavu.logic.fingerprint  # noqa: F401
+
+
+def _noop():
+    pass
+
+
+def _timed(fn, *args, **kwargs):
+    # the time the task started at, to know how long it waited for a worker.
+    return time(), fn(*args, **kwargs)
@@ -6,7 +6,6 @@ import re
 import string
 import subprocess
 from dejavu import Dejavu
-from dejavu.logic.recognizer.file_recognizer import FileRecognizer
 
 def init_dejavu(config_path):
     # initialize dejavu
@@ -15,34 +14,11 @@ def init_dejavu(config_path):
     try:
         return Dejavu(config)
     except Exception as e:
+        # the service can't serve any request without the engine, it fails to start instead.
         debug_error_log("ERROR: " + str(e))      # type:ignore
+        raise
 
 
-def adv_exists(djv, uploaded_filepath):
-    try:
-        results_check = djv.recognize(
-            FileRecognizer, 
-            uploaded_filepath
-        )
-    except Exception as e:
-        debug_error_log(str(e))
-        return False, None, None
-
-    if results_check['results']:
-        fingerprinted_confidence = results_check['results'][0]['fingerprinted_confidence']
-        input_confidence = results_check['results'][0]['input_confidence']
-        if fingerprinted_confidence > 0.8 and input_confidence > 0.9:
-            advertisement_id = results_check['results'][0]['song_id']
-            advertisement_name = str(results_check['results'][0]['song_name'], encoding='utf-8')
-            os.remove(uploaded_filepath)
-            return True, advertisement_id, advertisement_name
-    return False, None, None
-
-
-async def create_fingerprint(djv, uploaded_filepath):
-    djv.fingerprint_file(uploaded_filepath)
-    
-
 def debug_error_log(text:str, timestamp:bool=True):
     # with open("D:/Anaconda/Audio-FingerPrinting/FastAPI-Application/debug_error.log", 'a') as err_file:
     with open("C:/python-apps/Advertisement-APP/audio-fingerprint/debug_error.log", 'a') as err_file:
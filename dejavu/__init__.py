@@ -1,21 +1,33 @@
+import asyncio
 import multiprocessing
 import os
 import sys
+import threading
 import traceback
-from itertools import groupby
+from functools import partial
 from time import time
-from typing import Dict, List, Tuple
+from typing import (AbstractSet, BinaryIO, Callable, Dict, FrozenSet, List,
+                    Optional, Tuple, Union)
+
+import numpy as np
 
 import dejavu.logic.decoder as decoder
+from dejavu.base_classes.async_database import get_async_database
 from dejavu.base_classes.base_database import get_database
-from dejavu.config.settings import (DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
-                                    DEFAULT_WINDOW_SIZE, FIELD_FILE_SHA1,
-                                    FIELD_TOTAL_HASHES,
+from dejavu.config.settings import (ALIGN_TIME, DEFAULT_FINGERPRINT_PROFILE,
+                                    DEFAULT_FS, ERROR, FIELD_FILE_SHA1,
+                                    FIELD_SONG_ID, FIELD_TOTAL_HASHES,
+                                    FINGERPRINT_PROFILES, FINGERPRINT_TIME,
                                     FINGERPRINTED_CONFIDENCE,
                                     FINGERPRINTED_HASHES, HASHES_MATCHED,
                                     INPUT_CONFIDENCE, INPUT_HASHES, OFFSET,
-                                    OFFSET_SECS, SONG_ID, SONG_NAME, TOPN)
-from dejavu.logic.fingerprint import fingerprint
+                                    OFFSET_SECS, QUERY_TIME, RESULTS,
+                                    SETTING_FINGERPRINT_PROFILE, SONG_ID,
+                                    SONG_NAME, TOPN, TOTAL_TIME)
+from dejavu.logic.alignment import best_offsets
+from dejavu.logic.cache import FingerprintCache
+from dejavu.logic.fingerprint import (FINGERPRINT_DTYPE, fingerprint,
+                                      prepare_channels)
 
 
 class Dejavu:
@@ -28,24 +40,153 @@ class Dejavu:
         self.db = db_cls(**config.get("database", {}))
         self.db.setup()
 
+        # async counterpart of the database for the async methods, None if there is none for its type, the
+        # database is then queried in a thread by those methods.
+        async_db_cls = get_async_database(config.get("database_type", "mysql").lower())
+        self.async_db = async_db_cls(**config.get("database", {})) if async_db_cls else None
+
+        # executor the async methods decode and fingerprint audio in, so the event loop only waits on it.
+        # None for the default one of the loop.
+        self.executor = None
+
         # if we should limit seconds fingerprinted,
         # None|-1 means use entire track
         self.limit = self.config.get("fingerprint_limit", None)
         if self.limit == -1:  # for JSON compatibility
             self.limit = None
+
+        # whether matches are aligned by the database, which then only sends back the best ones.
+        self.align_in_database = self.config.get("align_in_database", False)
+
+        # optional on-disk cache of the fingerprints of ingested files.
+        cache_config = self.config.get("fingerprint_cache", None)
+        self.cache = FingerprintCache(**cache_config) if cache_config else None
+
+        # a single instance can be shared by the threads serving requests, the songs state is
+        # only changed while holding this lock.
+        self._lock = threading.RLock()
         self.__load_fingerprinted_audio_hashes()
+        self.profile_name, self.profile = self.__load_fingerprint_profile()
+
+    def __load_fingerprint_profile(self) -> Tuple[str, Dict[str, any]]:
+        """
+        Resolves the fingerprint profile of the catalog. The profile of the first song fingerprinted into a catalog
+        is stored in the database, so ingest and recognition keep using it no matter how each instance is configured.
+
+        :return: a tuple with the profile name and the profile itself.
+        """
+        requested = self.config.get("fingerprint_profile", None)
+        if requested is not None and requested not in FINGERPRINT_PROFILES:
+            raise ValueError(f"Unknown fingerprint profile '{requested}', "
+                             f"available ones are: {', '.join(FINGERPRINT_PROFILES.keys())}.")
+
+        stored = self.db.get_setting(SETTING_FINGERPRINT_PROFILE)
+        if stored is None:
+            if not self.song_hashes:
+                # an empty catalog gets its profile with the first song fingerprinted into it, instances only
+                # recognizing on it must not decide it (see __record_fingerprint_profile).
+                self._profile_recorded = False
+                name = requested or DEFAULT_FINGERPRINT_PROFILE
+                return name, FINGERPRINT_PROFILES[name]
+
+            # catalogs built before profiles existed were fingerprinted with the default profile.
+            stored = self.db.set_setting(SETTING_FINGERPRINT_PROFILE, DEFAULT_FINGERPRINT_PROFILE)
+
+        if requested is not None and requested != stored:
+            raise ValueError(f"The catalog was fingerprinted with the '{stored}' profile, "
+                             f"it can't be used with the '{requested}' one.")
+
+        self._profile_recorded = True
+        return stored, FINGERPRINT_PROFILES[stored]
+
+    def __record_fingerprint_profile(self) -> None:
+        """
+        Records the profile of the instance as the one of the catalog before its first song is inserted, unless
+        another instance recorded one meanwhile, which must then be the same.
+        """
+        if self._profile_recorded:
+            return
+
+        used = self.profile_name
+        stored = self.db.set_setting(SETTING_FINGERPRINT_PROFILE, used)
+        if stored != used:
+            if self.config.get("fingerprint_profile", None) is None:
+                # songs to come are fingerprinted with the profile of the catalog.
+                self.profile_name, self.profile = stored, FINGERPRINT_PROFILES[stored]
+                self._profile_recorded = True
+            raise ValueError(f"The catalog was fingerprinted with the '{stored}' profile meanwhile, "
+                             f"it can't be used with the '{used}' one.")
+        self._profile_recorded = True
 
     def __load_fingerprinted_audio_hashes(self) -> None:
         """
         Keeps a dictionary with the hashes of the fingerprinted songs, in that way is possible to check
         whether or not an audio file was already processed.
+
+        The songs are only read from the database here, afterwards the state is updated as songs are
+        inserted and deleted through this instance.
         """
         # get songs previously indexed
-        self.songs = self.db.get_songs()
-        self.songhashes_set = set()  # to know which ones we've computed before
-        for song in self.songs:
-            song_hash = song[FIELD_FILE_SHA1]
-            self.songhashes_set.add(song_hash)
+        songs = self.db.get_songs()
+        with self._lock:
+            self.song_hashes = {song[FIELD_SONG_ID]: song[FIELD_FILE_SHA1] for song in songs}
+            self.songhashes_set = set(self.song_hashes.values())  # to know which ones we've computed before
+
+    def __store_fingerprints(self, song_name: str, file_hash: str, hashes: np.ndarray) -> Optional[int]:
+        """
+        Inserts a song and its fingerprints, unless a file with the same contents got fingerprinted
+        meanwhile.
+
+        :param song_name: song name associated to the audio file.
+        :param file_hash: SHA1 of the audio file.
+        :param hashes: array of (hash, offset) records of the song.
+        :return: the id of the inserted song, None if it was already fingerprinted.
+        """
+        with self._lock:
+            if file_hash in self.songhashes_set:
+                return None
+
+            self.__record_fingerprint_profile()
+            sid = self.db.insert_song(song_name, file_hash, len(hashes))
+
+            self.db.insert_hashes(sid, hashes)
+            self.db.set_song_fingerprinted(sid)
+
+            self.song_hashes[sid] = file_hash
+            self.songhashes_set.add(file_hash)
+
+        return sid
+
+    async def __store_fingerprints_async(self, song_name: str, file_hash: str, hashes: np.ndarray) -> Optional[int]:
+        """
+        Same as __store_fingerprints, through the async database.
+
+        :param song_name: song name associated to the audio file.
+        :param file_hash: SHA1 of the audio file.
+        :param hashes: array of (hash, offset) records of the song.
+        :return: the id of the inserted song, None if it was already fingerprinted.
+        """
+        # the lock can't be held while waiting on the database, the file hash is rather taken right away
+        # so the same contents are not inserted meanwhile.
+        with self._lock:
+            if file_hash in self.songhashes_set:
+                return None
+            self.songhashes_set.add(file_hash)
+
+        try:
+            await asyncio.to_thread(self.__record_fingerprint_profile)
+            sid = await self.async_db.insert_song(song_name, file_hash, len(hashes))
+            await self.async_db.insert_hashes(sid, hashes)
+            await self.async_db.set_song_fingerprinted(sid)
+        except BaseException:
+            with self._lock:
+                self.songhashes_set.discard(file_hash)
+            raise
+
+        with self._lock:
+            self.song_hashes[sid] = file_hash
+
+        return sid
 
     def get_fingerprinted_songs(self) -> List[Dict[str, any]]:
         """
@@ -61,7 +202,13 @@ class Dejavu:
 
         :param song_ids: song ids to delete from the database.
         """
-        self.db.delete_songs_by_id(song_ids)
+        with self._lock:
+            self.db.delete_songs_by_id(song_ids)
+
+            for song_id in song_ids:
+                file_hash = self.song_hashes.pop(song_id, None)
+                if file_hash is not None and file_hash not in self.song_hashes.values():
+                    self.songhashes_set.discard(file_hash)
 
     def fingerprint_directory(self, path: str, extensions: str, nprocesses: int = None) -> None:
         """
@@ -79,19 +226,16 @@ class Dejavu:
         else:
             nprocesses = 1 if nprocesses <= 0 else nprocesses
 
-        pool = multiprocessing.Pool(nprocesses)
-
-        filenames_to_fingerprint = []
-        for filename, _ in decoder.find_files(path, extensions):
-            # don't refingerprint already fingerprinted files
-            if decoder.unique_hash(filename) in self.songhashes_set:
-                print(f"{filename} already fingerprinted, continuing...")
-                continue
-
-            filenames_to_fingerprint.append(filename)
+        # workers get the hashes of the songs already fingerprinted once, to skip those files themselves
+        # right after reading them, instead of having every file read here first only to hash it.
+        with self._lock:
+            known_hashes = frozenset(self.songhashes_set)
+        pool = multiprocessing.Pool(nprocesses, initializer=Dejavu._init_fingerprint_worker,
+                                    initargs=(known_hashes,))
 
         # Prepare _fingerprint_worker input
-        worker_input = list(zip(filenames_to_fingerprint, [self.limit] * len(filenames_to_fingerprint)))
+        worker_input = [(filename, self.limit, self.profile, self.cache)
+                        for filename, _ in decoder.find_files(path, extensions)]
 
         # Send off our tasks
         iterator = pool.imap_unordered(Dejavu._fingerprint_worker, worker_input)
@@ -99,7 +243,7 @@ class Dejavu:
         # Loop till we have all of them
         while True:
             try:
-                song_name, hashes, file_hash = next(iterator)
+                song_name, hashes, file_hash, cache_hit = next(iterator)
             except multiprocessing.TimeoutError:
                 continue
             except StopIteration:
@@ -109,11 +253,12 @@ class Dejavu:
                 # Print traceback because we can't reraise it here
                 traceback.print_exc(file=sys.stdout)
             else:
-                sid = self.db.insert_song(song_name, file_hash, len(hashes))
+                self.__count_cache_lookup(cache_hit)
 
-                self.db.insert_hashes(sid, hashes)
-                self.db.set_song_fingerprinted(sid)
-                self.__load_fingerprinted_audio_hashes()
+                # don't refingerprint already fingerprinted files, the same content may also appear
+                # more than once in the directory.
+                if hashes is None or self.__store_fingerprints(song_name, file_hash, hashes) is None:
+                    print(f"{song_name} already fingerprinted, continuing...")
 
         pool.close()
         pool.join()
@@ -127,42 +272,165 @@ class Dejavu:
         :param song_name: song name associated to the audio file.
         """
         song_name_from_path = decoder.get_audio_name_from_path(file_path)
-        song_hash = decoder.unique_hash(file_path)
         song_name = song_name or song_name_from_path
-        # don't refingerprint already fingerprinted files
-        if song_hash in self.songhashes_set:
-            print(f"{song_name} already fingerprinted, continuing...")
+        # the file is read once, and not fingerprinted if it already was.
+        contents, file_hash = decoder.load(file_path)
+        self.__fingerprint_contents(contents, file_hash, song_name, os.path.splitext(file_path)[1])
+
+    def fingerprint_buffer(self, data: Union[decoder.Buffer, BinaryIO], song_name: str, extension: str = None) -> None:
+        """
+        Same as fingerprint_file, for an audio file that is already in memory (e.g. an upload).
+
+        :param data: bytes of the audio file, or a file-like object to read them from.
+        :param song_name: song name associated to the audio file.
+        :param extension: extension of the file, which tells pydub (ffmpeg) the format of non wav files.
+        """
+        contents, file_hash = decoder.load_buffer(data)
+        self.__fingerprint_contents(contents, file_hash, song_name, extension)
+
+    def ingest(self, data: Union[decoder.Buffer, BinaryIO], song_name: str, extension: str = None,
+               input_confidence: float = None, fingerprinted_confidence: float = None) \
+            -> Tuple[Optional[int], Optional[str], bool]:
+        """
+        Fingerprints an audio file and inserts it unless it is already in the catalog, in a single pass:
+        the file is read and hashed once, files with the SHA1 of a fingerprinted one are never decoded, and
+        the same fingerprints are used to look for the song and to insert it.
+
+        :param data: bytes of the audio file, or a file-like object to read them from.
+        :param song_name: song name associated to the audio file.
+        :param extension: extension of the file, which tells pydub (ffmpeg) the format of non wav files.
+        :param input_confidence: the audio is taken for the song it matches best when both its input
+        confidence and fingerprinted confidence are above these ones. None to only skip identical files.
+        :param fingerprinted_confidence: see input_confidence.
+        :return: a tuple with the song id and name, and whether the song was inserted. The song is the
+        one the audio was taken for if it was not inserted, its id being None if it is still being inserted.
+        """
+        contents, file_hash = decoder.load_buffer(data)
+        with self._lock:
+            duplicate = file_hash in self.songhashes_set
+        if duplicate:
+            return self.__fingerprinted_song(file_hash)
+
+        hashes, file_hash, cache_hit = Dejavu.get_buffer_fingerprints(contents, file_hash, self.limit,
+                                                                      extension=extension, profile=self.profile,
+                                                                      cache=self.cache)
+        self.__count_cache_lookup(cache_hit)
+
+        if input_confidence is not None and fingerprinted_confidence is not None:
+            songs = self.match_hashes(hashes, topn=1)
+            if self.__is_same_song(songs, input_confidence, fingerprinted_confidence):
+                return songs[0][SONG_ID], songs[0][SONG_NAME].decode("utf8"), False
+
+        song_id = self.__store_fingerprints(song_name, file_hash, hashes)
+        if song_id is None:
+            # the same file got fingerprinted meanwhile.
+            return self.__fingerprinted_song(file_hash)
+
+        return song_id, song_name, True
+
+    async def ingest_async(self, data: Union[decoder.Buffer, BinaryIO], song_name: str, extension: str = None,
+                           input_confidence: float = None, fingerprinted_confidence: float = None) \
+            -> Tuple[Optional[int], Optional[str], bool]:
+        """
+        Same as ingest, without blocking the event loop. The audio is decoded and fingerprinted in the
+        executor of the instance.
+
+        :param data: bytes of the audio file, or a file-like object to read them from.
+        :param song_name: song name associated to the audio file.
+        :param extension: extension of the file, which tells pydub (ffmpeg) the format of non wav files.
+        :param input_confidence: the audio is taken for the song it matches best when both its input
+        confidence and fingerprinted confidence are above these ones. None to only skip identical files.
+        :param fingerprinted_confidence: see input_confidence.
+        :return: a tuple with the song id and name, and whether the song was inserted. The song is the
+        one the audio was taken for if it was not inserted, its id being None if it is still being inserted.
+        """
+        contents, file_hash = decoder.load_buffer(data)
+        with self._lock:
+            duplicate = file_hash in self.songhashes_set
+        if duplicate:
+            return await self.__fingerprinted_song_async(file_hash)
+
+        hashes, file_hash, cache_hit = await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(Dejavu.get_buffer_fingerprints, contents, file_hash, self.limit,
+                                   extension=extension, profile=self.profile, cache=self.cache))
+        self.__count_cache_lookup(cache_hit)
+
+        if input_confidence is not None and fingerprinted_confidence is not None:
+            songs = await self.match_hashes_async(hashes, topn=1)
+            if self.__is_same_song(songs, input_confidence, fingerprinted_confidence):
+                return songs[0][SONG_ID], songs[0][SONG_NAME].decode("utf8"), False
+
+        if self.async_db is None:
+            song_id = await asyncio.to_thread(self.__store_fingerprints, song_name, file_hash, hashes)
         else:
-            song_name, hashes, file_hash = Dejavu._fingerprint_worker(
-                (file_path,
-                self.limit)
-                # song_name=song_name
-            )
-            sid = self.db.insert_song(song_name, file_hash, len(hashes))
+            song_id = await self.__store_fingerprints_async(song_name, file_hash, hashes)
+        if song_id is None:
+            # the same file got fingerprinted meanwhile.
+            return await self.__fingerprinted_song_async(file_hash)
 
-            self.db.insert_hashes(sid, hashes)
-            self.db.set_song_fingerprinted(sid)
-            self.__load_fingerprinted_audio_hashes()
+        return song_id, song_name, True
 
-    def generate_fingerprints(self, samples: List[int], Fs=DEFAULT_FS) -> Tuple[List[Tuple[str, int]], float]:
+    def __fingerprinted_song(self, file_hash: str) -> Tuple[Optional[int], Optional[str], bool]:
+        """
+        :param file_hash: SHA1 of an audio file already fingerprinted.
+        :return: the ingest result of the audio file, its song id and name being None if the song is still
+        being inserted.
+        """
+        song_id = self.__song_id(file_hash)
+        song = self.db.get_song_by_id(song_id) if song_id is not None else None
+        return song_id, song.get(SONG_NAME, None) if song else None, False
+
+    async def __fingerprinted_song_async(self, file_hash: str) -> Tuple[Optional[int], Optional[str], bool]:
+        song_id = self.__song_id(file_hash)
+        song = await self.__get_song_async(song_id) if song_id is not None else None
+        return song_id, song.get(SONG_NAME, None) if song else None, False
+
+    def __song_id(self, file_hash: str) -> Optional[int]:
+        with self._lock:
+            return next((song_id for song_id, song_hash in self.song_hashes.items() if song_hash == file_hash),
+                        None)
+
+    @staticmethod
+    def __is_same_song(songs: List[Dict[str, any]], input_confidence: float, fingerprinted_confidence: float) -> bool:
+        return bool(songs) and songs[0][INPUT_CONFIDENCE] > input_confidence \
+            and songs[0][FINGERPRINTED_CONFIDENCE] > fingerprinted_confidence
+
+    def __fingerprint_contents(self, contents: decoder.Buffer, file_hash: str, song_name: str,
+                               extension: str = None) -> None:
+        hashes, file_hash, cache_hit = Dejavu.get_buffer_fingerprints(contents, file_hash, self.limit,
+                                                                      extension=extension, profile=self.profile,
+                                                                      cache=self.cache,
+                                                                      known_hashes=self.songhashes_set)
+        self.__count_cache_lookup(cache_hit)
+        if hashes is None or self.__store_fingerprints(song_name, file_hash, hashes) is None:
+            print(f"{song_name} already fingerprinted, continuing...")
+
+    def __count_cache_lookup(self, cache_hit: Optional[bool]) -> None:
+        # lookups are counted here, whichever process made them.
+        if cache_hit is not None:
+            self.cache.count(cache_hit)
+
+    def generate_fingerprints(self, samples: List[int], Fs=DEFAULT_FS) -> Tuple[np.ndarray, float]:
         f"""
-        Generate the fingerprints for the given sample data (channel).
+        Generate the fingerprints for the given sample data (channel), with the window of the catalog profile.
+        The channel is expected to be already prepared for the profile (see prepare_channels).
 
         :param samples: list of ints which represents the channel info of the given audio file.
         :param Fs: sampling rate which defaults to {DEFAULT_FS}.
-        :return: a list of tuples for hash and its corresponding offset, together with the generation time.
+        :return: an array of (hash, offset) records, together with the generation time.
         """
         t = time()
-        hashes = fingerprint(samples, Fs=Fs)
+        hashes = fingerprint(samples, Fs=Fs, wsize=self.profile["window_size"], wratio=self.profile["overlap_ratio"])
         fingerprint_time = time() - t
         return hashes, fingerprint_time
 
-    def find_matches(self, hashes: List[Tuple[str, int]]) -> Tuple[List[Tuple[int, int]], Dict[str, int], float]:
+    def find_matches(self, hashes: np.ndarray) -> Tuple[np.ndarray, Dict[int, int], float]:
         """
         Finds the corresponding matches on the fingerprinted audios for the given hashes.
 
-        :param hashes: list of tuples for hashes and their corresponding offsets
-        :return: a tuple containing the matches found against the db, a dictionary which counts the different
+        :param hashes: array of (hash, offset) records
+        :return: a tuple containing the (song id, offset difference) matches found against the db as an
+         (n, 2) array, a dictionary which counts the different
          hashes matched for each song (with the song id as key), and the time that the query took.
 
         """
@@ -172,13 +440,102 @@ class Dejavu:
 
         return matches, dedup_hashes, query_time
 
-    def align_matches(self, matches: List[Tuple[int, int]], dedup_hashes: Dict[str, int], queried_hashes: int,
-                      topn: int = TOPN) -> List[Dict[str, any]]:
+    def find_aligned_matches(self, hashes: np.ndarray, topn: int = TOPN) \
+            -> Tuple[np.ndarray, np.ndarray, Dict[int, int], float]:
+        """
+        Same as find_matches followed by the alignment of align_matches, done by the database.
+
+        :param hashes: array of (hash, offset) records
+        :param topn: number of songs to find.
+        :return: a tuple containing the song ids and best offset differences of the topn songs, a dictionary
+         which counts the different hashes matched for each of those songs (with the song id as key), and the
+         time that the query took.
+        """
+        t = time()
+        song_ids, offsets, _, dedup_hashes = self.db.return_best_offsets(hashes, topn)
+        query_time = time() - t
+
+        return song_ids, offsets, dedup_hashes, query_time
+
+    async def find_matches_async(self, hashes: np.ndarray) -> Tuple[np.ndarray, Dict[int, int], float]:
+        """
+        Same as find_matches, without blocking the event loop.
+
+        :param hashes: array of (hash, offset) records
+        :return: a tuple containing the (song id, offset difference) matches found against the db as an
+         (n, 2) array, a dictionary which counts the different
+         hashes matched for each song (with the song id as key), and the time that the query took.
+        """
+        t = time()
+        if self.async_db is None:
+            matches, dedup_hashes = await asyncio.to_thread(self.db.return_matches, hashes)
+        else:
+            matches, dedup_hashes = await self.async_db.return_matches(hashes)
+        query_time = time() - t
+
+        return matches, dedup_hashes, query_time
+
+    async def find_aligned_matches_async(self, hashes: np.ndarray, topn: int = TOPN) \
+            -> Tuple[np.ndarray, np.ndarray, Dict[int, int], float]:
+        """
+        Same as find_aligned_matches, without blocking the event loop.
+
+        :param hashes: array of (hash, offset) records
+        :param topn: number of songs to find.
+        :return: a tuple containing the song ids and best offset differences of the topn songs, a dictionary
+         which counts the different hashes matched for each of those songs (with the song id as key), and the
+         time that the query took.
+        """
+        t = time()
+        if self.async_db is None:
+            song_ids, offsets, _, dedup_hashes = await asyncio.to_thread(self.db.return_best_offsets, hashes, topn)
+        else:
+            song_ids, offsets, _, dedup_hashes = await self.async_db.return_best_offsets(hashes, topn)
+        query_time = time() - t
+
+        return song_ids, offsets, dedup_hashes, query_time
+
+    def find_matches_batch(self, recordings: List[np.ndarray]) \
+            -> Tuple[List[Tuple[np.ndarray, Dict[int, int]]], float]:
+        """
+        Same as find_matches for several recordings, whose hashes are all looked up in a single pass.
+
+        :param recordings: array of (hash, offset) records of each recording.
+        :return: a tuple with the matches and dictionary of hashes matched per song of each recording, as
+         find_matches gives them, and the time that the query took.
+        """
+        t = time()
+        matches = self.db.return_matches_batch(recordings)
+        query_time = time() - t
+
+        return matches, query_time
+
+    async def find_matches_batch_async(self, recordings: List[np.ndarray]) \
+            -> Tuple[List[Tuple[np.ndarray, Dict[int, int]]], float]:
+        """
+        Same as find_matches_batch, without blocking the event loop.
+
+        :param recordings: array of (hash, offset) records of each recording.
+        :return: a tuple with the matches and dictionary of hashes matched per song of each recording, as
+         find_matches gives them, and the time that the query took.
+        """
+        t = time()
+        if self.async_db is None:
+            matches = await asyncio.to_thread(self.db.return_matches_batch, recordings)
+        else:
+            matches = await self.async_db.return_matches_batch(recordings)
+        query_time = time() - t
+
+        return matches, query_time
+
+    def align_matches(self, matches: Union[np.ndarray, List[Tuple[int, int]]], dedup_hashes: Dict[int, int],
+                      queried_hashes: int, topn: int = TOPN) -> List[Dict[str, any]]:
         """
         Finds hash matches that align in time with other matches and finds
         consensus about which hashes are "true" signal from the audio.
 
-        :param matches: matches from the database
+        :param matches: (song id, offset difference) matches from the database, as an (n, 2) array
+        or a list of tuples.
         :param dedup_hashes: dictionary containing the hashes matched without duplicates for each song
         (key is the song id).
         :param queried_hashes: amount of hashes sent for matching against the db
@@ -186,22 +543,73 @@ class Dejavu:
         :return: a list of dictionaries (based on topn) with match information.
         """
         # count offset occurrences per song and keep only the maximum ones.
-        # print(f"before sorting\n{len(matches[0])}")
-        sorted_matches = sorted(matches, key=lambda m: (m[0], m[1]))
-        # print(f"sorted_matches\n{len(sorted_matches[0])}")
-        counts = [(*key, len(list(group))) for key, group in groupby(sorted_matches, key=lambda m: (m[0], m[1]))]
-        songs_matches = sorted(
-            [max(list(group), key=lambda g: g[2]) for key, group in groupby(counts, key=lambda count: count[0])],
-            key=lambda count: count[2], reverse=True
-        )
+        matches = np.asarray(matches, dtype=np.int64).reshape(-1, 2)
+        song_ids, offsets, _ = best_offsets(matches[:, 0], matches[:, 1], topn)
 
-        songs_result = []
-        for song_id, offset, _ in songs_matches[0:topn]:  # consider topn elements in the result
-            song = self.db.get_song_by_id(song_id)
+        return self.get_songs_result(song_ids, offsets, dedup_hashes, queried_hashes)
+
+    async def align_matches_async(self, matches: Union[np.ndarray, List[Tuple[int, int]]],
+                                  dedup_hashes: Dict[int, int], queried_hashes: int,
+                                  topn: int = TOPN) -> List[Dict[str, any]]:
+        """
+        Same as align_matches, without blocking the event loop on the songs lookup.
+
+        :param matches: (song id, offset difference) matches from the database, as an (n, 2) array
+        or a list of tuples.
+        :param dedup_hashes: dictionary containing the hashes matched without duplicates for each song
+        (key is the song id).
+        :param queried_hashes: amount of hashes sent for matching against the db
+        :param topn: number of results being returned back.
+        :return: a list of dictionaries (based on topn) with match information.
+        """
+        matches = np.asarray(matches, dtype=np.int64).reshape(-1, 2)
+        song_ids, offsets, _ = best_offsets(matches[:, 0], matches[:, 1], topn)
 
+        return await self.get_songs_result_async(song_ids, offsets, dedup_hashes, queried_hashes)
+
+    def get_songs_result(self, song_ids: np.ndarray, offsets: np.ndarray, dedup_hashes: Dict[int, int],
+                         queried_hashes: int) -> List[Dict[str, any]]:
+        """
+        Builds the match information of the songs found.
+
+        :param song_ids: ids of the songs found, best match first.
+        :param offsets: offset difference of each song.
+        :param dedup_hashes: dictionary containing the hashes matched without duplicates for each song
+        (key is the song id).
+        :param queried_hashes: amount of hashes sent for matching against the db
+        :return: a list of dictionaries with match information.
+        """
+        songs = [self.db.get_song_by_id(song_id) for song_id in song_ids.tolist()]
+        return self.__songs_result(song_ids, offsets, songs, dedup_hashes, queried_hashes)
+
+    async def get_songs_result_async(self, song_ids: np.ndarray, offsets: np.ndarray, dedup_hashes: Dict[int, int],
+                                     queried_hashes: int) -> List[Dict[str, any]]:
+        """
+        Same as get_songs_result, the songs being looked up concurrently without blocking the event loop.
+
+        :param song_ids: ids of the songs found, best match first.
+        :param offsets: offset difference of each song.
+        :param dedup_hashes: dictionary containing the hashes matched without duplicates for each song
+        (key is the song id).
+        :param queried_hashes: amount of hashes sent for matching against the db
+        :return: a list of dictionaries with match information.
+        """
+        songs = await asyncio.gather(*(self.__get_song_async(song_id) for song_id in song_ids.tolist()))
+        return self.__songs_result(song_ids, offsets, songs, dedup_hashes, queried_hashes)
+
+    async def __get_song_async(self, song_id: int) -> Optional[Dict[str, any]]:
+        if self.async_db is None:
+            return await asyncio.to_thread(self.db.get_song_by_id, song_id)
+        return await self.async_db.get_song_by_id(song_id)
+
+    def __songs_result(self, song_ids: np.ndarray, offsets: np.ndarray, songs: List[Dict[str, any]],
+                       dedup_hashes: Dict[int, int], queried_hashes: int) -> List[Dict[str, any]]:
+        songs_result = []
+        for song_id, offset, song in zip(song_ids.tolist(), offsets.tolist(), songs):
             song_name = song.get(SONG_NAME, None)
             song_hashes = song.get(FIELD_TOTAL_HASHES, None)
-            nseconds = round(float(offset) / DEFAULT_FS * DEFAULT_WINDOW_SIZE * DEFAULT_OVERLAP_RATIO, 5)
+            nseconds = round(float(offset) / self.profile["sample_rate"] * self.profile["window_size"] *
+                             self.profile["overlap_ratio"], 5)
             hashes_matched = dedup_hashes[song_id]
 
             song = {
@@ -223,41 +631,248 @@ class Dejavu:
 
         return songs_result
 
+    def match_hashes(self, hashes: np.ndarray, topn: int = TOPN) -> List[Dict[str, any]]:
+        """
+        Finds the songs matching the given hashes, as recognizers do.
+
+        :param hashes: array of (hash, offset) records
+        :param topn: number of songs to find.
+        :return: a list of dictionaries (based on topn) with match information.
+        """
+        if self.align_in_database:
+            song_ids, offsets, dedup_hashes, _ = self.find_aligned_matches(hashes, topn)
+            return self.get_songs_result(song_ids, offsets, dedup_hashes, len(hashes))
+
+        matches, dedup_hashes, _ = self.find_matches(hashes)
+        return self.align_matches(matches, dedup_hashes, len(hashes), topn)
+
+    async def match_hashes_async(self, hashes: np.ndarray, topn: int = TOPN) -> List[Dict[str, any]]:
+        """
+        Same as match_hashes, without blocking the event loop.
+
+        :param hashes: array of (hash, offset) records
+        :param topn: number of songs to find.
+        :return: a list of dictionaries (based on topn) with match information.
+        """
+        if self.align_in_database:
+            song_ids, offsets, dedup_hashes, _ = await self.find_aligned_matches_async(hashes, topn)
+            return await self.get_songs_result_async(song_ids, offsets, dedup_hashes, len(hashes))
+
+        matches, dedup_hashes, _ = await self.find_matches_async(hashes)
+        return await self.align_matches_async(matches, dedup_hashes, len(hashes), topn)
+
     def recognize(self, recognizer, *options, **kwoptions) -> Dict[str, any]:
         r = recognizer(self)
         return r.recognize(*options, **kwoptions)
 
+    async def recognize_async(self, recognizer, *options, **kwoptions) -> Dict[str, any]:
+        """
+        Same as recognize, for event loops. The audio is decoded and fingerprinted in the executor of the
+        instance while the database is queried asynchronously, so many recognitions can be in flight at once.
+        """
+        r = recognizer(self)
+        return await r.recognize_async(*options, **kwoptions)
+
+    async def recognize_batch_async(self, recordings: List[decoder.Buffer], extension: str = None, topn: int = TOPN,
+                                    tasks: int = None) -> List[Dict[str, any]]:
+        """
+        Recognizes several audio files at once. They are decoded and fingerprinted in parallel in the executor
+        of the instance, the hashes of all of them are looked up in a single pass, and each one is then aligned
+        on its own. Songs found by several recordings are looked up once.
+
+        :param recordings: bytes of each audio file.
+        :param extension: extension of the files, which tells pydub (ffmpeg) the format of non wav files.
+        :param topn: number of songs to find for each recording.
+        :param tasks: number of executor tasks the recordings are split in, one per recording by default.
+        :return: the recognition results of each recording, as recognizers give them, or a dictionary with
+        the error that kept it from being recognized.
+        """
+        t = time()
+        tasks = min(tasks or len(recordings), len(recordings))
+        fingerprinted = await self.__run_all([
+            partial(Dejavu._fingerprint_recordings, recordings[index::tasks], self.limit, extension, self.profile)
+            for index in range(tasks)])
+
+        # back in the order of the recordings, task i got the recordings i, i + tasks, i + 2 * tasks...
+        fingerprints = [None] * len(recordings)
+        for index, task_fingerprints in enumerate(fingerprinted):
+            fingerprints[index::tasks] = task_fingerprints
+
+        found = [index for index, (hashes, _, _) in enumerate(fingerprints) if hashes is not None]
+        matches, query_time = await self.find_matches_batch_async([fingerprints[index][0] for index in found])
+
+        aligned = {}
+        for index, (recording_matches, dedup_hashes) in zip(found, matches):
+            align_start = time()
+            song_ids, offsets, _ = best_offsets(recording_matches[:, 0], recording_matches[:, 1], topn)
+            aligned[index] = song_ids, offsets, dedup_hashes, time() - align_start
+
+        song_ids = sorted({song_id for ids, _, _, _ in aligned.values() for song_id in ids.tolist()})
+        songs = dict(zip(song_ids, await asyncio.gather(*(self.__get_song_async(song_id) for song_id in song_ids))))
+        total_time = time() - t
+
+        results = []
+        for index, (hashes, fingerprint_time, error) in enumerate(fingerprints):
+            if hashes is None:
+                results.append({ERROR: error})
+                continue
+
+            ids, offsets, dedup_hashes, align_time = aligned[index]
+            results.append({
+                TOTAL_TIME: total_time,
+                FINGERPRINT_TIME: fingerprint_time,
+                QUERY_TIME: query_time,
+                ALIGN_TIME: align_time,
+                RESULTS: self.__songs_result(ids, offsets, [songs[song_id] for song_id in ids.tolist()],
+                                             dedup_hashes, len(hashes))
+            })
+
+        return results
+
+    async def __run_all(self, calls: List[Callable[[], any]]) -> List[any]:
+        """
+        Runs several calls in the executor of the instance. Executors bounding their queue (with a submit_all
+        method) take them all or none, otherwise, if one can't be submitted or fails, the ones not started
+        yet are cancelled rather than left running for a request that already failed.
+
+        :param calls: callables without arguments.
+        :return: the result of each call.
+        """
+        loop = asyncio.get_running_loop()
+        futures = []
+        try:
+            submit_all = getattr(self.executor, "submit_all", None)
+            if submit_all is not None:
+                futures = [asyncio.wrap_future(future) for future in submit_all(calls)]
+            else:
+                for call in calls:
+                    futures.append(loop.run_in_executor(self.executor, call))
+            return await asyncio.gather(*futures)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    # hashes of the songs already fingerprinted, set in every pool worker by _init_fingerprint_worker.
+    _worker_known_hashes = frozenset()
+
+    @staticmethod
+    def _init_fingerprint_worker(known_hashes: FrozenSet[str]) -> None:
+        Dejavu._worker_known_hashes = known_hashes
+
     @staticmethod
     def _fingerprint_worker(arguments):
         # Pool.imap sends arguments as tuples so we have to unpack
         # them ourself.
         try:
-            file_name, limit = arguments
+            file_name, limit, profile, cache = arguments
         except ValueError:
             pass
 
         song_name, extension = os.path.splitext(os.path.basename(file_name))
 
-        fingerprints, file_hash = Dejavu.get_file_fingerprints(file_name, limit, print_output=True)
+        fingerprints, file_hash, cache_hit = Dejavu.get_file_fingerprints(file_name, limit, print_output=True,
+                                                                          profile=profile, cache=cache,
+                                                                          known_hashes=Dejavu._worker_known_hashes)
+        return song_name, fingerprints, file_hash, cache_hit
+
+    @staticmethod
+    def get_file_fingerprints(file_name: str, limit: int, print_output: bool = False,
+                              profile: Dict[str, any] = FINGERPRINT_PROFILES[DEFAULT_FINGERPRINT_PROFILE],
+                              cache: FingerprintCache = None, known_hashes: AbstractSet[str] = None):
+        """
+        Reads, hashes and fingerprints an audio file, going over the file contents only once.
+
+        :param file_name: path to the file.
+        :param limit: number of seconds to fingerprint, None for the whole file.
+        :param print_output: whether to print progress.
+        :param profile: fingerprint profile to use.
+        :param cache: fingerprint cache to look up first and fill, if any.
+        :param known_hashes: hashes of the files already fingerprinted, which are not fingerprinted again.
+        :return: an array of (hash, offset) records, None if the file hash is in known_hashes, the file hash,
+        and whether the fingerprints were found in the cache, None if it was not looked up.
+        """
+        contents, file_hash = decoder.load(file_name)
+
+        if print_output:
+            pass
+            # print(f"Fingerprinting {file_name}")
+
+        fingerprints, file_hash, cache_hit = Dejavu.get_buffer_fingerprints(contents, file_hash, limit,
+                                                                            extension=os.path.splitext(file_name)[1],
+                                                                            profile=profile, cache=cache,
+                                                                            known_hashes=known_hashes)
+
+        if print_output:
+            pass
+            # print(f"Finished {file_name}")
 
-        return song_name, fingerprints, file_hash
+        return fingerprints, file_hash, cache_hit
 
     @staticmethod
-    def get_file_fingerprints(file_name: str, limit: int, print_output: bool = False):
-        channels, fs, file_hash = decoder.read(file_name, limit)
-        fingerprints = set()
-        channel_amount = len(channels)
-        for channeln, channel in enumerate(channels, start=1):
-            if print_output:
-                pass
-                # print(f"Fingerprinting channel {channeln}/{channel_amount} for {file_name}")
+    def get_buffer_fingerprints(contents: decoder.Buffer, file_hash: str, limit: int, extension: str = None,
+                                profile: Dict[str, any] = FINGERPRINT_PROFILES[DEFAULT_FINGERPRINT_PROFILE],
+                                cache: FingerprintCache = None, known_hashes: AbstractSet[str] = None):
+        """
+        Fingerprints an audio file already in memory, as given by decoder.load or decoder.load_buffer.
+
+        :param contents: bytes of the file.
+        :param file_hash: hash of the file contents.
+        :param limit: number of seconds to fingerprint, None for the whole file.
+        :param extension: extension of the file, which tells pydub (ffmpeg) the format of non wav files.
+        :param profile: fingerprint profile to use.
+        :param cache: fingerprint cache to look up first and fill, if any.
+        :param known_hashes: hashes of the files already fingerprinted, which are not fingerprinted again.
+        :return: an array of (hash, offset) records, None if the file hash is in known_hashes, the file hash,
+        and whether the fingerprints were found in the cache, None if it was not looked up. The lookup is
+        not counted by the cache, which may be a copy in another process, but by the caller.
+        """
+        if known_hashes is not None and file_hash in known_hashes:
+            return None, file_hash, None
+
+        if cache is not None:
+            fingerprints = cache.get(file_hash, limit, profile)
+            if fingerprints is not None:
+                return fingerprints, file_hash, True
+
+        channels, fs = decoder.decode(contents, limit, extension=extension)
+        channels, fs = prepare_channels(channels, fs, profile)
+
+        fingerprints = [np.empty(0, dtype=FINGERPRINT_DTYPE)]
+        for channel in channels:
+            fingerprints.append(fingerprint(channel, Fs=fs, wsize=profile["window_size"],
+                                            wratio=profile["overlap_ratio"]))
+
+        # drop the fingerprints repeated across channels.
+        fingerprints = np.unique(np.concatenate(fingerprints))
 
-            hashes = fingerprint(channel, Fs=fs)
+        if cache is not None:
+            cache.put(file_hash, limit, profile, fingerprints)
 
-            if print_output:
-                pass
-                # print(f"Finished channel {channeln}/{channel_amount} for {file_name}")
+        return fingerprints, file_hash, False if cache is not None else None
 
-            fingerprints |= set(hashes)
+    @staticmethod
+    def _fingerprint_recordings(recordings: List[decoder.Buffer], limit: int, extension: str,
+                                profile: Dict[str, any]) -> List[Tuple[Optional[np.ndarray], float, Optional[str]]]:
+        """
+        Decodes and fingerprints recordings to recognize, one after the other.
+
+        :param recordings: bytes of each audio file.
+        :param limit: number of seconds to fingerprint, None for the whole file.
+        :param extension: extension of the files, which tells pydub (ffmpeg) the format of non wav files.
+        :param profile: fingerprint profile to use.
+        :return: for each recording, a tuple with its array of (hash, offset) records and the time it took
+        to get them, or None and the error that kept it from being fingerprinted.
+        """
+        fingerprints = []
+        for contents in recordings:
+            t = time()
+            try:
+                hashes, _, _ = Dejavu.get_buffer_fingerprints(contents, None, limit, extension=extension,
+                                                              profile=profile)
+            except Exception as e:
+                fingerprints.append((None, time() - t, str(e)))
+            else:
+                fingerprints.append((hashes, time() - t, None))
 
-        return fingerprints, file_hash
+        return fingerprints
@@ -0,0 +1,158 @@
+import abc
+import importlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from dejavu.base_classes.common_database import (group_hashes, pair_matches,
+                                                 pair_recording_matches)
+from dejavu.config.settings import ASYNC_DATABASES, TOPN
+from dejavu.logic.alignment import best_offsets
+
+
+class AsyncCommonDatabase(object, metaclass=abc.ABCMeta):
+    """
+    Async counterpart of the lookups and inserts of CommonDatabase, so an event loop can keep many
+    queries in flight at once instead of blocking on each of them. It is built with the same options
+    as the database handler of its type, and works on the tables that handler set up.
+    """
+    # Name of the database handler this class is the async counterpart of, as in DATABASES.
+    type = None
+
+    def __init__(self):
+        super().__init__()
+
+    async def close(self) -> None:
+        """
+        Closes the connections of the database, called on shutdown.
+        """
+        pass
+
+    @abc.abstractmethod
+    async def insert_song(self, song_name: str, file_hash: str, total_hashes: int) -> int:
+        """
+        Inserts a song name into the database, returns the new
+        identifier of the song.
+
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param total_hashes: amount of hashes to be inserted on fingerprint table.
+        :return: the inserted id.
+        """
+        pass
+
+    @abc.abstractmethod
+    async def insert_hashes(self, song_id: int, hashes: np.ndarray, batch_size: int = 1000) -> None:
+        """
+        Insert a multitude of fingerprints.
+
+        :param song_id: Song identifier the fingerprints belong to
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
+            - offset: Offset this hash was created from/at.
+        :param batch_size: insert batches.
+        """
+        pass
+
+    @abc.abstractmethod
+    async def set_song_fingerprinted(self, song_id: int) -> None:
+        """
+        Sets a specific song as having all fingerprints in the database.
+
+        :param song_id: song identifier.
+        """
+        pass
+
+    @abc.abstractmethod
+    async def get_song_by_id(self, song_id: int) -> Optional[Dict[str, str]]:
+        """
+        Brings the song info from the database.
+
+        :param song_id: song identifier.
+        :return: a song by its identifier. Result must be a Dictionary.
+        """
+        pass
+
+    async def return_matches(self, hashes: np.ndarray, batch_size: int = 1000) \
+            -> Tuple[np.ndarray, Dict[int, int]]:
+        """
+        Searches the database for pairs of (hash, offset) values.
+
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
+            - offset: Offset this hash was created from/at.
+        :param batch_size: number of query's batches.
+        :return: an (n, 2) int64 array of (sid, offset_difference) rows and a
+        dictionary with the amount of hashes matched (not considering
+        duplicated hashes) in each song.
+            - song id: Song identifier
+            - offset_difference: (database_offset - sampled_offset)
+        """
+        values, starts, counts, sampled_offsets = group_hashes(hashes)
+        indexes, song_ids, db_offsets = await self._fetch_matches(values, batch_size)
+        return pair_matches(indexes, song_ids, db_offsets, starts, counts, sampled_offsets)
+
+    async def return_matches_batch(self, recordings: List[np.ndarray], batch_size: int = 1000) \
+            -> List[Tuple[np.ndarray, Dict[int, int]]]:
+        """
+        Same as return_matches for several recordings, whose hashes are all looked up at once.
+
+        :param recordings: an array of FINGERPRINT_DTYPE records for each recording.
+        :param batch_size: number of query's batches.
+        :return: the return_matches result of each recording.
+        """
+        groups = [group_hashes(hashes) for hashes in recordings]
+        values = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + [group[0] for group in groups]))
+        indexes, song_ids, db_offsets = await self._fetch_matches(values, batch_size)
+        return [pair_recording_matches(values, indexes, song_ids, db_offsets, group) for group in groups]
+
+    async def return_best_offsets(self, hashes: np.ndarray, topn: int = TOPN, batch_size: int = 1000) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[int, int]]:
+        """
+        Searches the database for pairs of (hash, offset) values and aligns them, returning only
+        the best offset difference of the songs with the most matches on it.
+
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
+            - offset: Offset this hash was created from/at.
+        :param topn: number of songs to return.
+        :param batch_size: number of query's batches.
+        :return: a tuple of arrays with the song ids, best offset differences and number of matches on
+        that offset of the topn songs, sorted by decreasing number of matches, and a dictionary with the
+        amount of hashes matched (not considering duplicated hashes) in each of those songs.
+        """
+        matches, dedup_hashes = await self.return_matches(hashes, batch_size)
+        song_ids, offsets, counts = best_offsets(matches[:, 0], matches[:, 1], topn)
+        return song_ids, offsets, counts, {song_id: dedup_hashes[song_id] for song_id in song_ids.tolist()}
+
+    @abc.abstractmethod
+    async def _fetch_matches(self, values: np.ndarray, batch_size: int = 1000) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Brings every fingerprint stored for the given hashes.
+
+        :param values: sorted array of unique hashes.
+        :param batch_size: number of query's batches.
+        :return: a tuple of int64 arrays with, for every fingerprint found, the index of its hash in values,
+        its song id and its offset.
+        """
+        pass
+
+
+def get_async_database(database_type: str) -> Optional[type]:
+    """
+    Given a database type it returns the async database class for that type.
+
+    :param database_type: type of the database.
+    :return: a subclass of AsyncCommonDatabase, None if the database type has no async counterpart.
+    """
+    if database_type not in ASYNC_DATABASES:
+        return None
+
+    path, db_class_name = ASYNC_DATABASES[database_type]
+    try:
+        db_module = importlib.import_module(path)
+    except ImportError:
+        # the async driver is optional, the database is then queried in a thread.
+        return None
+    return getattr(db_module, db_class_name)
@@ -1,8 +1,10 @@
 import abc
 import importlib
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
-from dejavu.config.settings import DATABASES
+import numpy as np
+
+from dejavu.config.settings import DATABASES, TOPN
 
 
 class BaseDatabase(object, metaclass=abc.ABCMeta):
@@ -95,11 +97,32 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         pass
 
     @abc.abstractmethod
-    def insert(self, fingerprint: str, song_id: int, offset: int):
+    def get_setting(self, name: str) -> Optional[str]:
+        """
+        Returns the value of a catalog setting.
+
+        :param name: setting name.
+        :return: the stored value, None if the setting was never set.
+        """
+        pass
+
+    @abc.abstractmethod
+    def set_setting(self, name: str, value: str) -> str:
+        """
+        Stores a catalog setting unless it was already set.
+
+        :param name: setting name.
+        :param value: value to store.
+        :return: the value of the setting after the call, which is the former one if it was already set.
+        """
+        pass
+
+    @abc.abstractmethod
+    def insert(self, fingerprint: int, song_id: int, offset: int):
         """
         Inserts a single fingerprint into the database.
 
-        :param fingerprint: Part of a sha1 hash, in hexadecimal format
+        :param fingerprint: First 64 bits of a sha1 hash, as a signed integer
         :param song_id: Song identifier this fingerprint is off
         :param offset: The offset this fingerprint is from.
         """
@@ -119,12 +142,25 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         pass
 
     @abc.abstractmethod
-    def query(self, fingerprint: str = None) -> List[Tuple]:
+    def mirror_song(self, song_id: int, song_name: str, file_hash: str, total_hashes: int) -> None:
+        """
+        Inserts a song under an identifier given by another database, unless it is already stored.
+        Used by the shards of a sharded catalog, whose fingerprints belong to songs stored elsewhere.
+
+        :param song_id: song identifier.
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param total_hashes: amount of hashes of the song.
+        """
+        pass
+
+    @abc.abstractmethod
+    def query(self, fingerprint: int = None) -> List[Tuple]:
         """
         Returns all matching fingerprint entries associated with
         the given hash as parameter, if None is passed it returns all entries.
 
-        :param fingerprint: part of a sha1 hash, in hexadecimal format
+        :param fingerprint: first 64 bits of a sha1 hash, as a signed integer
         :return: a list of fingerprint records stored in the db.
         """
         pass
@@ -139,28 +175,27 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         pass
 
     @abc.abstractmethod
-    def insert_hashes(self, song_id: int, hashes: List[Tuple[str, int]], batch_size: int = 1000) -> None:
+    def insert_hashes(self, song_id: int, hashes: np.ndarray, batch_size: int = 1000) -> None:
         """
         Insert a multitude of fingerprints.
 
         :param song_id: Song identifier the fingerprints belong to
-        :param hashes: A sequence of tuples in the format (hash, offset)
-            - hash: Part of a sha1 hash, in hexadecimal format
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
             - offset: Offset this hash was created from/at.
         :param batch_size: insert batches.
         """
 
     @abc.abstractmethod
-    def return_matches(self, hashes: List[Tuple[str, int]], batch_size: int = 1000) \
-            -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
+    def return_matches(self, hashes: np.ndarray, batch_size: int = 1000) -> Tuple[np.ndarray, Dict[int, int]]:
         """
         Searches the database for pairs of (hash, offset) values.
 
-        :param hashes: A sequence of tuples in the format (hash, offset)
-            - hash: Part of a sha1 hash, in hexadecimal format
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
             - offset: Offset this hash was created from/at.
         :param batch_size: number of query's batches.
-        :return: a list of (sid, offset_difference) tuples and a
+        :return: an (n, 2) int64 array of (sid, offset_difference) rows and a
         dictionary with the amount of hashes matched (not considering
         duplicated hashes) in each song.
             - song id: Song identifier
@@ -168,6 +203,36 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    @abc.abstractmethod
+    def return_matches_batch(self, recordings: List[np.ndarray], batch_size: int = 1000) \
+            -> List[Tuple[np.ndarray, Dict[int, int]]]:
+        """
+        Same as return_matches for several recordings, whose hashes are all looked up at once.
+
+        :param recordings: an array of FINGERPRINT_DTYPE records for each recording.
+        :param batch_size: number of query's batches.
+        :return: the return_matches result of each recording.
+        """
+        pass
+
+    @abc.abstractmethod
+    def return_best_offsets(self, hashes: np.ndarray, topn: int = TOPN, batch_size: int = 1000) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[int, int]]:
+        """
+        Searches the database for pairs of (hash, offset) values and aligns them, returning only
+        the best offset difference of the songs with the most matches on it.
+
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
+            - offset: Offset this hash was created from/at.
+        :param topn: number of songs to return.
+        :param batch_size: number of query's batches.
+        :return: a tuple of arrays with the song ids, best offset differences and number of matches on
+        that offset of the topn songs, sorted by decreasing number of matches, and a dictionary with the
+        amount of hashes matched (not considering duplicated hashes) in each of those songs.
+        """
+        pass
+
     @abc.abstractmethod
     def delete_songs_by_id(self, song_ids: List[int], batch_size: int = 1000) -> None:
         """
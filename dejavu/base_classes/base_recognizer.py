@@ -1,10 +1,13 @@
 import abc
+import asyncio
+from functools import partial
 from time import time
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Tuple
 
 import numpy as np
 
 from dejavu.config.settings import DEFAULT_FS
+from dejavu.logic.fingerprint import FINGERPRINT_DTYPE, prepare_channels
 
 
 class BaseRecognizer(object, metaclass=abc.ABCMeta):
@@ -14,20 +17,69 @@ class BaseRecognizer(object, metaclass=abc.ABCMeta):
 
     def _recognize(self, *data) -> Tuple[List[Dict[str, any]], int, int, int]:
         fingerprint_times = []
-        hashes = set()  # to remove possible duplicated fingerprints we built a set.
-        for channel in data:
-            fingerprints, fingerprint_time = self.dejavu.generate_fingerprints(channel, Fs=self.Fs)
+        fingerprints = [np.empty(0, dtype=FINGERPRINT_DTYPE)]
+        channels, Fs = prepare_channels(data, self.Fs, self.dejavu.profile)
+        for channel in channels:
+            channel_fingerprints, fingerprint_time = self.dejavu.generate_fingerprints(channel, Fs=Fs)
             fingerprint_times.append(fingerprint_time)
-            hashes |= set(fingerprints)
+            fingerprints.append(channel_fingerprints)
 
-        matches, dedup_hashes, query_time = self.dejavu.find_matches(hashes)
+        # to remove possible duplicated fingerprints across channels.
+        hashes = np.unique(np.concatenate(fingerprints))
 
-        t = time()
-        final_results = self.dejavu.align_matches(matches, dedup_hashes, len(hashes))
+        if self.dejavu.align_in_database:
+            # matches are aligned by the query itself, only the songs found come back.
+            song_ids, offsets, dedup_hashes, query_time = self.dejavu.find_aligned_matches(hashes)
+
+            t = time()
+            final_results = self.dejavu.get_songs_result(song_ids, offsets, dedup_hashes, len(hashes))
+        else:
+            matches, dedup_hashes, query_time = self.dejavu.find_matches(hashes)
+
+            t = time()
+            final_results = self.dejavu.align_matches(matches, dedup_hashes, len(hashes))
         align_time = time() - t
 
         return final_results, np.sum(fingerprint_times), query_time, align_time
 
+    async def _recognize_async(self, fingerprint: Callable, *args, **kwargs) \
+            -> Tuple[List[Dict[str, any]], float, float, float]:
+        """
+        Same as _recognize, without blocking the event loop. The recording is decoded and fingerprinted in
+        the executor of the engine, and the database is queried asynchronously.
+
+        :param fingerprint: a function giving the (hash, offset) records of the recording, its file hash and
+        the cache lookup outcome, as the get_*_fingerprints ones of Dejavu do. It is called with the given
+        arguments and the profile of the catalog.
+        :return: a tuple with the results, the time it took to decode and fingerprint the recording, the query
+        time and the alignment time.
+        """
+        t = time()
+        hashes, _, _ = await asyncio.get_running_loop().run_in_executor(
+            self.dejavu.executor, partial(fingerprint, *args, profile=self.dejavu.profile, **kwargs))
+        fingerprint_time = time() - t
+
+        if self.dejavu.align_in_database:
+            song_ids, offsets, dedup_hashes, query_time = await self.dejavu.find_aligned_matches_async(hashes)
+
+            t = time()
+            final_results = await self.dejavu.get_songs_result_async(song_ids, offsets, dedup_hashes, len(hashes))
+        else:
+            matches, dedup_hashes, query_time = await self.dejavu.find_matches_async(hashes)
+
+            t = time()
+            final_results = await self.dejavu.align_matches_async(matches, dedup_hashes, len(hashes))
+        align_time = time() - t
+
+        return final_results, fingerprint_time, query_time, align_time
+
     @abc.abstractmethod
     def recognize(self) -> Dict[str, any]:
         pass  # base class does nothing
+
+    async def recognize_async(self, *options, **kwoptions) -> Dict[str, any]:
+        """
+        Same as recognize, for event loops. Recognizers without an async way to recognize run
+        recognize in a thread.
+        """
+        return await asyncio.to_thread(self.recognize, *options, **kwoptions)
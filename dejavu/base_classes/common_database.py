@@ -1,7 +1,11 @@
 import abc
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
 
 from dejavu.base_classes.base_database import BaseDatabase
+from dejavu.config.settings import FIELD_HASH, FIELD_OFFSET, TOPN
+from dejavu.logic.alignment import best_offsets
 
 
 class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
@@ -33,6 +37,7 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         with self.cursor() as cur:
             cur.execute(self.CREATE_SONGS_TABLE)
             cur.execute(self.CREATE_FINGERPRINTS_TABLE)
+            cur.execute(self.CREATE_SETTINGS_TABLE)
             cur.execute(self.DELETE_UNFINGERPRINTED)
 
     def empty(self) -> None:
@@ -42,6 +47,7 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         with self.cursor() as cur:
             cur.execute(self.DROP_FINGERPRINTS)
             cur.execute(self.DROP_SONGS)
+            cur.execute(self.DROP_SETTINGS)
 
         self.setup()
 
@@ -107,11 +113,38 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
             cur.execute(self.SELECT_SONG, (song_id,))
             return cur.fetchone()
 
-    def insert(self, fingerprint: str, song_id: int, offset: int):
+    def get_setting(self, name: str) -> Optional[str]:
+        """
+        Returns the value of a catalog setting.
+
+        :param name: setting name.
+        :return: the stored value, None if the setting was never set.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_SETTING, (name,))
+            row = cur.fetchone()
+
+        return row[0] if row else None
+
+    def set_setting(self, name: str, value: str) -> str:
+        """
+        Stores a catalog setting unless it was already set, settings are not meant to change
+        once the catalog has been built with them.
+
+        :param name: setting name.
+        :param value: value to store.
+        :return: the value of the setting after the call, which is the former one if it was already set.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.INSERT_SETTING, (name, value))
+
+        return self.get_setting(name)
+
+    def insert(self, fingerprint: int, song_id: int, offset: int):
         """
         Inserts a single fingerprint into the database.
 
-        :param fingerprint: Part of a sha1 hash, in hexadecimal format
+        :param fingerprint: First 64 bits of a sha1 hash, as a signed integer
         :param song_id: Song identifier this fingerprint is off
         :param offset: The offset this fingerprint is from.
         """
@@ -131,16 +164,29 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         """
         pass
 
-    def query(self, fingerprint: str = None) -> List[Tuple]:
+    def mirror_song(self, song_id: int, song_name: str, file_hash: str, total_hashes: int) -> None:
+        """
+        Inserts a song under an identifier given by another database, unless it is already stored.
+        Used by the shards of a sharded catalog, whose fingerprints belong to songs stored elsewhere.
+
+        :param song_id: song identifier.
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param total_hashes: amount of hashes of the song.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.MIRROR_SONG, (song_id, song_name, file_hash, total_hashes))
+
+    def query(self, fingerprint: int = None) -> List[Tuple]:
         """
         Returns all matching fingerprint entries associated with
         the given hash as parameter, if None is passed it returns all entries.
 
-        :param fingerprint: part of a sha1 hash, in hexadecimal format
+        :param fingerprint: first 64 bits of a sha1 hash, as a signed integer
         :return: a list of fingerprint records stored in the db.
         """
         with self.cursor() as cur:
-            if fingerprint:
+            if fingerprint is not None:
                 cur.execute(self.SELECT, (fingerprint,))
             else:  # select all if no key
                 cur.execute(self.SELECT_ALL)
@@ -154,68 +200,98 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         """
         return self.query(None)
 
-    def insert_hashes(self, song_id: int, hashes: List[Tuple[str, int]], batch_size: int = 1000) -> None:
+    def insert_hashes(self, song_id: int, hashes: np.ndarray, batch_size: int = 1000) -> None:
         """
         Insert a multitude of fingerprints.
 
         :param song_id: Song identifier the fingerprints belong to
-        :param hashes: A sequence of tuples in the format (hash, offset)
-            - hash: Part of a sha1 hash, in hexadecimal format
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
             - offset: Offset this hash was created from/at.
         :param batch_size: insert batches.
         """
-        values = [(song_id, hsh, int(offset)) for hsh, offset in hashes]
+        # tolist gives plain python ints, which is what the database drivers know how to adapt.
+        values = list(zip([song_id] * len(hashes), hashes[FIELD_HASH].tolist(), hashes[FIELD_OFFSET].tolist()))
 
         with self.cursor() as cur:
             for index in range(0, len(hashes), batch_size):
                 cur.executemany(self.INSERT_FINGERPRINT, values[index: index + batch_size])
 
-    def return_matches(self, hashes: List[Tuple[str, int]],
-                       batch_size: int = 1000) -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
+    def return_matches(self, hashes: np.ndarray, batch_size: int = 1000) -> Tuple[np.ndarray, Dict[int, int]]:
         """
         Searches the database for pairs of (hash, offset) values.
 
-        :param hashes: A sequence of tuples in the format (hash, offset)
-            - hash: Part of a sha1 hash, in hexadecimal format
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
             - offset: Offset this hash was created from/at.
         :param batch_size: number of query's batches.
-        :return: a list of (sid, offset_difference) tuples and a
+        :return: an (n, 2) int64 array of (sid, offset_difference) rows and a
         dictionary with the amount of hashes matched (not considering
         duplicated hashes) in each song.
             - song id: Song identifier
             - offset_difference: (database_offset - sampled_offset)
         """
-        # Create a dictionary of hash => offset pairs for later lookups
-        mapper = {}
-        for hsh, offset in hashes:
-            if hsh.upper() in mapper.keys():
-                mapper[hsh.upper()].append(offset)
-            else:
-                mapper[hsh.upper()] = [offset]
+        values, starts, counts, sampled_offsets = group_hashes(hashes)
+        indexes, song_ids, db_offsets = self._fetch_matches(values, batch_size)
+        return pair_matches(indexes, song_ids, db_offsets, starts, counts, sampled_offsets)
 
-        values = list(mapper.keys())
+    def return_matches_batch(self, recordings: List[np.ndarray], batch_size: int = 1000) \
+            -> List[Tuple[np.ndarray, Dict[int, int]]]:
+        """
+        Same as return_matches for several recordings, whose hashes are all looked up at once.
+
+        :param recordings: an array of FINGERPRINT_DTYPE records for each recording.
+        :param batch_size: number of query's batches.
+        :return: the return_matches result of each recording.
+        """
+        groups = [group_hashes(hashes) for hashes in recordings]
+        values = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + [group[0] for group in groups]))
+        indexes, song_ids, db_offsets = self._fetch_matches(values, batch_size)
+        return [pair_recording_matches(values, indexes, song_ids, db_offsets, group) for group in groups]
+
+    def return_best_offsets(self, hashes: np.ndarray, topn: int = TOPN, batch_size: int = 1000) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[int, int]]:
+        """
+        Searches the database for pairs of (hash, offset) values and aligns them, returning only
+        the best offset difference of the songs with the most matches on it.
 
-        # in order to count each hash only once per db offset we use the dic below
-        dedup_hashes = {}
+        Matches are aligned here, handlers able to align them in the database itself override it.
 
-        results = []
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
+            - offset: Offset this hash was created from/at.
+        :param topn: number of songs to return.
+        :param batch_size: number of query's batches.
+        :return: a tuple of arrays with the song ids, best offset differences and number of matches on
+        that offset of the topn songs, sorted by decreasing number of matches, and a dictionary with the
+        amount of hashes matched (not considering duplicated hashes) in each of those songs.
+        """
+        matches, dedup_hashes = self.return_matches(hashes, batch_size)
+        song_ids, offsets, counts = best_offsets(matches[:, 0], matches[:, 1], topn)
+        return song_ids, offsets, counts, {song_id: dedup_hashes[song_id] for song_id in song_ids.tolist()}
+
+    def _fetch_matches(self, values: np.ndarray, batch_size: int = 1000) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Brings every fingerprint stored for the given hashes. Handlers with a faster way to run
+        the lookup only need to override this method.
+
+        :param values: sorted array of unique hashes.
+        :param batch_size: number of query's batches.
+        :return: a tuple of int64 arrays with, for every fingerprint found, the index of its hash in values,
+        its song id and its offset.
+        """
+        hashes = values.tolist()
+        rows = []
         with self.cursor() as cur:
-            for index in range(0, len(values), batch_size):
+            for index in range(0, len(hashes), batch_size):
                 # Create our IN part of the query
-                query = self.SELECT_MULTIPLE % ', '.join([self.IN_MATCH] * len(values[index: index + batch_size]))
-                # print(f"{query = }")
-                cur.execute(query, values[index: index + batch_size])
-
-                for hsh, sid, offset in cur:
-                    if sid not in dedup_hashes.keys():
-                        dedup_hashes[sid] = 1
-                    else:
-                        dedup_hashes[sid] += 1
-                    #  we now evaluate all offset for each  hash matched
-                    for song_sampled_offset in mapper[hsh]:
-                        results.append((sid, offset - song_sampled_offset))
+                query = self.SELECT_MULTIPLE % ', '.join([self.IN_MATCH] * len(hashes[index: index + batch_size]))
+                cur.execute(query, hashes[index: index + batch_size])
+                rows.extend(cur.fetchall())
 
-            return results, dedup_hashes
+        matches = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        return np.searchsorted(values, matches[:, 0]), matches[:, 1], matches[:, 2]
 
     def delete_songs_by_id(self, song_ids: List[int], batch_size: int = 1000) -> None:
         """
@@ -227,6 +303,91 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         with self.cursor() as cur:
             for index in range(0, len(song_ids), batch_size):
                 # Create our IN part of the query
-                query = self.DELETE_SONGS % ', '.join(['%s'] * len(song_ids[index: index + batch_size]))
+                query = self.DELETE_SONGS % ', '.join([self.IN_MATCH] * len(song_ids[index: index + batch_size]))
 
                 cur.execute(query, song_ids[index: index + batch_size])
+
+    def migrate_fingerprints(self) -> bool:
+        """
+        Converts a fingerprints table stored with the former hexadecimal hash format into the
+        64 bits integer one, keeping the first 8 bytes of every stored hash.
+
+        :return: True if the table was migrated, False if it was already in the integer format.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_HASH_COLUMN_TYPE)
+            column_type = cur.fetchone()[0]
+            if column_type.lower() not in self.LEGACY_HASH_COLUMN_TYPES:
+                return False
+
+            for statement in self.MIGRATE_FINGERPRINTS:
+                cur.execute(statement)
+
+        return True
+
+
+def group_hashes(hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Groups the sampled offsets of each hash of a recording, the offsets of values[i] being
+    sampled_offsets[starts[i]: starts[i] + counts[i]].
+
+    :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset).
+    :return: a tuple with the sorted unique hashes, where the offsets of each one start, how many
+    there are, and the sampled offsets (as int64).
+    """
+    order = np.argsort(hashes[FIELD_HASH], kind="stable")
+    sampled_offsets = hashes[FIELD_OFFSET][order].astype(np.int64)
+    values, starts, counts = np.unique(hashes[FIELD_HASH][order], return_index=True, return_counts=True)
+    return values, starts, counts, sampled_offsets
+
+
+def pair_matches(indexes: np.ndarray, song_ids: np.ndarray, db_offsets: np.ndarray, starts: np.ndarray,
+                 counts: np.ndarray, sampled_offsets: np.ndarray) -> Tuple[np.ndarray, Dict[int, int]]:
+    """
+    Pairs the fingerprints found for the unique hashes of a recording with every offset each hash was
+    sampled at.
+
+    :param indexes: index in the unique hashes of each fingerprint found.
+    :param song_ids: song id of each fingerprint found.
+    :param db_offsets: offset of each fingerprint found.
+    :param starts: as given by group_hashes.
+    :param counts: as given by group_hashes.
+    :param sampled_offsets: as given by group_hashes.
+    :return: an (n, 2) int64 array of (sid, offset_difference) rows and a dictionary with the amount
+    of hashes matched (not considering duplicated hashes) in each song.
+    """
+    # in order to count each hash only once per db offset we count the rows matched.
+    matched_songs, matched_counts = np.unique(song_ids, return_counts=True)
+    dedup_hashes = dict(zip(matched_songs.tolist(), matched_counts.tolist()))
+
+    # we now evaluate all sampled offsets for each hash matched, every row being repeated once per offset.
+    repeats = counts[indexes]
+    row_index = np.repeat(np.arange(len(indexes)), repeats)
+    position = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    differences = db_offsets[row_index] - sampled_offsets[starts[indexes][row_index] + position]
+
+    return np.column_stack((song_ids[row_index], differences)), dedup_hashes
+
+
+def pair_recording_matches(values: np.ndarray, indexes: np.ndarray, song_ids: np.ndarray, db_offsets: np.ndarray,
+                           group: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]) \
+        -> Tuple[np.ndarray, Dict[int, int]]:
+    """
+    Same as pair_matches, for one of several recordings whose unique hashes were looked up together.
+
+    :param values: sorted unique hashes of all the recordings.
+    :param indexes: index in values of each fingerprint found.
+    :param song_ids: song id of each fingerprint found.
+    :param db_offsets: offset of each fingerprint found.
+    :param group: the group_hashes result of the recording.
+    :return: the pair_matches result of the recording.
+    """
+    recording_values, starts, counts, sampled_offsets = group
+
+    # index of every hash of values in the unique hashes of the recording, -1 for the ones it does not have.
+    positions = np.full(len(values), -1, dtype=np.int64)
+    positions[np.searchsorted(values, recording_values)] = np.arange(len(recording_values))
+    rows = positions[indexes]
+    found = rows >= 0
+
+    return pair_matches(rows[found], song_ids[found], db_offsets[found], starts, counts, sampled_offsets)
@@ -4,6 +4,8 @@
 SONG_ID = "song_id"
 SONG_NAME = 'song_name'
 RESULTS = 'results'
+# Why a recording of a batch could not be recognized.
+ERROR = 'error'
 
 HASHES_MATCHED = 'hashes_matched_in_input'
 
@@ -23,13 +25,37 @@ QUERY_TIME = 'query_time'
 ALIGN_TIME = 'align_time'
 OFFSET = 'offset'
 OFFSET_SECS = 'offset_seconds'
+# Seconds of a stream received when a song was found in it.
+STREAM_SECS = 'stream_seconds'
 
 # DATABASE CLASS INSTANCES:
 DATABASES = {
     'mysql': ("dejavu.database_handler.mysql_database", "MySQLDatabase"),
-    'postgres': ("dejavu.database_handler.postgres_database", "PostgreSQLDatabase")
+    'postgres': ("dejavu.database_handler.postgres_database", "PostgreSQLDatabase"),
+    'memory': ("dejavu.database_handler.memory_database", "MemoryDatabase"),
+    'sqlite': ("dejavu.database_handler.sqlite_database", "SQLiteDatabase"),
+    'sharded': ("dejavu.database_handler.sharded_database", "ShardedDatabase")
 }
 
+# ASYNC DATABASE CLASS INSTANCES:
+# Databases which can also be queried without blocking an event loop, used by the async methods of Dejavu.
+# Other databases are queried in a thread by those methods.
+ASYNC_DATABASES = {
+    'postgres': ("dejavu.database_handler.async_postgres_database", "AsyncPostgreSQLDatabase")
+}
+
+# DATABASE CONNECTION POOL
+# Every process keeps a pool of connections per database, these defaults can be overridden
+# with a "pool" entry in the database config, e.g. "pool": {"min_size": 1, "max_size": 10}.
+DATABASE_POOL_MIN_SIZE = 1
+DATABASE_POOL_MAX_SIZE = 10
+# Seconds to wait for a connection when all of them are in use.
+DATABASE_POOL_TIMEOUT = 30
+# Connections idle for longer than this many seconds are checked before being used again.
+DATABASE_POOL_HEALTH_CHECK_INTERVAL = 30
+# Seconds after which idle connections beyond DATABASE_POOL_MIN_SIZE are closed.
+DATABASE_POOL_MAX_IDLE_TIME = 600
+
 # TABLE SONGS
 SONGS_TABLENAME = "songs"
 
@@ -47,6 +73,18 @@ FINGERPRINTS_TABLENAME = "fingerprints"
 FIELD_HASH = 'hash'
 FIELD_OFFSET = 'offset'
 
+# TABLE SETTINGS
+# Key/value settings of the catalog, e.g. the fingerprint profile it was built with.
+SETTINGS_TABLENAME = "settings"
+
+# SETTINGS FIELDS
+FIELD_SETTING_NAME = 'name'
+FIELD_SETTING_VALUE = 'value'
+
+# SETTINGS NAMES
+SETTING_FINGERPRINT_PROFILE = 'fingerprint_profile'
+SETTING_SHARD_MAPPING = 'shard_mapping'
+
 # FINGERPRINTS CONFIG:
 # This is used as connectivity parameter for scipy.generate_binary_structure function. This parameter
 # changes the morphology mask when looking for maximum peaks on the spectrogram matrix.
@@ -63,6 +101,10 @@ DEFAULT_FS = 44100
 # Size of the FFT window, affects frequency granularity
 DEFAULT_WINDOW_SIZE = 4096
 
+# Number of threads scipy.fft may use to compute the spectrogram. None keeps it
+# single threaded, a negative value wraps around the number of CPUs (-1 means all).
+DEFAULT_FFT_WORKERS = None
+
 # Ratio by which each sequential window overlaps the last and the
 # next window. Higher overlap will allow a higher granularity of offset
 # matching, but potentially more fingerprints.
@@ -93,10 +135,61 @@ MAX_HASH_TIME_DELTA = 200
 # affect performance.
 PEAK_SORT = True
 
-# Number of bits to grab from the front of the SHA1 hash in the
-# fingerprint calculation. The more you grab, the more memory storage,
-# with potentially lesser collisions of matches.
-FINGERPRINT_REDUCTION = 20 # 20
+# Fingerprints keep the first 64 bits of the SHA1 hash in the fingerprint
+# calculation as a signed integer, stored as BIGINT in the database. Catalogs
+# built with the former format (first 20 hex chars of the hash stored as
+# BYTEA/BINARY(10)) can be converted in place with `python -m dejavu.migrate`.
+
+# FINGERPRINT PROFILES:
+# A profile sets how audio is prepared before being fingerprinted. Every catalog is built with a single
+# profile, which is recorded in the database the first time songs are fingerprinted into it, and
+# recognition has to use the same one. It is chosen through the "fingerprint_profile" key of the config.
+#   - sample_rate: rate the audio is fingerprinted at (and offsets are converted to seconds with).
+#   - window_size / overlap_ratio: FFT window size and overlap at that rate.
+#   - mono: whether channels are downmixed into a single one instead of fingerprinted one by one.
+#   - resample: whether audio at any other rate is resampled (polyphase filter) to sample_rate.
+# The "low" profile keeps the frequency resolution (Fs / window_size) and the duration of a frame of the
+# default one, so the peak and hash time delta settings above keep their meaning. It only sees up to
+# 5.5 kHz, which is enough for speech and jingles, with ~4x less FFT work per channel.
+FINGERPRINT_PROFILES = {
+    # every channel at the rate of the file, as catalogs were built before profiles existed.
+    "default": {
+        "sample_rate": DEFAULT_FS,
+        "window_size": DEFAULT_WINDOW_SIZE,
+        "overlap_ratio": DEFAULT_OVERLAP_RATIO,
+        "mono": False,
+        "resample": False
+    },
+    "low": {
+        "sample_rate": 11025,
+        "window_size": 1024,
+        "overlap_ratio": DEFAULT_OVERLAP_RATIO,
+        "mono": True,
+        "resample": True
+    }
+}
+
+DEFAULT_FINGERPRINT_PROFILE = "default"
+
+# FINGERPRINT CACHE:
+# Fingerprints of ingested files can be kept on disk, keyed by the file SHA1 and the fingerprint
+# parameters, by setting "fingerprint_cache": {"directory": ..., "max_size": ...} in the config.
+# Maximum size in bytes of the cache, the least recently used fingerprints are evicted past it.
+FINGERPRINT_CACHE_MAX_SIZE = 2 ** 30
 
 # Number of results being returned for file recognition
 TOPN = 1
+
+# STREAM RECOGNITION:
+# Live streams (e.g. a radio channel) are matched over a sliding window of their last seconds, and a song is
+# reported once enough of the hashes of the window agree on a single offset of it.
+# Seconds of audio the window covers, the matches kept for a stream are bounded by it.
+STREAM_WINDOW_SECONDS = 10
+# Seconds of audio fingerprinted and looked up at a time.
+STREAM_STEP_SECONDS = 1
+# Minimum ratio of the hashes of the window matched on the best offset of a song for it to be reported. Frames
+# of a stream rarely start where the ones of the song did, which can leave as few as ~1% of the hashes of an
+# airing aligned, while unrelated songs get a handful of matches at most.
+STREAM_CONFIDENCE = 0.005
+# Minimum number of hashes of the window matched on the best offset of a song for it to be reported.
+STREAM_MIN_MATCHES = 20
@@ -0,0 +1,209 @@
+import asyncio
+import io
+import re
+from typing import Dict, Optional, Tuple
+
+import asyncpg
+import numpy as np
+
+from dejavu.base_classes.async_database import AsyncCommonDatabase
+from dejavu.config.settings import (DATABASE_POOL_MAX_IDLE_TIME,
+                                    DATABASE_POOL_MAX_SIZE,
+                                    DATABASE_POOL_MIN_SIZE,
+                                    DATABASE_POOL_TIMEOUT, FIELD_HASH,
+                                    FIELD_OFFSET, FIELD_SONG_ID,
+                                    FINGERPRINTS_TABLENAME, TOPN)
+from dejavu.database_handler.postgres_database import (PostgreSQLDatabase,
+                                                       copy_binary)
+
+
+def numbered(query: str) -> str:
+    """
+    Turns the %s parameters of a psycopg2 query into the $1, $2... ones asyncpg takes.
+
+    :param query: the query.
+    :return: the query with numbered parameters.
+    """
+    count = iter(range(1, query.count("%s") + 1))
+    return re.sub("%s", lambda _: f"${next(count)}", query)
+
+
+class AsyncPostgreSQLDatabase(AsyncCommonDatabase):
+    type = "postgres"
+
+    # the queries of PostgreSQLDatabase, which creates the tables, with asyncpg parameters.
+    INSERT_SONG = numbered(PostgreSQLDatabase.INSERT_SONG)
+    UPDATE_SONG_FINGERPRINTED = numbered(PostgreSQLDatabase.UPDATE_SONG_FINGERPRINTED)
+    SELECT_SONG = numbered(PostgreSQLDatabase.SELECT_SONG)
+
+    CREATE_FINGERPRINTS_STAGING_TABLE = PostgreSQLDatabase.CREATE_FINGERPRINTS_STAGING_TABLE
+    MERGE_FINGERPRINTS_STAGING = PostgreSQLDatabase.MERGE_FINGERPRINTS_STAGING
+
+    DISABLE_JOIN_SCANS = PostgreSQLDatabase.DISABLE_JOIN_SCANS
+    SET_ALIGNMENT_WORK_MEM = PostgreSQLDatabase.SET_ALIGNMENT_WORK_MEM
+    SELECT_BEST_OFFSETS = numbered(PostgreSQLDatabase.SELECT_BEST_OFFSETS)
+
+    # the "array" match strategy, asyncpg prepares the statements it runs once per connection.
+    SELECT_MATCHES = f"""
+        SELECT q."index" - 1, f."{FIELD_SONG_ID}", f."{FIELD_OFFSET}"
+        FROM unnest($1::BIGINT[]) WITH ORDINALITY AS q("{FIELD_HASH}", "index")
+        JOIN "{FINGERPRINTS_TABLENAME}" f ON f."{FIELD_HASH}" = q."{FIELD_HASH}";
+    """
+
+    def __init__(self, **options):
+        super().__init__()
+        pool_options = options.pop("pool", {})
+        # matches are always looked up with the array query.
+        options.pop("match_strategy", None)
+        # psycopg2 takes the libpq name of the database option.
+        if "dbname" in options:
+            options["database"] = options.pop("dbname")
+
+        self._options = options
+        self._pool_options = {
+            "min_size": pool_options.get("min_size", DATABASE_POOL_MIN_SIZE),
+            "max_size": pool_options.get("max_size", DATABASE_POOL_MAX_SIZE),
+            "max_inactive_connection_lifetime": pool_options.get("max_idle_time", DATABASE_POOL_MAX_IDLE_TIME)
+        }
+        self.timeout = pool_options.get("timeout", DATABASE_POOL_TIMEOUT)
+
+        # the pool is bound to the event loop it was created on, so it is created on first use.
+        self._pool_task = None
+        self._loop = None
+
+    async def close(self) -> None:
+        """
+        Closes the connections of the database, called on shutdown.
+        """
+        task, self._pool_task, self._loop = self._pool_task, None, None
+        if task is None:
+            return
+        try:
+            pool = await task
+        except Exception:
+            # the pool was never created.
+            return
+        await pool.close()
+
+    async def insert_song(self, song_name: str, file_hash: str, total_hashes: int) -> int:
+        """
+        Inserts a song name into the database, returns the new
+        identifier of the song.
+
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param total_hashes: amount of hashes to be inserted on fingerprint table.
+        :return: the inserted id.
+        """
+        pool = await self._get_pool()
+        async with pool.acquire(timeout=self.timeout) as conn:
+            return await conn.fetchval(self.INSERT_SONG, song_name, file_hash, total_hashes)
+
+    async def insert_hashes(self, song_id: int, hashes: np.ndarray, batch_size: int = 1000) -> None:
+        """
+        Insert a multitude of fingerprints, streamed with a binary COPY instead of row by row inserts.
+
+        :param song_id: Song identifier the fingerprints belong to
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
+            - offset: Offset this hash was created from/at.
+        :param batch_size: unused, all fingerprints are copied at once.
+        """
+        if len(hashes) == 0:
+            return
+
+        rows = copy_binary(hashes[FIELD_HASH].astype(np.int64), np.full(len(hashes), song_id, dtype=np.int32),
+                           hashes[FIELD_OFFSET].astype(np.int32))
+
+        pool = await self._get_pool()
+        async with pool.acquire(timeout=self.timeout) as conn:
+            async with conn.transaction():
+                await conn.execute(self.CREATE_FINGERPRINTS_STAGING_TABLE)
+                await conn.copy_to_table(f"{FINGERPRINTS_TABLENAME}_staging", source=io.BytesIO(rows),
+                                         columns=[FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET], format="binary")
+                await conn.execute(self.MERGE_FINGERPRINTS_STAGING)
+
+    async def set_song_fingerprinted(self, song_id: int) -> None:
+        """
+        Sets a specific song as having all fingerprints in the database.
+
+        :param song_id: song identifier.
+        """
+        pool = await self._get_pool()
+        async with pool.acquire(timeout=self.timeout) as conn:
+            await conn.execute(self.UPDATE_SONG_FINGERPRINTED, song_id)
+
+    async def get_song_by_id(self, song_id: int) -> Optional[Dict[str, str]]:
+        """
+        Brings the song info from the database.
+
+        :param song_id: song identifier.
+        :return: a song by its identifier. Result must be a Dictionary.
+        """
+        pool = await self._get_pool()
+        async with pool.acquire(timeout=self.timeout) as conn:
+            song = await conn.fetchrow(self.SELECT_SONG, song_id)
+        return dict(song) if song is not None else None
+
+    async def return_best_offsets(self, hashes: np.ndarray, topn: int = TOPN, batch_size: int = 1000) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[int, int]]:
+        """
+        Searches the database for pairs of (hash, offset) values and aligns them in the database itself,
+        so only the best offset of the topn songs is sent back instead of every match.
+
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
+            - offset: Offset this hash was created from/at.
+        :param topn: number of songs to return.
+        :param batch_size: unused, all hashes are sent at once.
+        :return: a tuple of arrays with the song ids, best offset differences and number of matches on
+        that offset of the topn songs, sorted by decreasing number of matches, and a dictionary with the
+        amount of hashes matched (not considering duplicated hashes) in each of those songs.
+        """
+        # positions are 1-based, as the ordinality of the unique hashes.
+        values, positions = np.unique(hashes[FIELD_HASH], return_inverse=True)
+
+        pool = await self._get_pool()
+        async with pool.acquire(timeout=self.timeout) as conn:
+            async with conn.transaction():
+                await conn.execute(self.SET_ALIGNMENT_WORK_MEM)
+                rows = await conn.fetch(self.SELECT_BEST_OFFSETS, values.tolist(), (positions + 1).tolist(),
+                                        hashes[FIELD_OFFSET].tolist(), topn)
+
+        best = np.array(rows, dtype=np.int64).reshape(-1, 4)
+        return best[:, 0], best[:, 1], best[:, 2], dict(zip(best[:, 0].tolist(), best[:, 3].tolist()))
+
+    async def _fetch_matches(self, values: np.ndarray, batch_size: int = 1000) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Brings every fingerprint stored for the given hashes.
+
+        :param values: sorted array of unique hashes.
+        :param batch_size: unused, all hashes are sent at once.
+        :return: a tuple of int64 arrays with, for every fingerprint found, the index of its hash in values,
+        its song id and its offset.
+        """
+        pool = await self._get_pool()
+        async with pool.acquire(timeout=self.timeout) as conn:
+            async with conn.transaction():
+                await conn.execute(self.DISABLE_JOIN_SCANS)
+                rows = await conn.fetch(self.SELECT_MATCHES, values.tolist())
+
+        matches = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        return matches[:, 0], matches[:, 1], matches[:, 2]
+
+    async def _get_pool(self) -> asyncpg.Pool:
+        loop = asyncio.get_running_loop()
+        if self._pool_task is None or self._loop is not loop:
+            # concurrent first queries wait on the same pool creation.
+            self._pool_task = asyncio.ensure_future(asyncpg.create_pool(**self._options, **self._pool_options))
+            self._loop = loop
+
+        task = self._pool_task
+        try:
+            return await task
+        except Exception:
+            # the next query tries again, e.g. once the server is back.
+            if self._pool_task is task:
+                self._pool_task = None
+            raise
@@ -0,0 +1,243 @@
+import json
+import os
+import threading
+from collections import deque
+from time import monotonic
+from typing import Callable, Dict
+
+from dejavu.config.settings import (DATABASE_POOL_HEALTH_CHECK_INTERVAL,
+                                    DATABASE_POOL_MAX_IDLE_TIME,
+                                    DATABASE_POOL_MAX_SIZE,
+                                    DATABASE_POOL_MIN_SIZE,
+                                    DATABASE_POOL_TIMEOUT)
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of database connections, so queries reuse open connections instead of
+    connecting and authenticating every time.
+
+    Connections are created on demand up to max_size. Idle connections beyond min_size are closed
+    after max_idle_time. Connections that sat idle for a while are checked before being handed out,
+    and broken ones are replaced.
+
+    Connections can't be shared across processes. A forked child drops the connections it inherited
+    (without closing them, which would also close them for the parent) and opens its own ones.
+
+    # Use as
+    conn = pool.acquire()
+    try:
+        ...
+    finally:
+        pool.release(conn)
+    """
+    def __init__(self, connect: Callable[[], any], is_alive: Callable[[any], bool],
+                 min_size: int = DATABASE_POOL_MIN_SIZE, max_size: int = DATABASE_POOL_MAX_SIZE,
+                 timeout: float = DATABASE_POOL_TIMEOUT,
+                 health_check_interval: float = DATABASE_POOL_HEALTH_CHECK_INTERVAL,
+                 max_idle_time: float = DATABASE_POOL_MAX_IDLE_TIME):
+        """
+        :param connect: function opening a new connection.
+        :param is_alive: function telling whether a connection is still usable, it may query the server.
+        :param min_size: number of connections kept open even when idle.
+        :param max_size: maximum number of connections open at the same time.
+        :param timeout: seconds acquire waits for a connection when all of them are in use.
+        :param health_check_interval: connections idle for longer than this many seconds are checked
+        with is_alive before being handed out.
+        :param max_idle_time: seconds after which idle connections beyond min_size are closed.
+        """
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError("The pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1.")
+
+        self.connect = connect
+        self.is_alive = is_alive
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.max_idle_time = max_idle_time
+        self._reset_state()
+
+    def _reset_state(self) -> None:
+        # a new lock, the former one may have been held by another thread when the process forked.
+        self._condition = threading.Condition()
+        self._pid = os.getpid()
+        # (connection, time it was released) pairs, the most recently used last.
+        self._idle = deque()
+        # connections handed out, plus the ones being opened.
+        self._in_use = 0
+        self._created = 0
+        self._discarded = 0
+        self._waits = 0
+        self._wait_time = 0.0
+
+    def acquire(self, timeout: float = None):
+        """
+        Checks out a connection, opening a new one if none is idle and the pool is not full.
+
+        :param timeout: seconds to wait if every connection is in use, defaults to the pool timeout.
+        :return: an open connection, which must be given back with release.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        self._check_pid()
+        with self._condition:
+            if not self._idle and self._in_use >= self.max_size:
+                start = monotonic()
+                self._waits += 1
+                available = self._condition.wait_for(lambda: self._idle or self._in_use < self.max_size, timeout)
+                self._wait_time += monotonic() - start
+                if not available:
+                    raise TimeoutError(f"No database connection available after {timeout} seconds, "
+                                       f"all {self.max_size} of them are in use.")
+
+            self._in_use += 1
+            conn, released = self._idle.pop() if self._idle else (None, None)
+
+        # connecting and checking connections happen outside of the lock, as they wait on the network.
+        try:
+            if conn is not None and not self._check(conn, released):
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = self.connect()
+                with self._condition:
+                    self._created += 1
+        except BaseException:
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+        return conn
+
+    def release(self, conn, broken: bool = False) -> None:
+        """
+        Gives back a connection checked out with acquire.
+
+        :param conn: the connection.
+        :param broken: closes the connection instead of keeping it, e.g. after a connection error.
+        """
+        if self._check_pid():
+            # the connection was acquired before the fork, it belongs to the parent.
+            return
+
+        with self._condition:
+            now = monotonic()
+            self._in_use -= 1
+            closing = [conn] if broken else []
+            if not broken:
+                self._idle.append((conn, now))
+
+            # the least recently used connections are on the left.
+            while (self._idle and len(self._idle) + self._in_use > self.min_size
+                   and now - self._idle[0][1] > self.max_idle_time):
+                closing.append(self._idle.popleft()[0])
+            self._condition.notify()
+
+        for conn in closing:
+            self._close(conn)
+
+    def close(self) -> None:
+        """
+        Closes the idle connections, the ones in use go back to the pool when released.
+        Meant to be called before forking or on shutdown.
+        """
+        self._check_pid()
+        with self._condition:
+            idle, self._idle = self._idle, deque()
+
+        for conn, _ in idle:
+            self._close(conn)
+
+    def reset(self) -> None:
+        """
+        Forgets every connection without closing them. Called in a forked child, whose inherited
+        connections still belong to the parent.
+        """
+        _orphaned.extend(conn for conn, _ in self._idle)
+        self._reset_state()
+
+    def stats(self) -> Dict[str, any]:
+        """
+        :return: a dictionary with the connections in use and idle, and how often and how long
+        callers had to wait for a connection.
+        """
+        self._check_pid()
+        with self._condition:
+            return {
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "max_size": self.max_size,
+                "created": self._created,
+                "discarded": self._discarded,
+                "waits": self._waits,
+                "wait_time": self._wait_time
+            }
+
+    def _check(self, conn, released: float) -> bool:
+        if monotonic() - released < self.health_check_interval:
+            return True
+        try:
+            return self.is_alive(conn)
+        except Exception:
+            return False
+
+    def _check_pid(self) -> bool:
+        """
+        Resets the pool if the process forked since it was last used, fork hooks may not have run
+        (e.g. when the fork was not done by multiprocessing).
+
+        :return: True if the pool was reset.
+        """
+        if self._pid == os.getpid():
+            return False
+        self.reset()
+        return True
+
+    def _close(self, conn) -> None:
+        with self._condition:
+            self._discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+# Connections inherited from a parent process, kept referenced so the drivers never close them
+# (and the parent's sessions with them) when they get garbage collected.
+_orphaned = []
+
+# Pools of the current process, shared by every handler instance connecting with the same options.
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(database_type: str, options: Dict[str, any], connect: Callable[[], any],
+             is_alive: Callable[[any], bool], **pool_options) -> ConnectionPool:
+    """
+    Returns the pool of the process for the given database, creating it if needed.
+
+    :param database_type: type of the database, as in DATABASES.
+    :param options: connection options, pools are shared by handlers connecting with the same ones.
+    :param connect: function opening a new connection.
+    :param is_alive: function telling whether a connection is still usable.
+    :param pool_options: ConnectionPool sizes and timeouts, only used when the pool is created.
+    :return: the pool.
+    """
+    key = database_type, json.dumps(options, sort_keys=True, default=str)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(connect, is_alive, **pool_options)
+        return pool
+
+
+def _reset_pools() -> None:
+    global _pools_lock
+    _pools_lock = threading.Lock()
+    for pool in _pools.values():
+        pool.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pools)
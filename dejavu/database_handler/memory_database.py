@@ -0,0 +1,497 @@
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from dejavu.base_classes.common_database import CommonDatabase
+from dejavu.config.settings import (FIELD_FILE_SHA1, FIELD_FINGERPRINTED,
+                                    FIELD_HASH, FIELD_OFFSET, FIELD_SONG_ID,
+                                    FIELD_SONGNAME, FIELD_TOTAL_HASHES)
+from dejavu.logic.fingerprint import FINGERPRINT_DTYPE
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks (e.g. on Windows), a persisted catalog must then be written by a single process.
+    fcntl = None
+
+
+class Segment(NamedTuple):
+    """
+    Fingerprints sorted by hash, as parallel arrays.
+    """
+    name: str
+    hashes: np.ndarray
+    song_ids: np.ndarray
+    offsets: np.ndarray
+
+
+class MemoryDatabase(CommonDatabase):
+    """
+    Keeps the whole catalog in the memory of the process, so matches are looked up with np.searchsorted
+    instead of querying a database server. Meant for catalogs fitting in RAM.
+
+    Fingerprints are kept in segments, each of them sorted by hash. Every song inserted adds a segment,
+    and consecutive segments of similar sizes are merged, so there are only a few of them to search.
+
+    Given a "path" in the database config, the catalog is persisted to that directory on every change:
+    segments are stored as .npy files and loaded memory-mapped, so the processes using the same directory
+    (e.g. uvicorn workers) share a single copy of them in the page cache. Every process notices the changes
+    made by the others before its next read. Writes take a file lock, each one reloading the catalog first.
+    """
+    type = "memory"
+
+    CATALOG_FILE = "catalog.json"
+    LOCK_FILE = "catalog.lock"
+    SEGMENTS_DIRECTORY = "segments"
+
+    # times a read retries loading a catalog whose segments got replaced by another process meanwhile.
+    LOAD_ATTEMPTS = 5
+
+    def __init__(self, path: str = None):
+        """
+        :param path: directory the catalog is persisted to, the catalog only lives in memory if None.
+        """
+        super().__init__()
+        self.path = path
+        self._lock = threading.RLock()
+        self._clear_state()
+        # the catalog file that was loaded, to tell whether another process changed it.
+        self._loaded = None
+
+    def _clear_state(self) -> None:
+        # song id to its info, including whether it is fingerprinted.
+        self._songs = {}
+        self._settings = {}
+        self._next_id = 1
+        # lists and segments are never modified in place, readers keep using the ones they got.
+        self._segments = []
+
+    def after_fork(self) -> None:
+        # a new lock, the former one may have been held by another thread when the process forked.
+        self._lock = threading.RLock()
+
+    def setup(self) -> None:
+        """
+        Called on creation or shortly afterwards.
+        """
+        if self.path is not None:
+            os.makedirs(os.path.join(self.path, self.SEGMENTS_DIRECTORY), exist_ok=True)
+        self.delete_unfingerprinted_songs()
+
+    def empty(self) -> None:
+        """
+        Called when the database should be cleared of all data.
+        """
+        with self._writing():
+            self._clear_state()
+
+    def delete_unfingerprinted_songs(self) -> None:
+        """
+        Called to remove any song entries that do not have any fingerprints
+        associated with them.
+        """
+        with self._writing():
+            self._delete_songs([song_id for song_id, song in self._songs.items() if not song[FIELD_FINGERPRINTED]])
+
+    def get_num_songs(self) -> int:
+        """
+        Returns the song's count stored.
+
+        :return: the amount of songs in the database.
+        """
+        self._refresh()
+        return sum(1 for song in self._songs.values() if song[FIELD_FINGERPRINTED])
+
+    def get_num_fingerprints(self) -> int:
+        """
+        Returns the fingerprints' count stored.
+
+        :return: the number of fingerprints in the database.
+        """
+        self._refresh()
+        return sum(len(segment.hashes) for segment in self._segments)
+
+    def set_song_fingerprinted(self, song_id: int):
+        """
+        Sets a specific song as having all fingerprints in the database.
+
+        :param song_id: song identifier.
+        """
+        with self._writing():
+            if song_id in self._songs:
+                self._songs = {**self._songs, song_id: {**self._songs[song_id], FIELD_FINGERPRINTED: 1}}
+
+    def get_songs(self) -> List[Dict[str, str]]:
+        """
+        Returns all fully fingerprinted songs in the database
+
+        :return: a dictionary with the songs info.
+        """
+        self._refresh()
+        return [{
+            FIELD_SONG_ID: song_id,
+            FIELD_SONGNAME: song[FIELD_SONGNAME],
+            FIELD_FILE_SHA1: song[FIELD_FILE_SHA1],
+            FIELD_TOTAL_HASHES: song[FIELD_TOTAL_HASHES],
+            "date_created": song["date_created"]
+        } for song_id, song in self._songs.items() if song[FIELD_FINGERPRINTED]]
+
+    def get_song_by_id(self, song_id: int) -> Optional[Dict[str, str]]:
+        """
+        Brings the song info from the database.
+
+        :param song_id: song identifier.
+        :return: a song by its identifier, None if there is no such song.
+        """
+        self._refresh()
+        song = self._songs.get(song_id)
+        if song is None:
+            return None
+        return {
+            FIELD_SONGNAME: song[FIELD_SONGNAME],
+            FIELD_FILE_SHA1: song[FIELD_FILE_SHA1],
+            FIELD_TOTAL_HASHES: song[FIELD_TOTAL_HASHES]
+        }
+
+    def get_setting(self, name: str) -> Optional[str]:
+        """
+        Returns the value of a catalog setting.
+
+        :param name: setting name.
+        :return: the stored value, None if the setting was never set.
+        """
+        self._refresh()
+        return self._settings.get(name)
+
+    def set_setting(self, name: str, value: str) -> str:
+        """
+        Stores a catalog setting unless it was already set, settings are not meant to change
+        once the catalog has been built with them.
+
+        :param name: setting name.
+        :param value: value to store.
+        :return: the value of the setting after the call, which is the former one if it was already set.
+        """
+        with self._writing():
+            if name not in self._settings:
+                self._settings = {**self._settings, name: value}
+            return self._settings[name]
+
+    def insert(self, fingerprint: int, song_id: int, offset: int):
+        """
+        Inserts a single fingerprint into the database.
+
+        :param fingerprint: First 64 bits of a sha1 hash, as a signed integer
+        :param song_id: Song identifier this fingerprint is off
+        :param offset: The offset this fingerprint is from.
+        """
+        self.insert_hashes(song_id, np.array([(fingerprint, offset)], dtype=FINGERPRINT_DTYPE))
+
+    def insert_song(self, song_name: str, file_hash: str, total_hashes: int) -> int:
+        """
+        Inserts a song name into the database, returns the new
+        identifier of the song.
+
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param total_hashes: amount of hashes to be inserted on fingerprint table.
+        :return: the inserted id.
+        """
+        with self._writing():
+            song_id = self._next_id
+            self._next_id += 1
+            self._songs = {**self._songs, song_id: {
+                FIELD_SONGNAME: song_name,
+                FIELD_FILE_SHA1: file_hash.upper(),
+                FIELD_TOTAL_HASHES: total_hashes,
+                FIELD_FINGERPRINTED: 0,
+                "date_created": datetime.now()
+            }}
+
+        return song_id
+
+    def mirror_song(self, song_id: int, song_name: str, file_hash: str, total_hashes: int) -> None:
+        """
+        Inserts a song under an identifier given by another database, unless it is already stored.
+        Used by the shards of a sharded catalog, whose fingerprints belong to songs stored elsewhere.
+
+        :param song_id: song identifier.
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param total_hashes: amount of hashes of the song.
+        """
+        with self._writing():
+            if song_id in self._songs:
+                return
+            self._next_id = max(self._next_id, song_id + 1)
+            self._songs = {**self._songs, song_id: {
+                FIELD_SONGNAME: song_name,
+                FIELD_FILE_SHA1: file_hash.upper(),
+                FIELD_TOTAL_HASHES: total_hashes,
+                FIELD_FINGERPRINTED: 0,
+                "date_created": datetime.now()
+            }}
+
+    def query(self, fingerprint: int = None) -> List[Tuple]:
+        """
+        Returns all matching fingerprint entries associated with
+        the given hash as parameter, if None is passed it returns all entries.
+
+        :param fingerprint: first 64 bits of a sha1 hash, as a signed integer
+        :return: a list of fingerprint records stored in the db.
+        """
+        if fingerprint is None:
+            self._refresh()
+            song_ids = [segment.song_ids for segment in self._segments]
+            offsets = [segment.offsets for segment in self._segments]
+            return list(zip(np.concatenate(song_ids or [[]]).astype(np.int64).tolist(),
+                            np.concatenate(offsets or [[]]).astype(np.int64).tolist()))
+
+        _, song_ids, offsets = self._fetch_matches(np.array([fingerprint], dtype=np.int64))
+        return list(zip(song_ids.tolist(), offsets.tolist()))
+
+    def insert_hashes(self, song_id: int, hashes: np.ndarray, batch_size: int = 1000) -> None:
+        """
+        Insert a multitude of fingerprints, as a new segment. Duplicated fingerprints are ignored.
+
+        :param song_id: Song identifier the fingerprints belong to
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
+            - offset: Offset this hash was created from/at.
+        :param batch_size: unused, all fingerprints are inserted at once.
+        """
+        if len(hashes) == 0:
+            return
+
+        # unique sorts the records by hash, and then by offset.
+        fingerprints = np.unique(np.asarray(hashes, dtype=FINGERPRINT_DTYPE))
+        segment = Segment(uuid.uuid4().hex, fingerprints[FIELD_HASH].copy(),
+                          np.full(len(fingerprints), song_id, dtype=np.int32),
+                          fingerprints[FIELD_OFFSET].copy())
+
+        with self._writing():
+            segments = self._segments + [segment]
+            # merged as a binary counter is incremented, so there are only a logarithmic number of segments
+            # and every fingerprint is merged a logarithmic number of times.
+            while len(segments) > 1 and len(segments[-1].hashes) >= len(segments[-2].hashes):
+                segments = segments[:-2] + [merge_segments(segments[-2], segments[-1])]
+            self._segments = segments
+
+    def delete_songs_by_id(self, song_ids: List[int], batch_size: int = 1000) -> None:
+        """
+        Given a list of song ids it deletes all songs specified and their corresponding fingerprints.
+
+        :param song_ids: song ids to be deleted from the database.
+        :param batch_size: unused, all songs are deleted at once.
+        """
+        with self._writing():
+            self._delete_songs(song_ids)
+
+    def migrate_fingerprints(self) -> bool:
+        """
+        Fingerprints in memory always have the 64 bits integer format.
+
+        :return: False, there is nothing to migrate.
+        """
+        return False
+
+    def _delete_songs(self, song_ids: List[int]) -> None:
+        song_ids = np.array([song_id for song_id in song_ids if song_id in self._songs], dtype=np.int32)
+        if len(song_ids) == 0:
+            return
+
+        deleted_ids = set(song_ids.tolist())
+        self._songs = {song_id: song for song_id, song in self._songs.items() if song_id not in deleted_ids}
+
+        segments = []
+        for segment in self._segments:
+            deleted = np.isin(segment.song_ids, song_ids)
+            if not deleted.any():
+                segments.append(segment)
+            elif not deleted.all():
+                kept = ~deleted
+                segments.append(Segment(uuid.uuid4().hex, segment.hashes[kept], segment.song_ids[kept],
+                                        segment.offsets[kept]))
+        self._segments = segments
+
+    def _fetch_matches(self, values: np.ndarray, batch_size: int = 1000) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Brings every fingerprint stored for the given hashes, searching them in every segment.
+
+        :param values: sorted array of unique hashes.
+        :param batch_size: unused, all hashes are searched at once.
+        :return: a tuple of int64 arrays with, for every fingerprint found, the index of its hash in values,
+        its song id and its offset.
+        """
+        self._refresh()
+        indexes, song_ids, offsets = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], \
+            [np.empty(0, dtype=np.int64)]
+        for segment in self._segments:
+            # the fingerprints of values[i] are the rows starts[i]: starts[i] + counts[i] of the segment.
+            starts = np.searchsorted(segment.hashes, values, side="left")
+            counts = np.searchsorted(segment.hashes, values, side="right") - starts
+            total = counts.sum()
+            if total == 0:
+                continue
+
+            rows = np.arange(total) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+            indexes.append(np.repeat(np.arange(len(values)), counts))
+            song_ids.append(segment.song_ids[rows].astype(np.int64))
+            offsets.append(segment.offsets[rows].astype(np.int64))
+
+        return np.concatenate(indexes), np.concatenate(song_ids), np.concatenate(offsets)
+
+    @contextmanager
+    def _writing(self):
+        """
+        Context in which the catalog is changed. When the catalog is persisted it holds the file lock,
+        reloads the catalog before the block if another process changed it and saves it afterwards.
+        On errors, the changes done by the block are dropped.
+        """
+        with self._lock:
+            if self.path is None:
+                yield
+                return
+
+            with open(os.path.join(self.path, self.LOCK_FILE), "a") as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    self._refresh()
+                    try:
+                        yield
+                        self._save()
+                    except BaseException:
+                        self._clear_state()
+                        self._loaded = None
+                        self._refresh()
+                        raise
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _refresh(self) -> None:
+        """
+        Loads the persisted catalog if it changed since it was last loaded.
+        """
+        if self.path is None:
+            return
+
+        with self._lock:
+            for _ in range(self.LOAD_ATTEMPTS):
+                try:
+                    stat = os.stat(self._catalog_path())
+                except FileNotFoundError:
+                    if self._loaded is not None:
+                        self._clear_state()
+                        self._loaded = None
+                    return
+
+                # the catalog is always replaced by a new file, never written in place.
+                loaded = stat.st_ino, stat.st_mtime_ns, stat.st_size
+                if loaded == self._loaded:
+                    return
+
+                try:
+                    self._load()
+                except FileNotFoundError:
+                    # a segment was deleted by a process that replaced the catalog meanwhile.
+                    continue
+                self._loaded = loaded
+                return
+
+            raise RuntimeError(f"The catalog at {self.path} changed while being loaded {self.LOAD_ATTEMPTS} times.")
+
+    def _load(self) -> None:
+        with open(self._catalog_path()) as f:
+            catalog = json.load(f)
+
+        segments = [self._load_segment(name) for name in catalog["segments"]]
+
+        self._songs = {int(song_id): {**song, "date_created": datetime.fromisoformat(song["date_created"])}
+                       for song_id, song in catalog["songs"].items()}
+        self._settings = catalog["settings"]
+        self._next_id = catalog["next_id"]
+        self._segments = segments
+
+    def _load_segment(self, name: str) -> Segment:
+        # memory-mapped, the pages are shared by every process and only read from disk when searched.
+        return Segment(name, *(np.load(self._segment_path(name, column), mmap_mode="r")
+                               for column in Segment._fields[1:]))
+
+    def _save(self) -> None:
+        # segments are only written once, under a new name whenever their contents change.
+        segments = []
+        for segment in self._segments:
+            if not os.path.exists(self._segment_path(segment.name, Segment._fields[-1])):
+                for column in Segment._fields[1:]:
+                    np.save(self._segment_path(segment.name, column), getattr(segment, column), allow_pickle=False)
+                segment = self._load_segment(segment.name)
+            segments.append(segment)
+        self._segments = segments
+
+        catalog = {
+            "next_id": self._next_id,
+            "songs": {song_id: {**song, "date_created": song["date_created"].isoformat()}
+                      for song_id, song in self._songs.items()},
+            "settings": self._settings,
+            "segments": [segment.name for segment in segments]
+        }
+
+        # write aside and rename, so other processes never load a partial catalog.
+        temp_path = f"{self._catalog_path()}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(catalog, f)
+        os.replace(temp_path, self._catalog_path())
+        stat = os.stat(self._catalog_path())
+        self._loaded = stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+        # segments no longer in the catalog, the processes that mapped them keep them until they reload.
+        names = set(catalog["segments"])
+        for entry in os.scandir(os.path.join(self.path, self.SEGMENTS_DIRECTORY)):
+            if entry.name.split(".")[0] not in names:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def _catalog_path(self) -> str:
+        return os.path.join(self.path, self.CATALOG_FILE)
+
+    def _segment_path(self, name: str, column: str) -> str:
+        return os.path.join(self.path, self.SEGMENTS_DIRECTORY, f"{name}.{column}.npy")
+
+    def __getstate__(self):
+        if self.path is not None:
+            return self.path, None
+        return self.path, (self._songs, self._settings, self._next_id, self._segments)
+
+    def __setstate__(self, state):
+        self.path, catalog = state
+        self._lock = threading.RLock()
+        self._loaded = None
+        self._clear_state()
+        if catalog is not None:
+            self._songs, self._settings, self._next_id, self._segments = catalog
+
+
+def merge_segments(first: Segment, second: Segment) -> Segment:
+    """
+    Merges two segments into a new one, sorted by hash.
+
+    :param first: a segment.
+    :param second: another segment.
+    :return: the merged segment.
+    """
+    hashes = np.concatenate((first.hashes, second.hashes))
+    # a stable sort of two sorted runs is a linear merge.
+    order = np.argsort(hashes, kind="stable")
+    return Segment(uuid.uuid4().hex, hashes[order], np.concatenate((first.song_ids, second.song_ids))[order],
+                   np.concatenate((first.offsets, second.offsets))[order])
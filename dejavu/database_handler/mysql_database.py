@@ -1,13 +1,16 @@
-import queue
+from typing import Dict
 
 import mysql.connector
-from mysql.connector.errors import DatabaseError
+from mysql.connector.errors import Error
 
 from dejavu.base_classes.common_database import CommonDatabase
 from dejavu.config.settings import (FIELD_FILE_SHA1, FIELD_FINGERPRINTED,
-                                    FIELD_HASH, FIELD_OFFSET, FIELD_SONG_ID,
-                                    FIELD_SONGNAME, FIELD_TOTAL_HASHES,
-                                    FINGERPRINTS_TABLENAME, SONGS_TABLENAME)
+                                    FIELD_HASH, FIELD_OFFSET,
+                                    FIELD_SETTING_NAME, FIELD_SETTING_VALUE,
+                                    FIELD_SONG_ID, FIELD_SONGNAME,
+                                    FIELD_TOTAL_HASHES, FINGERPRINTS_TABLENAME,
+                                    SETTINGS_TABLENAME, SONGS_TABLENAME)
+from dejavu.database_handler.connection_pool import ConnectionPool, get_pool
 
 
 class MySQLDatabase(CommonDatabase):
@@ -30,7 +33,7 @@ class MySQLDatabase(CommonDatabase):
 
     CREATE_FINGERPRINTS_TABLE = f"""
         CREATE TABLE IF NOT EXISTS `{FINGERPRINTS_TABLENAME}` (
-            `{FIELD_HASH}` BINARY(10) NOT NULL
+            `{FIELD_HASH}` BIGINT NOT NULL
         ,   `{FIELD_SONG_ID}` MEDIUMINT UNSIGNED NOT NULL
         ,   `{FIELD_OFFSET}` INT UNSIGNED NOT NULL
         ,   `date_created` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
@@ -43,13 +46,22 @@ class MySQLDatabase(CommonDatabase):
     ) ENGINE=INNODB;
     """
 
+    CREATE_SETTINGS_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS `{SETTINGS_TABLENAME}` (
+            `{FIELD_SETTING_NAME}` VARCHAR(64) NOT NULL
+        ,   `{FIELD_SETTING_VALUE}` VARCHAR(250) NOT NULL
+        ,   `date_created` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ,   CONSTRAINT `pk_{SETTINGS_TABLENAME}_{FIELD_SETTING_NAME}` PRIMARY KEY (`{FIELD_SETTING_NAME}`)
+        ) ENGINE=INNODB;
+    """
+
     # INSERTS (IGNORES DUPLICATES)
     INSERT_FINGERPRINT = f"""
         INSERT IGNORE INTO `{FINGERPRINTS_TABLENAME}` (
                 `{FIELD_SONG_ID}`
             ,   `{FIELD_HASH}`
             ,   `{FIELD_OFFSET}`)
-        VALUES (%s, UNHEX(%s), %s);
+        VALUES (%s, %s, %s);
     """
 
     INSERT_SONG = f"""
@@ -57,15 +69,27 @@ class MySQLDatabase(CommonDatabase):
         VALUES (%s, UNHEX(%s), %s);
     """
 
+    MIRROR_SONG = f"""
+        INSERT IGNORE INTO `{SONGS_TABLENAME}` (`{FIELD_SONG_ID}`, `{FIELD_SONGNAME}`, `{FIELD_FILE_SHA1}`,
+            `{FIELD_TOTAL_HASHES}`)
+        VALUES (%s, %s, UNHEX(%s), %s);
+    """
+
+    # a setting keeps the first value it was given, so concurrent writers agree on it.
+    INSERT_SETTING = f"""
+        INSERT IGNORE INTO `{SETTINGS_TABLENAME}` (`{FIELD_SETTING_NAME}`, `{FIELD_SETTING_VALUE}`)
+        VALUES (%s, %s);
+    """
+
     # SELECTS
     SELECT = f"""
         SELECT `{FIELD_SONG_ID}`, `{FIELD_OFFSET}`
         FROM `{FINGERPRINTS_TABLENAME}`
-        WHERE `{FIELD_HASH}` = UNHEX(%s);
+        WHERE `{FIELD_HASH}` = %s;
     """
 
     SELECT_MULTIPLE = f"""
-        SELECT HEX(`{FIELD_HASH}`), `{FIELD_SONG_ID}`, `{FIELD_OFFSET}`
+        SELECT `{FIELD_HASH}`, `{FIELD_SONG_ID}`, `{FIELD_OFFSET}`
         FROM `{FINGERPRINTS_TABLENAME}`
         WHERE `{FIELD_HASH}` IN (%s);
     """
@@ -97,9 +121,16 @@ class MySQLDatabase(CommonDatabase):
         WHERE `{FIELD_FINGERPRINTED}` = 1;
     """
 
+    SELECT_SETTING = f"""
+        SELECT `{FIELD_SETTING_VALUE}`
+        FROM `{SETTINGS_TABLENAME}`
+        WHERE `{FIELD_SETTING_NAME}` = %s;
+    """
+
     # DROPS
     DROP_FINGERPRINTS = f"DROP TABLE IF EXISTS `{FINGERPRINTS_TABLENAME}`;"
     DROP_SONGS = f"DROP TABLE IF EXISTS `{SONGS_TABLENAME}`;"
+    DROP_SETTINGS = f"DROP TABLE IF EXISTS `{SETTINGS_TABLENAME}`;"
 
     # UPDATE
     UPDATE_SONG_FINGERPRINTED = f"""
@@ -116,17 +147,53 @@ class MySQLDatabase(CommonDatabase):
     """
 
     # IN
-    IN_MATCH = f"UNHEX(%s)"
+    IN_MATCH = "%s"
+
+    # MIGRATIONS
+    SELECT_HASH_COLUMN_TYPE = f"""
+        SELECT DATA_TYPE
+        FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE()
+        AND TABLE_NAME = '{FINGERPRINTS_TABLENAME}' AND COLUMN_NAME = '{FIELD_HASH}';
+    """
+
+    LEGACY_HASH_COLUMN_TYPES = ("binary",)
+
+    # the first 8 bytes are read as an unsigned number and then wrapped into the signed BIGINT range.
+    MIGRATE_FINGERPRINTS = [
+        f"ALTER TABLE `{FINGERPRINTS_TABLENAME}` ADD COLUMN `{FIELD_HASH}_bigint` BIGINT NULL;",
+        f"""
+        UPDATE `{FINGERPRINTS_TABLENAME}`
+        SET `{FIELD_HASH}_bigint` = CAST(CAST(CONV(HEX(LEFT(`{FIELD_HASH}`, 8)), 16, 10) AS UNSIGNED) AS SIGNED);
+        """,
+        f"""
+        ALTER TABLE `{FINGERPRINTS_TABLENAME}`
+            DROP INDEX `ix_{FINGERPRINTS_TABLENAME}_{FIELD_HASH}`
+        ,   DROP INDEX `uq_{FINGERPRINTS_TABLENAME}_{FIELD_SONG_ID}_{FIELD_OFFSET}_{FIELD_HASH}`
+        ,   DROP COLUMN `{FIELD_HASH}`
+        ,   CHANGE COLUMN `{FIELD_HASH}_bigint` `{FIELD_HASH}` BIGINT NOT NULL FIRST
+        ,   ADD INDEX `ix_{FINGERPRINTS_TABLENAME}_{FIELD_HASH}` (`{FIELD_HASH}`)
+        ,   ADD CONSTRAINT `uq_{FINGERPRINTS_TABLENAME}_{FIELD_SONG_ID}_{FIELD_OFFSET}_{FIELD_HASH}`
+                UNIQUE KEY (`{FIELD_SONG_ID}`, `{FIELD_OFFSET}`, `{FIELD_HASH}`);
+        """
+    ]
 
     def __init__(self, **options):
         super().__init__()
-        self.cursor = cursor_factory(**options)
+        # connection pool sizes and timeouts, see ConnectionPool.
+        self._pool_options = options.pop("pool", {})
         self._options = options
+        self.pool = connection_pool(self._options, self._pool_options)
+        self.cursor = cursor_factory(self.pool)
+
+    def before_fork(self) -> None:
+        # the new process opens its own connections, the idle ones are of no use to it.
+        self.pool.close()
 
     def after_fork(self) -> None:
-        # Clear the cursor cache, we don't want any stale connections from
-        # the previous process.
-        Cursor.clear_cache()
+        # Drop the connections of the previous process, we don't want any stale
+        # connections (and closing them would close them for the parent too).
+        self.pool.reset()
 
     def insert_song(self, song_name: str, file_hash: str, total_hashes: int) -> int:
         """
@@ -143,61 +210,66 @@ class MySQLDatabase(CommonDatabase):
             return cur.lastrowid
 
     def __getstate__(self):
-        return self._options,
+        return self._options, self._pool_options
 
     def __setstate__(self, state):
-        self._options, = state
-        self.cursor = cursor_factory(**self._options)
+        self._options, self._pool_options = state
+        self.pool = connection_pool(self._options, self._pool_options)
+        self.cursor = cursor_factory(self.pool)
+
+
+def connection_pool(options: Dict[str, any], pool_options: Dict[str, any]) -> ConnectionPool:
+    return get_pool(MySQLDatabase.type, options, lambda: mysql.connector.connect(**options), is_alive,
+                    **pool_options)
+
 
+def is_alive(conn) -> bool:
+    return conn.is_connected()
 
-def cursor_factory(**factory_options):
+
+def cursor_factory(pool: ConnectionPool):
     def cursor(**options):
-        options.update(factory_options)
-        return Cursor(**options)
+        return Cursor(pool, **options)
     return cursor
 
 
 class Cursor(object):
     """
-    Establishes a connection to the database and returns an open cursor.
+    Checks out a connection from the pool and returns an open cursor. On exit the transaction is
+    committed, or rolled back if the block raised, and the connection goes back to the pool.
     # Use as context manager
-    with Cursor() as cur:
+    with Cursor(pool) as cur:
         cur.execute(query)
         ...
     """
-    def __init__(self, dictionary=False, **options):
+    def __init__(self, pool: ConnectionPool, dictionary=False, buffered=False):
         super().__init__()
-
-        self._cache = queue.Queue(maxsize=5)
-
-        try:
-            conn = self._cache.get_nowait()
-            # Ping the connection before using it from the cache.
-            conn.ping(True)
-        except queue.Empty:
-            conn = mysql.connector.connect(**options)
-
-        self.conn = conn
+        self.pool = pool
         self.dictionary = dictionary
-
-    @classmethod
-    def clear_cache(cls):
-        cls._cache = queue.Queue(maxsize=5)
+        self.buffered = buffered
 
     def __enter__(self):
-        self.cursor = self.conn.cursor(dictionary=self.dictionary)
+        self.conn = self.pool.acquire()
+        try:
+            self.cursor = self.conn.cursor(dictionary=self.dictionary, buffered=self.buffered)
+        except Error:
+            self.pool.release(self.conn, broken=True)
+            raise
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
-        # if we had a MySQL related error we try to rollback the cursor.
-        if extype is DatabaseError:
-            self.cursor.rollback()
-
-        self.cursor.close()
-        self.conn.commit()
-
-        # Put it back on the queue
+        broken = False
         try:
-            self._cache.put_nowait(self.conn)
-        except queue.Full:
-            self.conn.close()
+            self.cursor.close()
+            # if we had an error we rollback whatever the block did.
+            if extype is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        except Error:
+            broken = True
+            # the error raised within the block, if any, is the one worth raising.
+            if extype is None:
+                raise
+        finally:
+            self.pool.release(self.conn, broken=broken)
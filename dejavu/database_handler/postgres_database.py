@@ -1,13 +1,20 @@
-import queue
+import io
+import struct
+import weakref
+from typing import Dict, Tuple
 
+import numpy as np
 import psycopg2
 from psycopg2.extras import DictCursor
 
 from dejavu.base_classes.common_database import CommonDatabase
 from dejavu.config.settings import (FIELD_FILE_SHA1, FIELD_FINGERPRINTED,
-                                    FIELD_HASH, FIELD_OFFSET, FIELD_SONG_ID,
-                                    FIELD_SONGNAME, FIELD_TOTAL_HASHES,
-                                    FINGERPRINTS_TABLENAME, SONGS_TABLENAME)
+                                    FIELD_HASH, FIELD_OFFSET,
+                                    FIELD_SETTING_NAME, FIELD_SETTING_VALUE,
+                                    FIELD_SONG_ID, FIELD_SONGNAME,
+                                    FIELD_TOTAL_HASHES, FINGERPRINTS_TABLENAME,
+                                    SETTINGS_TABLENAME, SONGS_TABLENAME, TOPN)
+from dejavu.database_handler.connection_pool import ConnectionPool, get_pool
 
 
 class PostgreSQLDatabase(CommonDatabase):
@@ -30,7 +37,7 @@ class PostgreSQLDatabase(CommonDatabase):
 
     CREATE_FINGERPRINTS_TABLE = f"""
         CREATE TABLE IF NOT EXISTS "{FINGERPRINTS_TABLENAME}" (
-            "{FIELD_HASH}" BYTEA NOT NULL
+            "{FIELD_HASH}" BIGINT NOT NULL
         ,   "{FIELD_SONG_ID}" INT NOT NULL
         ,   "{FIELD_OFFSET}" INT NOT NULL
         ,   "date_created" TIMESTAMP NOT NULL DEFAULT now()
@@ -49,13 +56,49 @@ class PostgreSQLDatabase(CommonDatabase):
         USING hash ("{FIELD_HASH}");
     """
 
+    CREATE_SETTINGS_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS "{SETTINGS_TABLENAME}" (
+            "{FIELD_SETTING_NAME}" VARCHAR(64) NOT NULL
+        ,   "{FIELD_SETTING_VALUE}" VARCHAR(250) NOT NULL
+        ,   "date_created" TIMESTAMP NOT NULL DEFAULT now()
+        ,   CONSTRAINT "pk_{SETTINGS_TABLENAME}_{FIELD_SETTING_NAME}" PRIMARY KEY ("{FIELD_SETTING_NAME}")
+        );
+    """
+
     # INSERTS (IGNORES DUPLICATES)
     INSERT_FINGERPRINT = f"""
         INSERT INTO "{FINGERPRINTS_TABLENAME}" (
                 "{FIELD_SONG_ID}"
             ,   "{FIELD_HASH}"
             ,   "{FIELD_OFFSET}")
-        VALUES (%s, decode(%s, 'hex'), %s) ON CONFLICT DO NOTHING;
+        VALUES (%s, %s, %s) ON CONFLICT DO NOTHING;
+    """
+
+    # BULK INSERTS
+    # fingerprints are copied into a temporary table and then merged into the fingerprints one, so
+    # duplicates are still ignored. Temporary tables are not written to the WAL and are private to each
+    # connection, so concurrent ingests don't see each other's rows.
+    CREATE_FINGERPRINTS_STAGING_TABLE = f"""
+        CREATE TEMPORARY TABLE IF NOT EXISTS "{FINGERPRINTS_TABLENAME}_staging" (
+            "{FIELD_HASH}" BIGINT NOT NULL
+        ,   "{FIELD_SONG_ID}" INT NOT NULL
+        ,   "{FIELD_OFFSET}" INT NOT NULL
+        ) ON COMMIT DELETE ROWS;
+    """
+
+    COPY_FINGERPRINTS_STAGING = f"""
+        COPY "{FINGERPRINTS_TABLENAME}_staging" ("{FIELD_HASH}", "{FIELD_SONG_ID}", "{FIELD_OFFSET}")
+        FROM STDIN WITH (FORMAT binary);
+    """
+
+    MERGE_FINGERPRINTS_STAGING = f"""
+        INSERT INTO "{FINGERPRINTS_TABLENAME}" (
+                "{FIELD_SONG_ID}"
+            ,   "{FIELD_HASH}"
+            ,   "{FIELD_OFFSET}")
+        SELECT "{FIELD_SONG_ID}", "{FIELD_HASH}", "{FIELD_OFFSET}"
+        FROM "{FINGERPRINTS_TABLENAME}_staging"
+        ON CONFLICT DO NOTHING;
     """
 
     INSERT_SONG = f"""
@@ -64,19 +107,116 @@ class PostgreSQLDatabase(CommonDatabase):
         RETURNING "{FIELD_SONG_ID}";
     """
 
+    # songs stored under the id given by another database never advance the sequence, as that database
+    # is the one giving ids.
+    MIRROR_SONG = f"""
+        INSERT INTO "{SONGS_TABLENAME}" (
+            "{FIELD_SONG_ID}", "{FIELD_SONGNAME}", "{FIELD_FILE_SHA1}", "{FIELD_TOTAL_HASHES}")
+        VALUES (%s, %s, decode(%s, 'hex'), %s) ON CONFLICT DO NOTHING;
+    """
+
+    # a setting keeps the first value it was given, so concurrent writers agree on it.
+    INSERT_SETTING = f"""
+        INSERT INTO "{SETTINGS_TABLENAME}" ("{FIELD_SETTING_NAME}", "{FIELD_SETTING_VALUE}")
+        VALUES (%s, %s) ON CONFLICT DO NOTHING;
+    """
+
     # SELECTS
     SELECT = f"""
         SELECT "{FIELD_SONG_ID}", "{FIELD_OFFSET}"
         FROM "{FINGERPRINTS_TABLENAME}"
-        WHERE "{FIELD_HASH}" = decode(%s, 'hex');
+        WHERE "{FIELD_HASH}" = %s;
     """
 
     SELECT_MULTIPLE = f"""
-        SELECT upper(encode("{FIELD_HASH}", 'hex')), "{FIELD_SONG_ID}", "{FIELD_OFFSET}"
+        SELECT "{FIELD_HASH}", "{FIELD_SONG_ID}", "{FIELD_OFFSET}"
         FROM "{FINGERPRINTS_TABLENAME}"
         WHERE "{FIELD_HASH}" IN (%s);
     """
 
+    # MATCH QUERIES
+    # the strategies to look up the matches of a recording, set with a "match_strategy" entry in the database config:
+    #   - "array": all hashes are sent as a single array, joined with the fingerprints by a prepared statement.
+    #   - "temp_table": hashes are copied into a temporary table joined with the fingerprints, and the matches
+    #   are streamed through a server side cursor. Meant for queries matching huge amounts of rows.
+    #   - "in": batches of IN lists, each of them parsed and planned on its own.
+    # The first two return the position of the matched hash in the query instead of the hash.
+    MATCH_STRATEGIES = ("array", "temp_table", "in")
+    DEFAULT_MATCH_STRATEGY = "array"
+
+    PREPARE_SELECT_MATCHES = f"""
+        PREPARE "select_matches" (BIGINT[]) AS
+        SELECT q."index" - 1, f."{FIELD_SONG_ID}", f."{FIELD_OFFSET}"
+        FROM unnest($1) WITH ORDINALITY AS q("{FIELD_HASH}", "index")
+        JOIN "{FINGERPRINTS_TABLENAME}" f ON f."{FIELD_HASH}" = q."{FIELD_HASH}";
+    """
+
+    EXECUTE_SELECT_MATCHES = 'EXECUTE "select_matches" (%s::BIGINT[]);'
+
+    CREATE_MATCHES_STAGING_TABLE = f"""
+        CREATE TEMPORARY TABLE IF NOT EXISTS "matches_staging" (
+            "index" INT NOT NULL
+        ,   "{FIELD_HASH}" BIGINT NOT NULL
+        ) ON COMMIT DELETE ROWS;
+    """
+
+    COPY_MATCHES_STAGING = f"""
+        COPY "matches_staging" ("index", "{FIELD_HASH}") FROM STDIN WITH (FORMAT binary);
+    """
+
+    # matches are looked up through the hash index, as scanning the whole fingerprints table is never cheaper
+    # for a recording, but the planner may estimate otherwise once the query has thousands of hashes (e.g. it
+    # merge joins them with a sorted scan of a freshly analyzed table). Set for both the array and temp_table
+    # strategies.
+    DISABLE_JOIN_SCANS = "SET LOCAL enable_hashjoin = off; SET LOCAL enable_mergejoin = off;"
+
+    SELECT_MATCHES_STAGING = f"""
+        SELECT q."index", f."{FIELD_SONG_ID}", f."{FIELD_OFFSET}"
+        FROM "matches_staging" q
+        JOIN "{FINGERPRINTS_TABLENAME}" f ON f."{FIELD_HASH}" = q."{FIELD_HASH}";
+    """
+
+    # ALIGNMENT
+    # the offset histograms of every song are aggregated and sorted in memory rather than spilled to disk,
+    # with the default 4MB a million matches already spill.
+    SET_ALIGNMENT_WORK_MEM = "SET LOCAL work_mem = '64MB';"
+
+    # aligns the matches of a recording in the database, only the best offset difference of the topn songs
+    # comes back. The unique hashes of the recording are joined with the fingerprints once, every matched
+    # row is then paired with each offset its hash was sampled at (given as the position of the hash in the
+    # unique ones), and the offset differences are counted. Ties are broken as in best_offsets.
+    SELECT_BEST_OFFSETS = f"""
+        WITH "matches" AS (
+            SELECT q."index", f."{FIELD_SONG_ID}", f."{FIELD_OFFSET}"
+            FROM unnest(%s::BIGINT[]) WITH ORDINALITY AS q("{FIELD_HASH}", "index")
+            JOIN "{FINGERPRINTS_TABLENAME}" f ON f."{FIELD_HASH}" = q."{FIELD_HASH}"
+        )
+        ,   "matched" AS (
+            SELECT "{FIELD_SONG_ID}", count(*) AS "matched"
+            FROM "matches"
+            GROUP BY "{FIELD_SONG_ID}"
+        )
+        ,   "counts" AS (
+            SELECT m."{FIELD_SONG_ID}", m."{FIELD_OFFSET}" - s."{FIELD_OFFSET}" AS "difference", count(*) AS "count"
+            FROM "matches" m
+            JOIN unnest(%s::BIGINT[], %s::INT[]) AS s("index", "{FIELD_OFFSET}") ON s."index" = m."index"
+            GROUP BY 1, 2
+        )
+        ,   "best" AS (
+            SELECT DISTINCT ON ("{FIELD_SONG_ID}") "{FIELD_SONG_ID}", "difference", "count"
+            FROM "counts"
+            ORDER BY "{FIELD_SONG_ID}", "count" DESC, "difference"
+        )
+        SELECT b."{FIELD_SONG_ID}", b."difference", b."count", d."matched"
+        FROM "best" b
+        JOIN "matched" d ON d."{FIELD_SONG_ID}" = b."{FIELD_SONG_ID}"
+        ORDER BY b."count" DESC, b."{FIELD_SONG_ID}"
+        LIMIT %s;
+    """
+
+    # rows brought at once by server side cursors.
+    MATCHES_FETCH_SIZE = 50000
+
     SELECT_ALL = f'SELECT "{FIELD_SONG_ID}", "{FIELD_OFFSET}" FROM "{FINGERPRINTS_TABLENAME}";'
 
     SELECT_SONG = f"""
@@ -107,9 +247,16 @@ class PostgreSQLDatabase(CommonDatabase):
         WHERE "{FIELD_FINGERPRINTED}" = 1;
     """
 
+    SELECT_SETTING = f"""
+        SELECT "{FIELD_SETTING_VALUE}"
+        FROM "{SETTINGS_TABLENAME}"
+        WHERE "{FIELD_SETTING_NAME}" = %s;
+    """
+
     # DROPS
     DROP_FINGERPRINTS = F'DROP TABLE IF EXISTS "{FINGERPRINTS_TABLENAME}";'
     DROP_SONGS = F'DROP TABLE IF EXISTS "{SONGS_TABLENAME}";'
+    DROP_SETTINGS = f'DROP TABLE IF EXISTS "{SETTINGS_TABLENAME}";'
 
     # UPDATE
     UPDATE_SONG_FINGERPRINTED = f"""
@@ -129,17 +276,43 @@ class PostgreSQLDatabase(CommonDatabase):
     """
 
     # IN
-    IN_MATCH = f"decode(%s, 'hex')"
+    IN_MATCH = "%s"
+
+    # MIGRATIONS
+    SELECT_HASH_COLUMN_TYPE = f"""
+        SELECT data_type
+        FROM information_schema.columns
+        WHERE table_name = '{FINGERPRINTS_TABLENAME}' AND column_name = '{FIELD_HASH}';
+    """
+
+    LEGACY_HASH_COLUMN_TYPES = ("bytea",)
+
+    # the hash index and the unique constraint are rebuilt by postgres along with the column.
+    MIGRATE_FINGERPRINTS = [f"""
+        ALTER TABLE "{FINGERPRINTS_TABLENAME}" ALTER COLUMN "{FIELD_HASH}" TYPE BIGINT
+        USING ('x' || substr(encode("{FIELD_HASH}", 'hex'), 1, 16))::bit(64)::bigint;
+    """]
 
     def __init__(self, **options):
         super().__init__()
-        self.cursor = cursor_factory(**options)
+        # connection pool sizes and timeouts, see ConnectionPool.
+        self._pool_options = options.pop("pool", {})
+        self.match_strategy = options.pop("match_strategy", self.DEFAULT_MATCH_STRATEGY)
+        if self.match_strategy not in self.MATCH_STRATEGIES:
+            raise ValueError(f"Unknown match strategy '{self.match_strategy}', "
+                             f"available ones are: {', '.join(self.MATCH_STRATEGIES)}.")
         self._options = options
+        self.pool = connection_pool(self._options, self._pool_options)
+        self.cursor = cursor_factory(self.pool)
+
+    def before_fork(self) -> None:
+        # the new process opens its own connections, the idle ones are of no use to it.
+        self.pool.close()
 
     def after_fork(self) -> None:
-        # Clear the cursor cache, we don't want any stale connections from
-        # the previous process.
-        Cursor.clear_cache()
+        # Drop the connections of the previous process, we don't want any stale
+        # connections (and closing them would close them for the parent too).
+        self.pool.reset()
 
     def insert_song(self, song_name: str, file_hash: str, total_hashes: int) -> int:
         """
@@ -155,65 +328,193 @@ class PostgreSQLDatabase(CommonDatabase):
             cur.execute(self.INSERT_SONG, (song_name, file_hash, total_hashes))
             return cur.fetchone()[0]
 
+    def insert_hashes(self, song_id: int, hashes: np.ndarray, batch_size: int = 1000) -> None:
+        """
+        Insert a multitude of fingerprints, streamed with a binary COPY instead of row by row inserts.
+
+        :param song_id: Song identifier the fingerprints belong to
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
+            - offset: Offset this hash was created from/at.
+        :param batch_size: unused, all fingerprints are copied at once.
+        """
+        if len(hashes) == 0:
+            return
+
+        rows = copy_binary(hashes[FIELD_HASH].astype(np.int64), np.full(len(hashes), song_id, dtype=np.int32),
+                           hashes[FIELD_OFFSET].astype(np.int32))
+
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_FINGERPRINTS_STAGING_TABLE)
+            cur.copy_expert(self.COPY_FINGERPRINTS_STAGING, io.BytesIO(rows))
+            cur.execute(self.MERGE_FINGERPRINTS_STAGING)
+
+    def return_best_offsets(self, hashes: np.ndarray, topn: int = TOPN, batch_size: int = 1000) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[int, int]]:
+        """
+        Searches the database for pairs of (hash, offset) values and aligns them in the database itself,
+        so only the best offset of the topn songs is sent back instead of every match.
+
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
+            - offset: Offset this hash was created from/at.
+        :param topn: number of songs to return.
+        :param batch_size: unused, all hashes are sent at once.
+        :return: a tuple of arrays with the song ids, best offset differences and number of matches on
+        that offset of the topn songs, sorted by decreasing number of matches, and a dictionary with the
+        amount of hashes matched (not considering duplicated hashes) in each of those songs.
+        """
+        # positions are 1-based, as the ordinality of the unique hashes.
+        values, positions = np.unique(hashes[FIELD_HASH], return_inverse=True)
+        with self.cursor() as cur:
+            cur.execute(self.SET_ALIGNMENT_WORK_MEM)
+            cur.execute(self.SELECT_BEST_OFFSETS, (values.tolist(), (positions + 1).tolist(),
+                                                   hashes[FIELD_OFFSET].tolist(), topn))
+            rows = cur.fetchall()
+
+        best = np.array(rows, dtype=np.int64).reshape(-1, 4)
+        return best[:, 0], best[:, 1], best[:, 2], dict(zip(best[:, 0].tolist(), best[:, 3].tolist()))
+
+    def _fetch_matches(self, values: np.ndarray, batch_size: int = 1000) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Brings every fingerprint stored for the given hashes, with the configured match strategy.
+
+        :param values: sorted array of unique hashes.
+        :param batch_size: number of query's batches, only used by the "in" strategy.
+        :return: a tuple of int64 arrays with, for every fingerprint found, the index of its hash in values,
+        its song id and its offset.
+        """
+        if self.match_strategy == "in":
+            return super()._fetch_matches(values, batch_size)
+
+        chunks = [np.empty((0, 3), dtype=np.int64)]
+        with self.cursor() as cur:
+            cur.execute(self.DISABLE_JOIN_SCANS)
+            if self.match_strategy == "array":
+                # prepared statements belong to the session, so each connection prepares it once.
+                if cur.connection not in _prepared_connections:
+                    cur.execute(self.PREPARE_SELECT_MATCHES)
+                    _prepared_connections.add(cur.connection)
+
+                cur.execute(self.EXECUTE_SELECT_MATCHES, (values.tolist(),))
+                chunks.append(np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 3))
+            else:
+                cur.execute(self.CREATE_MATCHES_STAGING_TABLE)
+                cur.copy_expert(self.COPY_MATCHES_STAGING,
+                                io.BytesIO(copy_binary(np.arange(len(values), dtype=np.int32),
+                                                       values.astype(np.int64))))
+
+                # a named cursor lives on the server, rows are brought in chunks as they are fetched.
+                with cur.connection.cursor(name="select_matches") as matches_cursor:
+                    matches_cursor.execute(self.SELECT_MATCHES_STAGING)
+                    while True:
+                        rows = matches_cursor.fetchmany(self.MATCHES_FETCH_SIZE)
+                        if not rows:
+                            break
+                        chunks.append(np.array(rows, dtype=np.int64))
+
+        matches = np.concatenate(chunks)
+        return matches[:, 0], matches[:, 1], matches[:, 2]
+
     def __getstate__(self):
-        return self._options,
+        return self._options, self._pool_options, self.match_strategy
 
     def __setstate__(self, state):
-        self._options, = state
-        self.cursor = cursor_factory(**self._options)
+        self._options, self._pool_options, self.match_strategy = state
+        self.pool = connection_pool(self._options, self._pool_options)
+        self.cursor = cursor_factory(self.pool)
+
+
+# PostgreSQL binary COPY format: a signature, flags and header extension length, then every row as its
+# number of fields followed by each field size and value, all of them in network byte order.
+COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_BINARY_TRAILER = struct.pack("!h", -1)
 
+# connections the match query was prepared on.
+_prepared_connections = weakref.WeakSet()
 
-def cursor_factory(**factory_options):
+
+def copy_binary(*columns: np.ndarray) -> bytes:
+    """
+    Encodes integer columns as the rows of a binary COPY, each value is sent with the size of its
+    column dtype (e.g. int32 for INT columns and int64 for BIGINT ones).
+
+    :param columns: arrays with the values of each column, in the order of the COPY columns.
+    :return: the COPY data.
+    """
+    dtype = [("fields", ">i2")]
+    for index, column in enumerate(columns):
+        dtype += [(f"size_{index}", ">i4"), (f"value_{index}", column.dtype.newbyteorder(">"))]
+
+    rows = np.empty(len(columns[0]), dtype=dtype)
+    rows["fields"] = len(columns)
+    for index, column in enumerate(columns):
+        rows[f"size_{index}"] = column.dtype.itemsize
+        rows[f"value_{index}"] = column
+    return COPY_BINARY_HEADER + rows.tobytes() + COPY_BINARY_TRAILER
+
+
+def connection_pool(options: Dict[str, any], pool_options: Dict[str, any]) -> ConnectionPool:
+    return get_pool(PostgreSQLDatabase.type, options, lambda: psycopg2.connect(**options), is_alive,
+                    **pool_options)
+
+
+def is_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1;")
+    conn.rollback()
+    return True
+
+
+def cursor_factory(pool: ConnectionPool):
     def cursor(**options):
-        options.update(factory_options)
-        return Cursor(**options)
+        return Cursor(pool, **options)
     return cursor
 
 
 class Cursor(object):
     """
-    Establishes a connection to the database and returns an open cursor.
+    Checks out a connection from the pool and returns an open cursor. On exit the transaction is
+    committed, or rolled back if the block raised, and the connection goes back to the pool.
     # Use as context manager
-    with Cursor() as cur:
+    with Cursor(pool) as cur:
         cur.execute(query)
         ...
     """
-    def __init__(self, dictionary=False, **options):
+    def __init__(self, pool: ConnectionPool, dictionary=False, buffered=True):
         super().__init__()
-
-        self._cache = queue.Queue(maxsize=5)
-
-        try:
-            conn = self._cache.get_nowait()
-            # Ping the connection before using it from the cache.
-            conn.ping(True)
-        except queue.Empty:
-            conn = psycopg2.connect(**options)
-
-        self.conn = conn
+        self.pool = pool
         self.dictionary = dictionary
-
-    @classmethod
-    def clear_cache(cls):
-        cls._cache = queue.Queue(maxsize=5)
+        # psycopg2 cursors always fetch the whole result on execute, i.e. they are always buffered.
 
     def __enter__(self):
-        if self.dictionary:
-            self.cursor = self.conn.cursor(cursor_factory=DictCursor)
-        else:
-            self.cursor = self.conn.cursor()
+        self.conn = self.pool.acquire()
+        try:
+            if self.dictionary:
+                self.cursor = self.conn.cursor(cursor_factory=DictCursor)
+            else:
+                self.cursor = self.conn.cursor()
+        except psycopg2.Error:
+            self.pool.release(self.conn, broken=True)
+            raise
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
-        # if we had a PostgreSQL related error we try to rollback the cursor.
-        if extype is psycopg2.DatabaseError:
-            self.cursor.rollback()
-
-        self.cursor.close()
-        self.conn.commit()
-
-        # Put it back on the queue
+        broken = False
         try:
-            self._cache.put_nowait(self.conn)
-        except queue.Full:
-            self.conn.close()
+            self.cursor.close()
+            # if we had an error we rollback whatever the block did.
+            if extype is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        except psycopg2.Error:
+            broken = True
+            # the error raised within the block, if any, is the one worth raising.
+            if extype is None:
+                raise
+        finally:
+            self.pool.release(self.conn, broken=broken or bool(self.conn.closed))
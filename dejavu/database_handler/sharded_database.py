@@ -0,0 +1,341 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from dejavu.base_classes.base_database import get_database
+from dejavu.base_classes.common_database import CommonDatabase
+from dejavu.config.settings import (FIELD_FILE_SHA1, FIELD_HASH, FIELD_SONG_ID,
+                                    FIELD_SONGNAME, FIELD_TOTAL_HASHES,
+                                    SETTING_SHARD_MAPPING)
+from dejavu.logic.fingerprint import FINGERPRINT_DTYPE
+
+
+class ShardedDatabase(CommonDatabase):
+    """
+    Spreads the fingerprints of the catalog over several databases, each of them storing the hashes
+    of a range of hash prefixes. Inserts and lookups are split by shard and run on all of them at once.
+
+    Songs and settings live in a single metadata database, which gives the song ids. Shards keep a copy
+    of the songs they have fingerprints of, as their fingerprints reference them, which is only used to
+    delete those fingerprints along with the songs.
+
+    # database config
+    "database_type": "sharded",
+    "database": {
+        "metadata": {"database_type": "postgres", "database": {...}},
+        "shards": [
+            {"database_type": "postgres", "database": {...}, "weight": 1},
+            {"database_type": "postgres", "database": {...}, "weight": 2},
+            ...
+        ]
+    }
+
+    Every shard is given a range of the first 32 bits of the hashes proportional to its weight (1 by default).
+    The metadata database defaults to the first shard. The mapping is stored in the catalog, the same
+    shards and weights must be configured afterwards, as fingerprints are never moved between shards.
+    """
+    type = "sharded"
+
+    def __init__(self, shards: List[Dict[str, any]], metadata: Dict[str, any] = None):
+        """
+        :param shards: database config of each shard, with an optional "weight".
+        :param metadata: database config of the database storing songs and settings, the first shard if None.
+        """
+        super().__init__()
+        if not shards:
+            raise ValueError("A sharded database needs at least one shard.")
+
+        self._shards_config = shards
+        self._metadata_config = metadata
+        self.shards = [connect(config) for config in shards]
+        self.metadata = connect(metadata) if metadata is not None else self.shards[0]
+
+        weights = np.array([config.get("weight", 1) for config in shards], dtype=np.float64)
+        if (weights <= 0).any():
+            raise ValueError("Shard weights must be positive.")
+        # first prefix of every shard but the first one.
+        self.boundaries = np.round(np.cumsum(weights)[:-1] / weights.sum() * 2 ** 32).astype(np.uint64)
+
+        self._executor = None
+        self._executor_pid = None
+
+    def before_fork(self) -> None:
+        for db in self._databases():
+            db.before_fork()
+
+    def after_fork(self) -> None:
+        for db in self._databases():
+            db.after_fork()
+
+    def setup(self) -> None:
+        """
+        Called on creation or shortly afterwards. Besides setting every database up, checks the shards are
+        the ones the catalog was built with and drops the fingerprints left on shards by songs whose insertion
+        never completed.
+        """
+        # shards are only touched once they are known to be the ones of the catalog.
+        self.metadata.setup()
+        self._check_mapping()
+        self._map(lambda shard: shard.setup(), [shard for shard in self.shards if shard is not self.metadata])
+
+        # songs are flagged fingerprinted on the shards before the metadata database, a song may be
+        # fingerprinted on shards but gone from the metadata database if its insertion was interrupted.
+        song_ids = {song[FIELD_SONG_ID] for song in self.metadata.get_songs()}
+        for shard in self.shards:
+            if shard is not self.metadata:
+                orphans = [song[FIELD_SONG_ID] for song in shard.get_songs() if song[FIELD_SONG_ID] not in song_ids]
+                shard.delete_songs_by_id(orphans)
+
+    def empty(self) -> None:
+        """
+        Called when the database should be cleared of all data.
+        """
+        self._map(lambda db: db.empty(), self._databases())
+        self._check_mapping()
+
+    def delete_unfingerprinted_songs(self) -> None:
+        """
+        Called to remove any song entries that do not have any fingerprints
+        associated with them.
+        """
+        self._map(lambda db: db.delete_unfingerprinted_songs(), self._databases())
+
+    def get_num_songs(self) -> int:
+        """
+        Returns the song's count stored.
+
+        :return: the amount of songs in the database.
+        """
+        return self.metadata.get_num_songs()
+
+    def get_num_fingerprints(self) -> int:
+        """
+        Returns the fingerprints' count stored.
+
+        :return: the number of fingerprints in the database.
+        """
+        return sum(self._map(lambda shard: shard.get_num_fingerprints(), self.shards))
+
+    def set_song_fingerprinted(self, song_id: int):
+        """
+        Sets a specific song as having all fingerprints in the database, on the shards first.
+
+        :param song_id: song identifier.
+        """
+        self._map(lambda shard: shard.set_song_fingerprinted(song_id),
+                  [shard for shard in self.shards if shard is not self.metadata])
+        self.metadata.set_song_fingerprinted(song_id)
+
+    def get_songs(self) -> List[Dict[str, str]]:
+        """
+        Returns all fully fingerprinted songs in the database
+
+        :return: a dictionary with the songs info.
+        """
+        return self.metadata.get_songs()
+
+    def get_song_by_id(self, song_id: int) -> Dict[str, str]:
+        """
+        Brings the song info from the database.
+
+        :param song_id: song identifier.
+        :return: a song by its identifier. Result must be a Dictionary.
+        """
+        return self.metadata.get_song_by_id(song_id)
+
+    def get_setting(self, name: str) -> Optional[str]:
+        """
+        Returns the value of a catalog setting.
+
+        :param name: setting name.
+        :return: the stored value, None if the setting was never set.
+        """
+        return self.metadata.get_setting(name)
+
+    def set_setting(self, name: str, value: str) -> str:
+        """
+        Stores a catalog setting unless it was already set.
+
+        :param name: setting name.
+        :param value: value to store.
+        :return: the value of the setting after the call, which is the former one if it was already set.
+        """
+        return self.metadata.set_setting(name, value)
+
+    def insert(self, fingerprint: int, song_id: int, offset: int):
+        """
+        Inserts a single fingerprint into the database.
+
+        :param fingerprint: First 64 bits of a sha1 hash, as a signed integer
+        :param song_id: Song identifier this fingerprint is off
+        :param offset: The offset this fingerprint is from.
+        """
+        self.insert_hashes(song_id, np.array([(fingerprint, offset)], dtype=FINGERPRINT_DTYPE))
+
+    def insert_song(self, song_name: str, file_hash: str, total_hashes: int) -> int:
+        """
+        Inserts a song name into the metadata database, returns the new
+        identifier of the song.
+
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param total_hashes: amount of hashes to be inserted on fingerprint table.
+        :return: the inserted id.
+        """
+        return self.metadata.insert_song(song_name, file_hash, total_hashes)
+
+    def mirror_song(self, song_id: int, song_name: str, file_hash: str, total_hashes: int) -> None:
+        """
+        Inserts a song under an identifier given by another database, unless it is already stored.
+
+        :param song_id: song identifier.
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param total_hashes: amount of hashes of the song.
+        """
+        self.metadata.mirror_song(song_id, song_name, file_hash, total_hashes)
+
+    def query(self, fingerprint: int = None) -> List[Tuple]:
+        """
+        Returns all matching fingerprint entries associated with
+        the given hash as parameter, if None is passed it returns all entries.
+
+        :param fingerprint: first 64 bits of a sha1 hash, as a signed integer
+        :return: a list of fingerprint records stored in the db.
+        """
+        if fingerprint is None:
+            return [row for rows in self._map(lambda shard: shard.query(None), self.shards) for row in rows]
+
+        shard = self.shard_of(np.array([fingerprint], dtype=np.int64))[0]
+        return self.shards[shard].query(fingerprint)
+
+    def insert_hashes(self, song_id: int, hashes: np.ndarray, batch_size: int = 1000) -> None:
+        """
+        Insert a multitude of fingerprints, each of them into the shard of its hash.
+
+        :param song_id: Song identifier the fingerprints belong to
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
+            - offset: Offset this hash was created from/at.
+        :param batch_size: insert batches.
+        """
+        song = self.metadata.get_song_by_id(song_id)
+        shards = self.shard_of(hashes[FIELD_HASH])
+
+        def insert(shard: int) -> None:
+            db = self.shards[shard]
+            db.mirror_song(song_id, song[FIELD_SONGNAME], song[FIELD_FILE_SHA1], song[FIELD_TOTAL_HASHES])
+            db.insert_hashes(song_id, hashes[shards == shard], batch_size)
+
+        self._map(insert, np.unique(shards).tolist())
+
+    def delete_songs_by_id(self, song_ids: List[int], batch_size: int = 1000) -> None:
+        """
+        Given a list of song ids it deletes all songs specified and their corresponding fingerprints.
+
+        :param song_ids: song ids to be deleted from the database.
+        :param batch_size: number of query's batches.
+        """
+        self._map(lambda db: db.delete_songs_by_id(song_ids, batch_size), self._databases())
+
+    def migrate_fingerprints(self) -> bool:
+        """
+        Converts the fingerprints of every shard stored with the former hexadecimal hash format.
+
+        :return: True if any shard was migrated.
+        """
+        return any(self._map(lambda shard: shard.migrate_fingerprints(), self.shards))
+
+    def shard_of(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Tells the shard storing each hash.
+
+        :param hashes: array of int64 hashes.
+        :return: array with the index of the shard of each hash.
+        """
+        prefixes = np.asarray(hashes, dtype=np.int64).view(np.uint64) >> np.uint64(32)
+        return np.searchsorted(self.boundaries, prefixes, side="right")
+
+    def _fetch_matches(self, values: np.ndarray, batch_size: int = 1000) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Brings every fingerprint stored for the given hashes, looking each of them up on its shard.
+
+        :param values: sorted array of unique hashes.
+        :param batch_size: number of query's batches.
+        :return: a tuple of int64 arrays with, for every fingerprint found, the index of its hash in values,
+        its song id and its offset.
+        """
+        shards = self.shard_of(values)
+
+        def fetch(shard: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            # the hashes of a shard are still sorted, indexes are mapped back to the positions in values.
+            positions = np.flatnonzero(shards == shard)
+            indexes, song_ids, offsets = self.shards[shard]._fetch_matches(values[positions], batch_size)
+            return positions[indexes], song_ids, offsets
+
+        matches = self._map(fetch, np.unique(shards).tolist())
+        if not matches:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+        return tuple(np.concatenate(columns) for columns in zip(*matches))
+
+    def _check_mapping(self) -> None:
+        mapping = mapping_description(self.boundaries)
+        stored = self.metadata.set_setting(SETTING_SHARD_MAPPING, mapping)
+        if stored != mapping:
+            raise ValueError(f"The catalog was built with a different shard mapping ({stored}) "
+                             f"than the configured one ({mapping}).")
+
+    def _databases(self) -> List[CommonDatabase]:
+        return self.shards + ([self.metadata] if all(shard is not self.metadata for shard in self.shards) else [])
+
+    def _map(self, func: Callable, items: List) -> List:
+        """
+        Runs a function on every item at the same time, one thread per shard.
+
+        :param func: function to run.
+        :param items: its arguments.
+        :return: the results, in the order of the items.
+        """
+        if len(items) <= 1:
+            return [func(item) for item in items]
+
+        # threads don't survive a fork, a forked process starts its own ones.
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=len(self.shards) + 1,
+                                                thread_name_prefix="dejavu-shard")
+            self._executor_pid = os.getpid()
+        return list(self._executor.map(func, items))
+
+    def __getstate__(self):
+        return self._shards_config, self._metadata_config
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+def connect(config: Dict[str, any]) -> CommonDatabase:
+    """
+    Creates the handler of a shard, or of the metadata database.
+
+    :param config: database config, as the dejavu one: with "database_type" and "database" entries.
+    :return: the handler.
+    """
+    db = get_database(config.get("database_type", "mysql").lower())(**config.get("database", {}))
+    if not isinstance(db, CommonDatabase) or isinstance(db, ShardedDatabase):
+        raise TypeError(f"Unsupported shard database type '{db.type}'.")
+    return db
+
+
+def mapping_description(boundaries: np.ndarray) -> str:
+    """
+    :param boundaries: first hash prefix of every shard but the first one.
+    :return: a short description of the shard mapping, as stored in the catalog.
+    """
+    digest = sha1(json.dumps(boundaries.tolist()).encode("utf-8")).hexdigest()[0:16]
+    return f"{len(boundaries) + 1} shards, {digest}"
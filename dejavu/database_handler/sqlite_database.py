@@ -0,0 +1,375 @@
+import sqlite3
+from typing import Dict, Tuple
+
+import numpy as np
+
+from dejavu.base_classes.common_database import CommonDatabase
+from dejavu.config.settings import (FIELD_FILE_SHA1, FIELD_FINGERPRINTED,
+                                    FIELD_HASH, FIELD_OFFSET,
+                                    FIELD_SETTING_NAME, FIELD_SETTING_VALUE,
+                                    FIELD_SONG_ID, FIELD_SONGNAME,
+                                    FIELD_TOTAL_HASHES, FINGERPRINTS_TABLENAME,
+                                    SETTINGS_TABLENAME, SONGS_TABLENAME)
+from dejavu.database_handler.connection_pool import ConnectionPool, get_pool
+
+
+class SQLiteDatabase(CommonDatabase):
+    """
+    Catalog stored in a single SQLite file, for single node deployments with no database server.
+    The "database" entry of the database config is the path of the file.
+
+    The database runs in WAL mode, so readers (e.g. concurrent recognitions) never wait for writers and
+    the processes sharing the file see each other's commits. Writers wait for each other up to the
+    "timeout" entry of the database config (5 seconds by default).
+    """
+    type = "sqlite"
+
+    # run on every new connection. WAL mode is stored in the file, the rest of them only last for the connection.
+    # With WAL a NORMAL synchronous mode never corrupts the file, a power loss may only lose the last commits.
+    CONNECTION_PRAGMAS = [
+        "PRAGMA journal_mode = WAL;",
+        "PRAGMA synchronous = NORMAL;",
+        "PRAGMA foreign_keys = ON;",
+        "PRAGMA temp_store = MEMORY;"
+    ]
+
+    # CREATES
+    CREATE_SONGS_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS "{SONGS_TABLENAME}" (
+            "{FIELD_SONG_ID}" INTEGER PRIMARY KEY AUTOINCREMENT
+        ,   "{FIELD_SONGNAME}" VARCHAR(250) NOT NULL
+        ,   "{FIELD_FINGERPRINTED}" SMALLINT DEFAULT 0
+        ,   "{FIELD_FILE_SHA1}" BLOB
+        ,   "{FIELD_TOTAL_HASHES}" INT NOT NULL DEFAULT 0
+        ,   "date_created" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ,   "date_modified" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+    """
+
+    # the table is clustered on its unique key, which deletes the fingerprints of a song by range. Matches
+    # are looked up through an index holding every column they need, so they never read the table itself.
+    # There are no date columns, they would take as much space as the fingerprints in both of them.
+    CREATE_FINGERPRINTS_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS "{FINGERPRINTS_TABLENAME}" (
+            "{FIELD_HASH}" INTEGER NOT NULL
+        ,   "{FIELD_SONG_ID}" INTEGER NOT NULL
+        ,   "{FIELD_OFFSET}" INTEGER NOT NULL
+        ,   CONSTRAINT "pk_{FINGERPRINTS_TABLENAME}" PRIMARY KEY ("{FIELD_SONG_ID}", "{FIELD_OFFSET}", "{FIELD_HASH}")
+        ,   CONSTRAINT "fk_{FINGERPRINTS_TABLENAME}_{FIELD_SONG_ID}" FOREIGN KEY ("{FIELD_SONG_ID}")
+                REFERENCES "{SONGS_TABLENAME}"("{FIELD_SONG_ID}") ON DELETE CASCADE
+        ) WITHOUT ROWID;
+    """
+
+    CREATE_FINGERPRINTS_TABLE_INDEX = f"""
+        CREATE INDEX IF NOT EXISTS "ix_{FINGERPRINTS_TABLENAME}_{FIELD_HASH}" ON "{FINGERPRINTS_TABLENAME}"
+        ("{FIELD_HASH}", "{FIELD_SONG_ID}", "{FIELD_OFFSET}");
+    """
+
+    CREATE_SETTINGS_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS "{SETTINGS_TABLENAME}" (
+            "{FIELD_SETTING_NAME}" VARCHAR(64) NOT NULL
+        ,   "{FIELD_SETTING_VALUE}" VARCHAR(250) NOT NULL
+        ,   "date_created" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ,   CONSTRAINT "pk_{SETTINGS_TABLENAME}_{FIELD_SETTING_NAME}" PRIMARY KEY ("{FIELD_SETTING_NAME}")
+        );
+    """
+
+    # INSERTS (IGNORES DUPLICATES)
+    INSERT_FINGERPRINT = f"""
+        INSERT OR IGNORE INTO "{FINGERPRINTS_TABLENAME}" (
+                "{FIELD_SONG_ID}"
+            ,   "{FIELD_HASH}"
+            ,   "{FIELD_OFFSET}")
+        VALUES (?, ?, ?);
+    """
+
+    INSERT_SONG = f"""
+        INSERT INTO "{SONGS_TABLENAME}" ("{FIELD_SONGNAME}", "{FIELD_FILE_SHA1}","{FIELD_TOTAL_HASHES}")
+        VALUES (?, ?, ?);
+    """
+
+    MIRROR_SONG = f"""
+        INSERT OR IGNORE INTO "{SONGS_TABLENAME}" (
+            "{FIELD_SONG_ID}", "{FIELD_SONGNAME}", "{FIELD_FILE_SHA1}", "{FIELD_TOTAL_HASHES}")
+        VALUES (?, ?, ?, ?);
+    """
+
+    # a setting keeps the first value it was given, so concurrent writers agree on it.
+    INSERT_SETTING = f"""
+        INSERT OR IGNORE INTO "{SETTINGS_TABLENAME}" ("{FIELD_SETTING_NAME}", "{FIELD_SETTING_VALUE}")
+        VALUES (?, ?);
+    """
+
+    # SELECTS
+    SELECT = f"""
+        SELECT "{FIELD_SONG_ID}", "{FIELD_OFFSET}"
+        FROM "{FINGERPRINTS_TABLENAME}"
+        WHERE "{FIELD_HASH}" = ?;
+    """
+
+    SELECT_MULTIPLE = f"""
+        SELECT "{FIELD_HASH}", "{FIELD_SONG_ID}", "{FIELD_OFFSET}"
+        FROM "{FINGERPRINTS_TABLENAME}"
+        WHERE "{FIELD_HASH}" IN (%s);
+    """
+
+    # MATCH QUERIES
+    # the hashes of a recording are inserted into a temporary table, private to the connection and kept in
+    # memory, which is joined with the fingerprints. CROSS JOIN makes SQLite loop over the hashes and look
+    # each of them up in the hash index, rather than trusting its estimates.
+    CREATE_MATCHES_STAGING_TABLE = f"""
+        CREATE TEMPORARY TABLE IF NOT EXISTS "matches_staging" (
+            "index" INTEGER PRIMARY KEY
+        ,   "{FIELD_HASH}" INTEGER NOT NULL
+        );
+    """
+
+    INSERT_MATCHES_STAGING = f'INSERT INTO "matches_staging" ("index", "{FIELD_HASH}") VALUES (?, ?);'
+
+    SELECT_MATCHES_STAGING = f"""
+        SELECT q."index", f."{FIELD_SONG_ID}", f."{FIELD_OFFSET}"
+        FROM "matches_staging" q
+        CROSS JOIN "{FINGERPRINTS_TABLENAME}" f ON f."{FIELD_HASH}" = q."{FIELD_HASH}";
+    """
+
+    DELETE_MATCHES_STAGING = 'DELETE FROM "matches_staging";'
+
+    SELECT_ALL = f'SELECT "{FIELD_SONG_ID}", "{FIELD_OFFSET}" FROM "{FINGERPRINTS_TABLENAME}";'
+
+    SELECT_SONG = f"""
+        SELECT
+            "{FIELD_SONGNAME}"
+        ,   hex("{FIELD_FILE_SHA1}") AS "{FIELD_FILE_SHA1}"
+        ,   "{FIELD_TOTAL_HASHES}"
+        FROM "{SONGS_TABLENAME}"
+        WHERE "{FIELD_SONG_ID}" = ?;
+    """
+
+    SELECT_NUM_FINGERPRINTS = f'SELECT COUNT(*) AS n FROM "{FINGERPRINTS_TABLENAME}";'
+
+    SELECT_UNIQUE_SONG_IDS = f"""
+        SELECT COUNT("{FIELD_SONG_ID}") AS n
+        FROM "{SONGS_TABLENAME}"
+        WHERE "{FIELD_FINGERPRINTED}" = 1;
+    """
+
+    SELECT_SONGS = f"""
+        SELECT
+            "{FIELD_SONG_ID}"
+        ,   "{FIELD_SONGNAME}"
+        ,   hex("{FIELD_FILE_SHA1}") AS "{FIELD_FILE_SHA1}"
+        ,   "{FIELD_TOTAL_HASHES}"
+        ,   "date_created"
+        FROM "{SONGS_TABLENAME}"
+        WHERE "{FIELD_FINGERPRINTED}" = 1;
+    """
+
+    SELECT_SETTING = f"""
+        SELECT "{FIELD_SETTING_VALUE}"
+        FROM "{SETTINGS_TABLENAME}"
+        WHERE "{FIELD_SETTING_NAME}" = ?;
+    """
+
+    # DROPS
+    DROP_FINGERPRINTS = f'DROP TABLE IF EXISTS "{FINGERPRINTS_TABLENAME}";'
+    DROP_SONGS = f'DROP TABLE IF EXISTS "{SONGS_TABLENAME}";'
+    DROP_SETTINGS = f'DROP TABLE IF EXISTS "{SETTINGS_TABLENAME}";'
+
+    # UPDATE
+    UPDATE_SONG_FINGERPRINTED = f"""
+        UPDATE "{SONGS_TABLENAME}" SET
+            "{FIELD_FINGERPRINTED}" = 1
+        ,   "date_modified" = CURRENT_TIMESTAMP
+        WHERE "{FIELD_SONG_ID}" = ?;
+    """
+
+    # DELETES
+    DELETE_UNFINGERPRINTED = f"""
+        DELETE FROM "{SONGS_TABLENAME}" WHERE "{FIELD_FINGERPRINTED}" = 0;
+    """
+
+    DELETE_SONGS = f"""
+        DELETE FROM "{SONGS_TABLENAME}" WHERE "{FIELD_SONG_ID}" IN (%s);
+    """
+
+    # IN
+    IN_MATCH = "?"
+
+    # MIGRATIONS
+    # SQLite catalogs were never stored with the former hexadecimal hashes.
+    SELECT_HASH_COLUMN_TYPE = f"""
+        SELECT type FROM pragma_table_info('{FINGERPRINTS_TABLENAME}') WHERE name = '{FIELD_HASH}';
+    """
+
+    LEGACY_HASH_COLUMN_TYPES = ()
+
+    MIGRATE_FINGERPRINTS = []
+
+    def __init__(self, **options):
+        super().__init__()
+        # connection pool sizes and timeouts, see ConnectionPool.
+        self._pool_options = options.pop("pool", {})
+        self._options = options
+        self.pool = connection_pool(self._options, self._pool_options)
+        self.cursor = cursor_factory(self.pool)
+
+    def before_fork(self) -> None:
+        # the new process opens its own connections, the idle ones are of no use to it.
+        self.pool.close()
+
+    def after_fork(self) -> None:
+        # Drop the connections of the previous process, SQLite connections must never be used
+        # (nor closed) by a forked process.
+        self.pool.reset()
+
+    def setup(self) -> None:
+        """
+        Called on creation or shortly afterwards.
+        """
+        super().setup()
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_FINGERPRINTS_TABLE_INDEX)
+
+    def insert_song(self, song_name: str, file_hash: str, total_hashes: int) -> int:
+        """
+        Inserts a song name into the database, returns the new
+        identifier of the song.
+
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param total_hashes: amount of hashes to be inserted on fingerprint table.
+        :return: the inserted id.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.INSERT_SONG, (song_name, bytes.fromhex(file_hash), total_hashes))
+            return cur.lastrowid
+
+    def mirror_song(self, song_id: int, song_name: str, file_hash: str, total_hashes: int) -> None:
+        """
+        Inserts a song under an identifier given by another database, unless it is already stored.
+        Used by the shards of a sharded catalog, whose fingerprints belong to songs stored elsewhere.
+
+        :param song_id: song identifier.
+        :param song_name: The name of the song.
+        :param file_hash: Hash from the fingerprinted file.
+        :param total_hashes: amount of hashes of the song.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.MIRROR_SONG, (song_id, song_name, bytes.fromhex(file_hash), total_hashes))
+
+    def insert_hashes(self, song_id: int, hashes: np.ndarray, batch_size: int = 1000) -> None:
+        """
+        Insert a multitude of fingerprints, all of them within a single transaction.
+
+        :param song_id: Song identifier the fingerprints belong to
+        :param hashes: An array of FINGERPRINT_DTYPE records in the format (hash, offset)
+            - hash: First 64 bits of a sha1 hash, as a signed integer.
+            - offset: Offset this hash was created from/at.
+        :param batch_size: unused, all fingerprints are inserted at once.
+        """
+        # inserted in hash order, so the hash index is filled page after page instead of at random.
+        hashes = hashes[np.argsort(hashes[FIELD_HASH], kind="stable")]
+        values = zip([song_id] * len(hashes), hashes[FIELD_HASH].tolist(), hashes[FIELD_OFFSET].tolist())
+
+        with self.cursor() as cur:
+            cur.executemany(self.INSERT_FINGERPRINT, values)
+
+    def _fetch_matches(self, values: np.ndarray, batch_size: int = 1000) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Brings every fingerprint stored for the given hashes, joining them with a temporary table.
+
+        :param values: sorted array of unique hashes.
+        :param batch_size: unused, all hashes are looked up at once.
+        :return: a tuple of int64 arrays with, for every fingerprint found, the index of its hash in values,
+        its song id and its offset.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_MATCHES_STAGING_TABLE)
+            cur.execute(self.DELETE_MATCHES_STAGING)
+            cur.executemany(self.INSERT_MATCHES_STAGING, enumerate(values.tolist()))
+            cur.execute(self.SELECT_MATCHES_STAGING)
+            matches = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 3)
+            # the hashes are not kept until the next lookup.
+            cur.execute(self.DELETE_MATCHES_STAGING)
+
+        return matches[:, 0], matches[:, 1], matches[:, 2]
+
+    def __getstate__(self):
+        return self._options, self._pool_options
+
+    def __setstate__(self, state):
+        self._options, self._pool_options = state
+        self.pool = connection_pool(self._options, self._pool_options)
+        self.cursor = cursor_factory(self.pool)
+
+
+def connection_pool(options: Dict[str, any], pool_options: Dict[str, any]) -> ConnectionPool:
+    return get_pool(SQLiteDatabase.type, options, lambda: connect(options), is_alive, **pool_options)
+
+
+def connect(options: Dict[str, any]) -> sqlite3.Connection:
+    # pooled connections are handed to one thread after another, never used by two of them at once.
+    conn = sqlite3.connect(**options, check_same_thread=False)
+    for pragma in SQLiteDatabase.CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def is_alive(conn) -> bool:
+    conn.execute("SELECT 1;")
+    return True
+
+
+def dictionary_row(cursor: sqlite3.Cursor, row: Tuple) -> Dict[str, any]:
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def cursor_factory(pool: ConnectionPool):
+    def cursor(**options):
+        return Cursor(pool, **options)
+    return cursor
+
+
+class Cursor(object):
+    """
+    Checks out a connection from the pool and returns an open cursor. On exit the transaction is
+    committed, or rolled back if the block raised, and the connection goes back to the pool.
+    # Use as context manager
+    with Cursor(pool) as cur:
+        cur.execute(query)
+        ...
+    """
+    def __init__(self, pool: ConnectionPool, dictionary=False, buffered=True):
+        super().__init__()
+        self.pool = pool
+        self.dictionary = dictionary
+        # sqlite3 cursors step through the results as they are fetched, there is no buffering to choose.
+
+    def __enter__(self):
+        self.conn = self.pool.acquire()
+        try:
+            self.cursor = self.conn.cursor()
+            if self.dictionary:
+                self.cursor.row_factory = dictionary_row
+        except sqlite3.Error:
+            self.pool.release(self.conn, broken=True)
+            raise
+        return self.cursor
+
+    def __exit__(self, extype, exvalue, traceback):
+        broken = False
+        try:
+            self.cursor.close()
+            # if we had an error we rollback whatever the block did.
+            if extype is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        except sqlite3.Error:
+            broken = True
+            # the error raised within the block, if any, is the one worth raising.
+            if extype is None:
+                raise
+        finally:
+            self.pool.release(self.conn, broken=broken)
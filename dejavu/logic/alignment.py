@@ -0,0 +1,57 @@
+from typing import Tuple
+
+import numpy as np
+
+from dejavu.config.settings import TOPN
+
+
+def best_offsets(song_ids: np.ndarray, offset_differences: np.ndarray,
+                 topn: int = TOPN) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Finds, for every song, the offset difference most matches agree on, and keeps the songs with
+    the most agreeing matches.
+
+    The (song, offset difference) pairs are packed into single int64 keys so a single np.unique
+    counts every bin of the offset histogram of every song. Ties are resolved as they always were:
+    the smallest offset difference of a song wins, and songs with the same count come in song id order.
+
+    :param song_ids: song id of every match.
+    :param offset_differences: database offset minus queried offset of every match.
+    :param topn: number of songs to return.
+    :return: a tuple of arrays with the song ids, best offset differences and number of matches on
+    that offset of the topn songs, sorted by decreasing number of matches.
+    """
+    song_ids = np.asarray(song_ids, dtype=np.int64)
+    offset_differences = np.asarray(offset_differences, dtype=np.int64)
+    if len(song_ids) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    # song id on the upper 32 bits and the offset difference, shifted to be non negative, on the lower ones.
+    min_difference = offset_differences.min()
+    keys, counts = np.unique((song_ids << 32) | (offset_differences - min_difference), return_counts=True)
+    key_songs = keys >> 32
+
+    # keys are sorted by song and then by offset, so every song is a run of consecutive bins.
+    starts = np.flatnonzero(np.concatenate(([True], key_songs[1:] != key_songs[:-1])))
+    best_counts = np.maximum.reduceat(counts, starts)
+
+    # first (i.e. smallest offset) bin of every run reaching the maximum of its run.
+    runs = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(keys))))
+    candidates = np.flatnonzero(counts == best_counts[runs])
+    _, first = np.unique(runs[candidates], return_index=True)
+    best_keys = keys[candidates[first]]
+
+    songs = key_songs[starts]
+    offsets = (best_keys & 0xFFFFFFFF) + min_difference
+
+    # only the songs that can make it to the topn are sorted, ties on the last count included.
+    if topn < len(songs):
+        threshold = -np.partition(-best_counts, topn - 1)[topn - 1]
+        selected = np.flatnonzero(best_counts >= threshold)
+    else:
+        selected = np.arange(len(songs))
+
+    order = selected[np.lexsort((songs[selected], -best_counts[selected]))][:topn]
+
+    return songs[order], offsets[order], best_counts[order]
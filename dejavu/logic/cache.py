@@ -0,0 +1,195 @@
+import json
+import os
+from hashlib import sha1
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from dejavu.config.settings import (CONNECTIVITY_MASK, DEFAULT_AMP_MIN,
+                                    DEFAULT_FAN_VALUE,
+                                    FINGERPRINT_CACHE_MAX_SIZE,
+                                    MAX_HASH_TIME_DELTA, MIN_HASH_TIME_DELTA,
+                                    PEAK_NEIGHBORHOOD_SIZE, PEAK_SORT)
+from dejavu.logic.fingerprint import FINGERPRINT_DTYPE
+
+# Bumped whenever the way fingerprints are computed changes without any of the settings below changing.
+CACHE_FORMAT_VERSION = 1
+
+
+class FingerprintCache:
+    """
+    Local cache of the fingerprints computed for each audio file, so re-ingesting files (e.g. rebuilding
+    a catalog on a new database) skips decoding and fingerprinting them.
+
+    Every entry is a .npy file named after the SHA1 of the file contents and a digest of the parameters
+    the fingerprints were computed with, so changing any of them just misses the cache. The total size of
+    the directory is bounded, the least recently used entries being evicted first.
+
+    The cache can be shared by several processes, entries are written atomically. A cache sent to another
+    process (e.g. with the tasks of a pool) is unpickled there as the one instance of that process for its
+    directory, so the tasks of a worker share it instead of each starting over.
+    """
+    def __init__(self, directory: str, max_size: int = FINGERPRINT_CACHE_MAX_SIZE):
+        """
+        :param directory: directory where entries are stored, created if it does not exist.
+        :param max_size: maximum size of the cache in bytes.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        # lookups counted with count(), by whoever gets their outcome back, possibly from other processes.
+        self.hits = 0
+        self.misses = 0
+        # size of the entries, only scanned from disk when needed.
+        self._size = None
+        os.makedirs(directory, exist_ok=True)
+
+    def count(self, hit: bool) -> None:
+        """
+        Adds a lookup to the hit/miss counters, get() leaving it to the caller, which may be another process.
+
+        :param hit: whether the lookup was a hit.
+        """
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def get(self, file_hash: str, limit: Optional[int], profile: Dict[str, any]) -> Optional[np.ndarray]:
+        """
+        Looks up the fingerprints of a file.
+
+        :param file_hash: SHA1 of the file, as given by decoder.unique_hash.
+        :param limit: number of seconds fingerprinted, None for the whole file.
+        :param profile: fingerprint profile used.
+        :return: the array of FINGERPRINT_DTYPE records, None if the file is not cached.
+        """
+        path = self._path(file_hash, limit, profile)
+        try:
+            fingerprints = np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            # missing, or a broken file left by a crash, which will be overwritten.
+            return None
+
+        if fingerprints.dtype != FINGERPRINT_DTYPE:
+            return None
+
+        # the modification time is what eviction goes by.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return fingerprints
+
+    def put(self, file_hash: str, limit: Optional[int], profile: Dict[str, any], fingerprints: np.ndarray) -> None:
+        """
+        Stores the fingerprints of a file, evicting the least recently used entries if the cache gets too big.
+
+        :param file_hash: SHA1 of the file, as given by decoder.unique_hash.
+        :param limit: number of seconds fingerprinted, None for the whole file.
+        :param profile: fingerprint profile used.
+        :param fingerprints: array of FINGERPRINT_DTYPE records.
+        """
+        path = self._path(file_hash, limit, profile)
+        # write aside and rename, so other processes never load a partial file.
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(fingerprints, dtype=FINGERPRINT_DTYPE), allow_pickle=False)
+        os.replace(temp_path, path)
+
+        if self._size is None:
+            self._size = self._scan_size()
+        else:
+            self._size += os.path.getsize(path)
+
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self, target_ratio: float = 0.9) -> None:
+        """
+        Removes the least recently used entries until the cache is below a fraction of its maximum size,
+        leaving room for the upcoming entries.
+
+        :param target_ratio: fraction of max_size to shrink the cache to.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size * target_ratio:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+
+        self._size = size
+
+    def clear(self) -> None:
+        """
+        Removes every entry of the cache.
+        """
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                os.remove(entry.path)
+        self._size = 0
+
+    def _scan_size(self) -> int:
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith(".npy"))
+
+    def _path(self, file_hash: str, limit: Optional[int], profile: Dict[str, any]) -> str:
+        return os.path.join(self.directory, f"{file_hash.upper()}-{parameters_digest(limit, profile)}.npy")
+
+    def __reduce__(self):
+        return process_cache, (self.directory, self.max_size)
+
+
+# caches of this process by directory and maximum size, see process_cache.
+_process_caches: Dict[Tuple[str, int], FingerprintCache] = {}
+
+
+def process_cache(directory: str, max_size: int = FINGERPRINT_CACHE_MAX_SIZE) -> FingerprintCache:
+    """
+    Gives the cache of this process for a directory, created on the first call. Caches are unpickled
+    through it, so a worker keeps the size of the entries it scanned across its tasks.
+
+    :param directory: directory where entries are stored.
+    :param max_size: maximum size of the cache in bytes.
+    :return: the cache of this process.
+    """
+    key = (directory, max_size)
+    cache = _process_caches.get(key)
+    if cache is None:
+        cache = _process_caches[key] = FingerprintCache(directory, max_size)
+    return cache
+
+
+def parameters_digest(limit: Optional[int], profile: Dict[str, any]) -> str:
+    """
+    Short digest of every parameter fingerprints depend on, besides the audio itself.
+
+    :param limit: number of seconds fingerprinted, None for the whole file.
+    :param profile: fingerprint profile used.
+    :return: an hexadecimal string.
+    """
+    parameters = {
+        "version": CACHE_FORMAT_VERSION,
+        "limit": limit,
+        "profile": profile,
+        "fan_value": DEFAULT_FAN_VALUE,
+        "amp_min": DEFAULT_AMP_MIN,
+        "connectivity": CONNECTIVITY_MASK,
+        "neighborhood": PEAK_NEIGHBORHOOD_SIZE,
+        "min_delta": MIN_HASH_TIME_DELTA,
+        "max_delta": MAX_HASH_TIME_DELTA,
+        "peak_sort": PEAK_SORT
+    }
+    return sha1(json.dumps(parameters, sort_keys=True).encode("utf-8")).hexdigest()[0:16]
@@ -1,7 +1,10 @@
 import fnmatch
+import io
+import mmap
 import os
+import struct
 from hashlib import sha1
-from typing import List, Tuple
+from typing import BinaryIO, List, Optional, Tuple, Union
 
 import numpy as np
 from pydub import AudioSegment
@@ -9,6 +12,9 @@ from pydub.utils import audioop
 
 from dejavu.third_party import wavio
 
+# in memory contents of an audio file.
+Buffer = Union[mmap.mmap, bytes, bytearray, memoryview]
+
 
 def unique_hash(file_path: str, block_size: int = 2**20) -> str:
     """ Small function to generate a hash to uniquely generate
@@ -51,11 +57,14 @@ def find_files(path: str, extensions: List[str]) -> List[Tuple[str, str]]:
     return results
 
 
-def read(file_name: str, limit: int = None) -> Tuple[List[List[int]], int, str]:
+def read(file_name: str, limit: int = None) -> Tuple[List[np.ndarray], int, str]:
     """
     Reads any file supported by pydub (ffmpeg) and returns the data contained
-    within. If file reading fails due to input being a 24-bit wav file,
-    wavio is used as a backup.
+    within. 16-bit PCM wav files are memory mapped instead of decoded (see decode_wav).
+    If file reading fails due to input being a 24-bit wav file, wavio is used as a backup.
+
+    The file is read from disk only once: its content hash is computed over the same
+    mapping the samples are then taken from.
 
     Can be optionally limited to a certain amount of seconds from the start
     of the file by specifying the `limit` parameter. This is the amount of
@@ -65,34 +74,166 @@ def read(file_name: str, limit: int = None) -> Tuple[List[List[int]], int, str]:
     :param limit: number of seconds to limit.
     :return: tuple list of (channels, sample_rate, content_file_hash).
     """
-    # pydub does not support 24-bit wav files, use wavio when this occurs
-    try:
-        audiofile = AudioSegment.from_file(file_name)
+    contents, file_hash = load(file_name)
+    channels, fs = decode(contents, limit, extension=os.path.splitext(file_name)[1])
+    return channels, fs, file_hash
+
+
+def load(file_name: str, block_size: int = 2**20) -> Tuple[Buffer, str]:
+    """
+    Maps a file in memory and computes its hash (the same one unique_hash gives) in a single sweep,
+    so that the file can be decoded afterwards (see decode) without reading it again.
+
+    :param file_name: file to be read.
+    :param block_size: hash block size.
+    :return: tuple of (contents, content_file_hash).
+    """
+    with open(file_name, "rb") as f:
+        try:
+            contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can't be mapped.
+            contents = b""
+
+    s = sha1()
+    view = memoryview(contents)
+    for start in range(0, len(view), block_size):
+        s.update(view[start:start + block_size])
+    view.release()
 
-        if limit:
-            audiofile = audiofile[:limit * 1000]
+    return contents, s.hexdigest().upper()
 
-        data = np.fromstring(audiofile.raw_data, np.int16)
 
-        channels = []
-        for chn in range(audiofile.channels):
-            channels.append(data[chn::audiofile.channels])
+def load_buffer(data: Union[Buffer, BinaryIO]) -> Tuple[Buffer, str]:
+    """
+    Computes the hash of an audio file already in memory (the same one unique_hash gives for it on disk).
+
+    :param data: bytes of the file, or a file-like object to read them from.
+    :return: tuple of (contents, content_file_hash).
+    """
+    if hasattr(data, "read"):
+        data = data.read()
 
-        audiofile.frame_rate
+    return data, sha1(data).hexdigest().upper()
+
+
+def decode(contents: Buffer, limit: int = None, extension: str = None) -> Tuple[List[np.ndarray], int]:
+    """
+    Decodes the samples of an audio file already in memory, 16-bit PCM wav files without copying them.
+
+    :param contents: bytes of the file.
+    :param limit: number of seconds to limit.
+    :param extension: extension of the file, which tells pydub (ffmpeg) the format to decode.
+    :return: tuple of (channels, sample_rate).
+    """
+    wav = decode_wav(contents, limit)
+    if wav is not None:
+        return wav
+
+    audio_format = extension.replace(".", "") if extension else None
+    try:
+        audiofile = AudioSegment.from_file(io.BytesIO(contents), format=audio_format)
     except audioop.error:
-        _, _, audiofile = wavio.readwav(file_name)
+        return _read_with_wavio(io.BytesIO(contents), limit)
 
-        if limit:
-            audiofile = audiofile[:limit * 1000]
+    return _segment_channels(audiofile, limit)
 
-        audiofile = audiofile.T
-        audiofile = audiofile.astype(np.int16)
 
-        channels = []
-        for chn in audiofile:
-            channels.append(chn)
+def decode_wav(contents: Buffer, limit: int = None) -> Optional[Tuple[List[np.ndarray], int]]:
+    """
+    Reads a 16-bit PCM wav file without decoding nor copying it: the RIFF header is parsed and the
+    samples are exposed straight from the given buffer, so a memory mapped file is only loaded from
+    disk as the samples are used. Each channel is a strided view over the interleaved samples.
+
+    :param contents: bytes of the file.
+    :param limit: number of seconds to limit.
+    :return: tuple of (channels, sample_rate), or None if the file is not a 16-bit PCM wav file.
+    """
+    header = _parse_wav_header(contents)
+    if header is None:
+        return None
+
+    n_channels, fs, data_offset, n_frames = header
+    if limit:
+        n_frames = min(n_frames, int(limit * fs))
+
+    # read only view, the buffer stays alive as long as any channel is referenced.
+    data = np.frombuffer(contents, dtype="<i2", count=n_frames * n_channels, offset=data_offset)
+    data = data.reshape(n_frames, n_channels)
+
+    return [data[:, chn] for chn in range(n_channels)], fs
+
+
+def _segment_channels(audiofile: AudioSegment, limit: int = None) -> Tuple[List[np.ndarray], int]:
+    if limit:
+        audiofile = audiofile[:limit * 1000]
+
+    data = np.frombuffer(audiofile.raw_data, np.int16)
+
+    channels = []
+    for chn in range(audiofile.channels):
+        channels.append(data[chn::audiofile.channels])
 
-    return channels, audiofile.frame_rate, unique_hash(file_name)
+    return channels, audiofile.frame_rate
+
+
+def _read_with_wavio(file: Union[str, BinaryIO], limit: int = None) -> Tuple[List[np.ndarray], int]:
+    wav = wavio.read(file)
+    fs = wav.rate
+    data = wav.data
+
+    if limit:
+        data = data[:int(limit * fs)]
+
+    # keep the 16 most significant bits of wider samples.
+    if wav.sampwidth > 2:
+        data = data >> (8 * (wav.sampwidth - 2))
+
+    return list(data.T.astype(np.int16)), fs
+
+
+def _parse_wav_header(contents: Buffer) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Looks for the format and data chunks of a RIFF/WAVE file.
+
+    :param contents: bytes of the file.
+    :return: tuple of (channels, sample_rate, data_offset, frames) for 16-bit PCM files, None otherwise.
+    """
+    if len(contents) < 12 or contents[0:4] != b"RIFF" or contents[8:12] != b"WAVE":
+        return None
+
+    fmt = None
+    position = 12
+    while True:
+        if position + 8 > len(contents):
+            return None
+        chunk_id, chunk_size = struct.unpack_from("<4sI", contents, position)
+        position += 8
+
+        if chunk_id == b"fmt ":
+            fmt = contents[position:position + chunk_size]
+            if len(fmt) < 16:
+                return None
+        elif chunk_id == b"data":
+            break
+
+        # chunks are word aligned.
+        position += chunk_size + chunk_size % 2
+
+    if fmt is None:
+        return None
+
+    audio_format, n_channels, fs, _, block_align, bits = struct.unpack_from("<HHIIHH", fmt)
+    # WAVE_FORMAT_EXTENSIBLE stores the actual format in the first 2 bytes of the sub format GUID.
+    if audio_format == 0xFFFE and len(fmt) >= 26:
+        audio_format, = struct.unpack_from("<H", fmt, 24)
+
+    if audio_format != 1 or bits != 16 or n_channels == 0 or block_align != 2 * n_channels:
+        return None
+
+    # streamed files may leave the data size unset, in any case it can't go past the end of the file.
+    data_size = min(chunk_size, len(contents) - position)
+    return n_channels, fs, position, data_size // block_align
 
 
 def get_audio_name_from_path(file_path: str) -> str:
@@ -0,0 +1,25 @@
+"""
+Plotting helpers used to inspect the fingerprinting steps. This module imports matplotlib, so it is
+only loaded on demand (e.g. get_2D_peaks(..., plot=True)) and the services and fingerprinting workers
+never pay for it.
+"""
+import matplotlib.pyplot as plt
+import numpy as np
+
+
+def plot_peaks(arr2D: np.ndarray, freqs: np.ndarray, times: np.ndarray) -> None:
+    """
+    Shows the spectrogram with the detected peaks scattered over it.
+
+    :param arr2D: matrix representing the spectogram.
+    :param freqs: frequency of every peak.
+    :param times: time of every peak.
+    """
+    fig, ax = plt.subplots()
+    ax.imshow(arr2D)
+    ax.scatter(times, freqs)
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Frequency')
+    ax.set_title("Spectrogram")
+    plt.gca().invert_yaxis()
+    plt.show()
@@ -1,21 +1,24 @@
 import hashlib
-from operator import itemgetter
-from typing import List, Tuple
+from math import gcd
+from typing import Dict, List, Tuple
 
-import matplotlib.mlab as mlab
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.ndimage.filters import maximum_filter
-from scipy.ndimage.morphology import (binary_erosion,
-                                      generate_binary_structure,
-                                      iterate_structure)
 
 from dejavu.config.settings import (CONNECTIVITY_MASK, DEFAULT_AMP_MIN,
-                                    DEFAULT_FAN_VALUE, DEFAULT_FS,
-                                    DEFAULT_OVERLAP_RATIO, DEFAULT_WINDOW_SIZE,
-                                    FINGERPRINT_REDUCTION, MAX_HASH_TIME_DELTA,
+                                    DEFAULT_FAN_VALUE, DEFAULT_FFT_WORKERS,
+                                    DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
+                                    DEFAULT_WINDOW_SIZE, FIELD_HASH,
+                                    FIELD_OFFSET, MAX_HASH_TIME_DELTA,
                                     MIN_HASH_TIME_DELTA,
                                     PEAK_NEIGHBORHOOD_SIZE, PEAK_SORT)
+from dejavu.logic.spectrogram import specgram
+
+# Fingerprints are carried around as arrays of (hash, offset) records, the hash being the first
+# 64 bits of the sha1 digest as a signed integer so it can be stored as a BIGINT.
+FINGERPRINT_DTYPE = np.dtype([(FIELD_HASH, np.int64), (FIELD_OFFSET, np.int32)])
+
+# frequencies and time deltas are packed in 21 bits each when looking for distinct hash triples.
+_KEY_MASK = (1 << 21) - 1
 
 
 def fingerprint(channel_samples: List[int],
@@ -23,7 +26,8 @@ def fingerprint(channel_samples: List[int],
                 wsize: int = DEFAULT_WINDOW_SIZE,
                 wratio: float = DEFAULT_OVERLAP_RATIO,
                 fan_value: int = DEFAULT_FAN_VALUE,
-                amp_min: int = DEFAULT_AMP_MIN) -> List[Tuple[str, int]]:
+                amp_min: int = DEFAULT_AMP_MIN,
+                workers: int = DEFAULT_FFT_WORKERS) -> np.ndarray:
     """
     FFT the channel, log transform output, find local maxima, then return locally sensitive hashes.
 
@@ -33,18 +37,11 @@ def fingerprint(channel_samples: List[int],
     :param wratio: ratio by which each sequential window overlaps the last and the next window.
     :param fan_value: degree to which a fingerprint can be paired with its neighbors.
     :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
-    :return: a list of hashes with their corresponding offsets.
+    :param workers: number of threads used by the FFT.
+    :return: an array of FINGERPRINT_DTYPE records with the hashes and their corresponding offsets.
     """
-    # FFT the signal and extract frequency components
-    arr2D = mlab.specgram(
-        channel_samples,
-        NFFT=wsize,
-        Fs=Fs,
-        window=mlab.window_hanning,
-        noverlap=int(wsize * wratio))[0]
-
-    # Apply log transform since specgram function returns linear array. 0s are excluded to avoid np warning.
-    arr2D = 10 * np.log10(arr2D, out=np.zeros_like(arr2D), where=(arr2D != 0))
+    # FFT the signal and extract frequency components, already log transformed.
+    arr2D = specgram(channel_samples, Fs=Fs, wsize=wsize, wratio=wratio, workers=workers)
 
     local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
 
@@ -52,15 +49,40 @@ def fingerprint(channel_samples: List[int],
     return generate_hashes(local_maxima, fan_value=fan_value)
 
 
-def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP_MIN)\
-        -> List[Tuple[List[int], List[int]]]:
+def prepare_channels(channels: List[np.ndarray], Fs: int, profile: Dict[str, any]) -> Tuple[List[np.ndarray], int]:
+    """
+    Downmixes and resamples the channels of an audio as the given fingerprint profile requires.
+
+    :param channels: samples of every channel, all of them of the same length.
+    :param Fs: audio sampling rate.
+    :param profile: one of the FINGERPRINT_PROFILES.
+    :return: a tuple with the channels to fingerprint and their sampling rate.
+    """
+    if profile["mono"] and len(channels) > 1:
+        channels = [np.mean(channels, axis=0, dtype=np.float32)]
+
+    if profile["resample"] and Fs != profile["sample_rate"]:
+        # scipy.signal takes a while to import, and only catalogs with resampling profiles need it.
+        from scipy.signal import resample_poly
+
+        # polyphase filtering, which low pass filters the audio before decimating it.
+        factor = gcd(Fs, profile["sample_rate"])
+        channels = [resample_poly(np.asarray(channel, dtype=np.float32), profile["sample_rate"] // factor,
+                                  Fs // factor)
+                    for channel in channels]
+        Fs = profile["sample_rate"]
+
+    return channels, Fs
+
+
+def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP_MIN) -> np.ndarray:
     """
     Extract maximum peaks from the spectogram matrix (arr2D).
 
     :param arr2D: matrix representing the spectogram.
     :param plot: for plotting the results.
     :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
-    :return: a list composed by a list of frequencies and times.
+    :return: an array of (frequency, time) rows.
     """
     # Original code from the repo is using a morphology mask that does not consider diagonal elements
     # as neighbors (basically a diamond figure) and then applies a dilation over it, so what I'm proposing
@@ -71,86 +93,194 @@ def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP
     # In my local tests time performance of the square mask was ~3 times faster
     # respect to the diamond one, without hurting accuracy of the predictions.
     # I've made now the mask shape configurable in order to allow both ways of find maximum peaks.
-    # That being said, we generate the mask by using the following function
+    # That being said, the mask is the one generated by
     # https://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.generate_binary_structure.html
-    struct = generate_binary_structure(2, CONNECTIVITY_MASK)
+    # dilated with
+    # http://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.iterate_structure.html
+    neighborhood = _peak_neighborhood(CONNECTIVITY_MASK, PEAK_NEIGHBORHOOD_SIZE)
+
+    # find local maxima using our filter mask. The maximum over a square is separable, so in that case
+    # it is computed as a running maximum over time followed by a running maximum over frequencies.
+    if neighborhood.all():
+        local_max = _running_max(_running_max(arr2D, len(neighborhood), axis=1), len(neighborhood), axis=0)
+    else:
+        from scipy.ndimage import maximum_filter
 
-    #  And then we apply dilation using the following function
-    #  http://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.iterate_structure.html
-    #  Take into account that if PEAK_NEIGHBORHOOD_SIZE is 2 you can avoid the use of the scipy functions and just
-    #  change it by the following code:
-    #  neighborhood = np.ones((PEAK_NEIGHBORHOOD_SIZE * 2 + 1, PEAK_NEIGHBORHOOD_SIZE * 2 + 1), dtype=bool)
-    neighborhood = iterate_structure(struct, PEAK_NEIGHBORHOOD_SIZE)
+        local_max = maximum_filter(arr2D, footprint=neighborhood)
 
-    # find local maxima using our filter mask
-    local_max = maximum_filter(arr2D, footprint=neighborhood) == arr2D
+    # Boolean mask of arr2D with True at peaks, the amplitude filter is applied before extracting them.
+    detected_peaks = (local_max == arr2D) & (arr2D > amp_min)
 
-    # Applying erosion, the dejavu documentation does not talk about this step.
-    background = (arr2D == 0)
-    eroded_background = binary_erosion(background, structure=neighborhood, border_value=1)
+    # Applying erosion, the dejavu documentation does not talk about this step. The eroded background
+    # is made of 0 valued cells, which could only flip peaks over the threshold (XOR on both matrices)
+    # when amp_min is negative, so it is skipped otherwise or when there is no background at all.
+    if amp_min < 0:
+        background = (arr2D == 0)
+        if background.any():
+            from scipy.ndimage import binary_erosion
 
-    # Boolean mask of arr2D with True at peaks (applying XOR on both matrices).
-    detected_peaks = local_max != eroded_background
+            detected_peaks ^= binary_erosion(background, structure=neighborhood, border_value=1)
 
     # extract peaks
-    amps = arr2D[detected_peaks]
-    freqs, times = np.where(detected_peaks)
+    freqs_filter, times_filter = np.where(detected_peaks)
 
-    # filter peaks
-    amps = amps.flatten()
+    if plot:
+        # matplotlib is only loaded when plots are requested.
+        from dejavu.logic.diagnostics import plot_peaks
 
-    # get indices for frequency and time
-    filter_idxs = np.where(amps > amp_min)
+        plot_peaks(arr2D, freqs_filter, times_filter)
 
-    freqs_filter = freqs[filter_idxs]
-    times_filter = times[filter_idxs]
+    return np.column_stack((freqs_filter, times_filter))
 
-    if plot:
-        # scatter of the peaks
-        fig, ax = plt.subplots()
-        ax.imshow(arr2D)
-        ax.scatter(times_filter, freqs_filter)
-        ax.set_xlabel('Time')
-        ax.set_ylabel('Frequency')
-        ax.set_title("Spectrogram")
-        plt.gca().invert_yaxis()
-        plt.show()
 
-    return list(zip(freqs_filter, times_filter))
+def _peak_neighborhood(connectivity: int, size: int) -> np.ndarray:
+    """
+    Same mask as iterate_structure(generate_binary_structure(2, connectivity), size), built with numpy
+    so that scipy.ndimage is only imported for the diamond mask.
+
+    :param connectivity: 1 for a diamond mask, 2 for a square one.
+    :param size: number of cells the mask reaches from its center.
+    :return: a boolean matrix of shape (2 * size + 1, 2 * size + 1).
+    """
+    if connectivity == 2:
+        return np.ones((2 * size + 1, 2 * size + 1), dtype=bool)
 
+    from scipy.ndimage import generate_binary_structure, iterate_structure
 
-def generate_hashes(peaks: List[Tuple[int, int]], fan_value: int = DEFAULT_FAN_VALUE) -> List[Tuple[str, int]]:
+    return iterate_structure(generate_binary_structure(2, connectivity), size)
+
+
+def _running_max(arr: np.ndarray, size: int, axis: int) -> np.ndarray:
     """
-    Hash list structure:
-       sha1_hash[0:FINGERPRINT_REDUCTION]    time_offset
-        [(e05b341a9b77a51fd26, 32), ... ]
+    Maximum over a sliding window of the given size along one axis, equivalent to
+    scipy.ndimage.maximum_filter1d. Windows are doubled in width at every step, so it takes
+    log2(size) vectorized passes over the array.
+
+    :param arr: input array.
+    :param size: length of the sliding window.
+    :param axis: axis along which the window slides.
+    :return: an array of the same shape with the maximum of the window centered on each element.
+    """
+    arr = np.moveaxis(arr, axis, 0)
+    length = len(arr)
+    radius = size // 2
+
+    # padding with -inf gives the same result as the default "reflect" mode, since reflected
+    # elements are always already within the window.
+    window_max = np.full((length + size - 1,) + arr.shape[1:], -np.inf, dtype=arr.dtype)
+    window_max[radius:radius + length] = arr
+
+    width = 1
+    end = len(window_max)
+    while width < size:
+        step = min(width, size - width)
+        np.maximum(window_max[:end - step], window_max[step:end], out=window_max[:end - step])
+        end -= step
+        width += step
+
+    return np.moveaxis(window_max[:length], 0, axis)
+
+
+def generate_hashes(peaks: List[Tuple[int, int]], fan_value: int = DEFAULT_FAN_VALUE) -> np.ndarray:
+    """
+    Hash array structure (FINGERPRINT_DTYPE):
+       int64(sha1_hash[0:8])    time_offset
+        [(-2303463316327519459, 32), ... ]
+
+    All the (peak, neighbour) pairs are built at once with array operations and the
+    MIN/MAX_HASH_TIME_DELTA filter is applied as a mask. The sha1 is only computed once per distinct
+    (freq1, freq2, t_delta) triple, so the output is exactly the same as hashing every pair one by one.
 
     :param peaks: list of peak frequencies and times.
     :param fan_value: degree to which a fingerprint can be paired with its neighbors.
-    :return: a list of hashes with their corresponding offsets.
+    :return: an array of FINGERPRINT_DTYPE records with the hashes and their corresponding offsets.
     """
-    # frequencies are in the first position of the tuples
-    idx_freq = 0
-    # times are in the second position of the tuples
-    idx_time = 1
+    peaks = sort_peaks(peaks)
+    anchors, neighbours = pair_indices(len(peaks), fan_value)
+    return hash_pairs(peaks, anchors, neighbours)
+
+
+def sort_peaks(peaks: List[Tuple[int, int]]) -> np.ndarray:
+    """
+    Puts the peaks in the order used to pair them, i.e. by time when PEAK_SORT is set.
+
+    :param peaks: list of peak frequencies and times.
+    :return: an int64 array of (frequency, time) rows.
+    """
+    peaks = np.asarray(peaks, dtype=np.int64).reshape(-1, 2)
 
     if PEAK_SORT:
-        peaks.sort(key=itemgetter(1))
+        # a stable sort keeps the frequency order of peaks sharing the same time.
+        peaks = peaks[np.argsort(peaks[:, 1], kind="stable")]
+
+    return peaks
+
+
+def hash_pairs(peaks: np.ndarray, anchors: np.ndarray, neighbours: np.ndarray) -> np.ndarray:
+    """
+    Hashes the given (peak, neighbour) pairs whose time delta is within MIN/MAX_HASH_TIME_DELTA.
+
+    :param peaks: an array of (frequency, time) rows, as given by sort_peaks.
+    :param anchors: indices of the anchor peak of every pair.
+    :param neighbours: indices of the neighbour peak of every pair.
+    :return: an array of FINGERPRINT_DTYPE records with the hashes and their corresponding offsets.
+    """
+    # frequencies are in the first column and times in the second one.
+    freqs = peaks[:, 0]
+    times = peaks[:, 1]
+
+    t_delta = times[neighbours] - times[anchors]
 
-    hashes = []
-    for i in range(len(peaks)):
-        for j in range(1, fan_value):
-            if (i + j) < len(peaks):
+    in_range = (MIN_HASH_TIME_DELTA <= t_delta) & (t_delta <= MAX_HASH_TIME_DELTA)
+    anchors = anchors[in_range]
+    freq1 = freqs[anchors]
+    freq2 = freqs[neighbours[in_range]]
+    t_delta = t_delta[in_range]
 
-                freq1 = peaks[i][idx_freq]
-                freq2 = peaks[i + j][idx_freq]
-                t1 = peaks[i][idx_time]
-                t2 = peaks[i + j][idx_time]
-                t_delta = t2 - t1
+    # pack each triple in a single integer key so the distinct ones can be found in one pass.
+    keys = (freq1 << 42) | (freq2 << 21) | (t_delta - MIN_HASH_TIME_DELTA)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    unique_freq1 = unique_keys >> 42
+    unique_freq2 = (unique_keys >> 21) & _KEY_MASK
+    unique_t_delta = unique_keys & _KEY_MASK
 
-                if MIN_HASH_TIME_DELTA <= t_delta <= MAX_HASH_TIME_DELTA:
-                    h = hashlib.sha1(f"{str(freq1)}|{str(freq2)}|{str(t_delta)}".encode('utf-8'))
+    # build the "freq1|freq2|t_delta" strings for the whole array at once from lookup tables.
+    freq_strings = _int_strings(0, max(unique_freq1.max(initial=0), unique_freq2.max(initial=0)))
+    t_delta_strings = _int_strings(MIN_HASH_TIME_DELTA, MAX_HASH_TIME_DELTA)
+    hash_inputs = np.char.add(np.char.add(freq_strings[unique_freq1], b"|"), freq_strings[unique_freq2])
+    hash_inputs = np.char.add(np.char.add(hash_inputs, b"|"), t_delta_strings[unique_t_delta])
 
-                    hashes.append((h.hexdigest()[0:FINGERPRINT_REDUCTION], t1))
+    # the first 8 bytes of every digest are read back at once as big endian signed integers.
+    digests = b"".join([hashlib.sha1(value).digest()[0:8] for value in hash_inputs.tolist()])
+    unique_hashes = np.frombuffer(digests, dtype=">i8")
 
+    hashes = np.empty(len(anchors), dtype=FINGERPRINT_DTYPE)
+    hashes[FIELD_HASH] = unique_hashes[inverse]
+    hashes[FIELD_OFFSET] = times[anchors]
     return hashes
+
+
+def pair_indices(n_peaks: int, fan_value: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Builds the indices of every (peak, neighbour) pair considered for hashing, in the same order
+    a nested loop over peaks and then over neighbours would visit them.
+
+    :param n_peaks: number of peaks.
+    :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :return: a tuple with the anchor peak indices and their neighbour peak indices.
+    """
+    anchors = np.broadcast_to(np.arange(n_peaks)[:, None], (n_peaks, max(fan_value - 1, 0)))
+    neighbours = anchors + np.arange(1, max(fan_value, 1))
+    valid = neighbours < n_peaks
+    return anchors[valid], neighbours[valid]
+
+
+def _int_strings(start: int, stop: int) -> np.ndarray:
+    """
+    Lookup table with the utf-8 decimal representation of every integer in [start, stop].
+
+    :param start: first integer of the table.
+    :param stop: last integer of the table.
+    :return: an array of bytes where position i holds the representation of start + i.
+    """
+    return np.array([str(value).encode('utf-8') for value in range(start, stop + 1)], dtype=bytes)
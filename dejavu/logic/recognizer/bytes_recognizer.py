@@ -0,0 +1,74 @@
+from time import time
+from typing import BinaryIO, Dict, Union
+
+import dejavu.logic.decoder as decoder
+from dejavu.base_classes.base_recognizer import BaseRecognizer
+from dejavu.config.settings import (ALIGN_TIME, FINGERPRINT_TIME, QUERY_TIME,
+                                    RESULTS, TOTAL_TIME)
+
+
+class BytesRecognizer(BaseRecognizer):
+    """
+    Recognizes audio files that are already in memory (e.g. uploads), without writing them to disk.
+    16-bit PCM wav samples are read straight from the given buffer.
+    """
+    def __init__(self, dejavu):
+        super().__init__(dejavu)
+
+    def recognize_bytes(self, data: Union[decoder.Buffer, BinaryIO], extension: str = None) -> Dict[str, any]:
+        """
+        :param data: bytes of the audio file, or a file-like object to read them from.
+        :param extension: extension of the file, which tells pydub (ffmpeg) the format of non wav files.
+        :return: the recognition results.
+        """
+        if hasattr(data, "read"):
+            data = data.read()
+
+        channels, self.Fs = decoder.decode(data, self.dejavu.limit, extension=extension)
+
+        t = time()
+        matches, fingerprint_time, query_time, align_time = self._recognize(*channels)
+        t = time() - t
+
+        results = {
+            TOTAL_TIME: t,
+            FINGERPRINT_TIME: fingerprint_time,
+            QUERY_TIME: query_time,
+            ALIGN_TIME: align_time,
+            RESULTS: matches
+        }
+
+        return results
+
+    async def recognize_bytes_async(self, data: Union[decoder.Buffer, BinaryIO],
+                                    extension: str = None) -> Dict[str, any]:
+        """
+        Same as recognize_bytes, without blocking the event loop.
+
+        :param data: bytes of the audio file, or a file-like object to read them from.
+        :param extension: extension of the file, which tells pydub (ffmpeg) the format of non wav files.
+        :return: the recognition results.
+        """
+        if hasattr(data, "read"):
+            data = data.read()
+
+        t = time()
+        matches, fingerprint_time, query_time, align_time = await self._recognize_async(
+            self.dejavu.get_buffer_fingerprints, data, None, self.dejavu.limit, extension=extension)
+        t = time() - t
+
+        results = {
+            TOTAL_TIME: t,
+            FINGERPRINT_TIME: fingerprint_time,
+            QUERY_TIME: query_time,
+            ALIGN_TIME: align_time,
+            RESULTS: matches
+        }
+
+        return results
+
+    def recognize(self, data: Union[decoder.Buffer, BinaryIO], extension: str = None) -> Dict[str, any]:
+        return self.recognize_bytes(data, extension)
+
+    async def recognize_async(self, data: Union[decoder.Buffer, BinaryIO], extension: str = None) -> Dict[str, any]:
+        return await self.recognize_bytes_async(data, extension)
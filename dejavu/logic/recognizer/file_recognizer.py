@@ -28,5 +28,30 @@ class FileRecognizer(BaseRecognizer):
 
         return results
 
+    async def recognize_file_async(self, filename: str) -> Dict[str, any]:
+        """
+        Same as recognize_file, without blocking the event loop.
+
+        :param filename: path to the file.
+        :return: the recognition results.
+        """
+        t = time()
+        matches, fingerprint_time, query_time, align_time = await self._recognize_async(
+            self.dejavu.get_file_fingerprints, filename, self.dejavu.limit)
+        t = time() - t
+
+        results = {
+            TOTAL_TIME: t,
+            FINGERPRINT_TIME: fingerprint_time,
+            QUERY_TIME: query_time,
+            ALIGN_TIME: align_time,
+            RESULTS: matches
+        }
+
+        return results
+
     def recognize(self, filename: str) -> Dict[str, any]:
         return self.recognize_file(filename)
+
+    async def recognize_async(self, filename: str) -> Dict[str, any]:
+        return await self.recognize_file_async(filename)
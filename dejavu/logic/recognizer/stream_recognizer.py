@@ -0,0 +1,248 @@
+import asyncio
+from collections import deque
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from dejavu.base_classes.base_recognizer import BaseRecognizer
+from dejavu.config.settings import (STREAM_CONFIDENCE, STREAM_MIN_MATCHES,
+                                    STREAM_SECS, STREAM_STEP_SECONDS,
+                                    STREAM_WINDOW_SECONDS)
+from dejavu.logic.alignment import best_offsets
+from dejavu.logic.fingerprint import FINGERPRINT_DTYPE
+from dejavu.logic.streaming import StreamingFingerprinter, StreamingResampler
+
+
+class StreamRecognizer(BaseRecognizer):
+    """
+    Recognizes a live stream of raw 16-bit PCM (e.g. a radio channel) as it arrives, instead of cutting it
+    into clips. The stream is fingerprinted incrementally, only the hashes of the last step are looked up,
+    and their matches are aligned together with the ones of the last window seconds. A song is reported
+    once, when its best offset in the window crosses the thresholds, and again only for a later airing.
+
+    Memory is bounded by the window: the fingerprinters keep the state they need to continue, and the
+    matches of the steps that left the window are dropped.
+
+    # Use as
+    recognizer = StreamRecognizer(djv)
+    recognizer.start(44100, 2)
+    for data in chunks:
+        detections = recognizer.feed(data)
+        ...
+    detections = recognizer.flush()
+    """
+    def __init__(self, dejavu):
+        super().__init__(dejavu)
+        self.channels = 1
+        self.window = STREAM_WINDOW_SECONDS
+        self.step = STREAM_STEP_SECONDS
+        self.confidence = STREAM_CONFIDENCE
+        self.min_matches = STREAM_MIN_MATCHES
+
+    def start(self, samplerate: int, channels: int, window: float = STREAM_WINDOW_SECONDS,
+              step: float = STREAM_STEP_SECONDS, confidence: float = STREAM_CONFIDENCE,
+              min_matches: int = STREAM_MIN_MATCHES) -> None:
+        """
+        Starts a new stream.
+
+        :param samplerate: sampling rate of the stream.
+        :param channels: number of interleaved channels of the stream.
+        :param window: seconds of audio the matches are aligned over.
+        :param step: seconds of audio fingerprinted and looked up at a time.
+        :param confidence: minimum ratio of the hashes of the window matched on the best offset of a song.
+        :param min_matches: minimum number of hashes of the window matched on the best offset of a song.
+        """
+        if samplerate <= 0 or channels <= 0:
+            raise ValueError("The sampling rate and the number of channels must be positive.")
+
+        self.Fs = samplerate
+        self.channels = channels
+        self.window = window
+        self.step = step
+        self.confidence = confidence
+        self.min_matches = min_matches
+
+        profile = self.dejavu.profile
+        fingerprint_channels = 1 if profile["mono"] else channels
+        fingerprint_fs = samplerate
+        self.resamplers = None
+        if profile["resample"] and samplerate != profile["sample_rate"]:
+            fingerprint_fs = profile["sample_rate"]
+            self.resamplers = [StreamingResampler(samplerate, fingerprint_fs) for _ in range(fingerprint_channels)]
+        self.fingerprinters = [StreamingFingerprinter(Fs=fingerprint_fs, wsize=profile["window_size"],
+                                                      wratio=profile["overlap_ratio"])
+                               for _ in range(fingerprint_channels)]
+
+        # bytes of an incomplete frame and samples of an incomplete step, waiting for the next data.
+        self._partial = b""
+        self._pending = np.empty((0, channels), dtype=np.int16)
+        self.total_samples = 0
+
+        # (stream seconds, number of hashes, (song id, offset difference) matches) of each step in the window.
+        self._steps = deque()
+        # song id -> [offset difference, stream seconds] of the songs found in the window, as last seen.
+        self._detected = {}
+
+    def feed(self, data: bytes) -> List[Dict[str, any]]:
+        """
+        Adds interleaved little-endian 16-bit PCM data to the stream.
+
+        :param data: next bytes of the stream, frames may be split across calls.
+        :return: a list of dictionaries with the match information of the songs found.
+        """
+        detections = []
+        for samples in self._steps_of(data):
+            hashes = self._fingerprint(samples)
+            matches, _, _ = self.dejavu.find_matches(hashes)
+            song_ids, offsets, counts, queried_hashes = self._detect(len(hashes), matches)
+            detections.extend(self.__detections(self.dejavu.get_songs_result(
+                song_ids, offsets, dict(zip(song_ids.tolist(), counts.tolist())), queried_hashes)))
+        return detections
+
+    async def feed_async(self, data: bytes) -> List[Dict[str, any]]:
+        """
+        Same as feed, without blocking the event loop. The stream is fingerprinted in a thread, its state
+        is kept by this instance, and the database is queried asynchronously.
+
+        :param data: next bytes of the stream, frames may be split across calls.
+        :return: a list of dictionaries with the match information of the songs found.
+        """
+        detections = []
+        for samples in self._steps_of(data):
+            hashes = await asyncio.to_thread(self._fingerprint, samples)
+            matches, _, _ = await self.dejavu.find_matches_async(hashes)
+            song_ids, offsets, counts, queried_hashes = self._detect(len(hashes), matches)
+            detections.extend(self.__detections(await self.dejavu.get_songs_result_async(
+                song_ids, offsets, dict(zip(song_ids.tolist(), counts.tolist())), queried_hashes)))
+        return detections
+
+    def flush(self) -> List[Dict[str, any]]:
+        """
+        Ends the stream, matching the audio that was waiting for a whole step.
+
+        :return: a list of dictionaries with the match information of the songs found.
+        """
+        samples, self._pending = self._pending, self._pending[:0]
+        hashes = self._fingerprint(samples, last=True)
+        matches, _, _ = self.dejavu.find_matches(hashes)
+        song_ids, offsets, counts, queried_hashes = self._detect(len(hashes), matches)
+        return self.__detections(self.dejavu.get_songs_result(
+            song_ids, offsets, dict(zip(song_ids.tolist(), counts.tolist())), queried_hashes))
+
+    async def flush_async(self) -> List[Dict[str, any]]:
+        """
+        Same as flush, without blocking the event loop.
+
+        :return: a list of dictionaries with the match information of the songs found.
+        """
+        samples, self._pending = self._pending, self._pending[:0]
+        hashes = await asyncio.to_thread(self._fingerprint, samples, True)
+        matches, _, _ = await self.dejavu.find_matches_async(hashes)
+        song_ids, offsets, counts, queried_hashes = self._detect(len(hashes), matches)
+        return self.__detections(await self.dejavu.get_songs_result_async(
+            song_ids, offsets, dict(zip(song_ids.tolist(), counts.tolist())), queried_hashes))
+
+    def _steps_of(self, data: bytes) -> Iterable[np.ndarray]:
+        """
+        Splits the stream into steps.
+
+        :param data: next bytes of the stream.
+        :return: the (samples, channels) int16 arrays of the steps completed by the data.
+        """
+        data = self._partial + data
+        frame_size = 2 * self.channels
+        complete = len(data) - len(data) % frame_size
+        self._partial = data[complete:]
+
+        frames = np.frombuffer(data[:complete], dtype="<i2").reshape(-1, self.channels)
+        self._pending = np.concatenate((self._pending, frames))
+
+        step_samples = max(int(self.step * self.Fs), 1)
+        while len(self._pending) >= step_samples:
+            samples, self._pending = self._pending[:step_samples], self._pending[step_samples:]
+            yield samples
+
+    def _fingerprint(self, samples: np.ndarray, last: bool = False) -> np.ndarray:
+        """
+        Fingerprints the next samples of the stream, prepared as prepare_channels() does for a whole audio.
+
+        :param samples: (samples, channels) array with the next samples of the stream.
+        :param last: whether the samples end the stream.
+        :return: an array of FINGERPRINT_DTYPE records with the hashes completed, offsets are counted from
+        the start of the stream.
+        """
+        self.total_samples += len(samples)
+
+        channels = samples.T
+        if len(self.fingerprinters) == 1 and self.channels > 1:
+            channels = [np.mean(channels, axis=0, dtype=np.float32)]
+        if self.resamplers is not None:
+            channels = [np.concatenate((resampler.feed(channel), resampler.flush())) if last else
+                        resampler.feed(channel)
+                        for resampler, channel in zip(self.resamplers, channels)]
+
+        fingerprints = [np.empty(0, dtype=FINGERPRINT_DTYPE)]
+        for fingerprinter, channel in zip(self.fingerprinters, channels):
+            fingerprints.append(fingerprinter.feed(channel))
+            if last:
+                fingerprints.append(fingerprinter.flush())
+
+        # to remove possible duplicated fingerprints across channels.
+        return np.unique(np.concatenate(fingerprints))
+
+    def _detect(self, queried_hashes: int, matches: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+        """
+        Adds the matches of the last step to the window and finds the songs crossing the thresholds.
+
+        :param queried_hashes: number of hashes looked up for the step.
+        :param matches: (song id, offset difference) matches of the step.
+        :return: a tuple with the ids, the offsets at the current end of the stream, and the number of hashes
+        matched on their best offset, of the songs found since the last step, and the number of hashes
+        looked up for the window.
+        """
+        now = self.total_samples / self.Fs
+        self._steps.append((now, queried_hashes, np.asarray(matches, dtype=np.int64).reshape(-1, 2)))
+        while self._steps[0][0] <= now - self.window:
+            self._steps.popleft()
+
+        window_hashes = sum(step[1] for step in self._steps)
+        window_matches = np.concatenate([step[2] for step in self._steps])
+        song_ids, offsets, counts = best_offsets(window_matches[:, 0], window_matches[:, 1], len(window_matches))
+
+        found = (counts >= self.min_matches) & (counts >= self.confidence * window_hashes)
+        new = np.zeros(len(song_ids), dtype=bool)
+        for index, song_id, offset in zip(np.flatnonzero(found).tolist(), song_ids[found].tolist(),
+                                          offsets[found].tolist()):
+            # the best offset of an airing may move by a frame from a step to the next.
+            new[index] = song_id not in self._detected or abs(self._detected[song_id][0] - offset) > 1
+            self._detected[song_id] = [offset, now]
+
+        # songs not found for a whole window can be found again, e.g. when they air again.
+        self._detected = {song_id: seen for song_id, seen in self._detected.items() if seen[1] > now - self.window}
+
+        # offsets in the song of the last frame fingerprinted.
+        fingerprinter = self.fingerprinters[0]
+        end = fingerprinter.total_samples // fingerprinter.hop
+        return song_ids[new], offsets[new] + end, counts[new], window_hashes
+
+    def __detections(self, songs: List[Dict[str, any]]) -> List[Dict[str, any]]:
+        for song in songs:
+            song[STREAM_SECS] = round(self.total_samples / self.Fs, 5)
+        return songs
+
+    def recognize(self, chunks: Iterable[bytes], samplerate: int, channels: int) -> List[Dict[str, any]]:
+        """
+        Recognizes a whole stream.
+
+        :param chunks: bytes of the stream, as interleaved little-endian 16-bit PCM.
+        :param samplerate: sampling rate of the stream.
+        :param channels: number of interleaved channels of the stream.
+        :return: a list of dictionaries with the match information of the songs found, in the order they
+        were found.
+        """
+        self.start(samplerate, channels)
+        detections = []
+        for data in chunks:
+            detections.extend(self.feed(data))
+        detections.extend(self.flush())
+        return detections
@@ -0,0 +1,98 @@
+from functools import lru_cache
+from typing import List, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft
+
+from dejavu.config.settings import (DEFAULT_FFT_WORKERS, DEFAULT_FS,
+                                    DEFAULT_OVERLAP_RATIO, DEFAULT_WINDOW_SIZE)
+
+# Number of frames transformed at once, it bounds the temporary float32/complex64 buffers
+# to a few tens of MB regardless of the length of the audio.
+FRAMES_PER_BLOCK = 1024
+
+
+@lru_cache(maxsize=16)
+def psd_window(wsize: int, Fs: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Hanning window and power spectral density scaling for a given window size and sampling rate.
+    Both are cached, so they are computed only once per configuration.
+
+    The scaling is the one applied by matplotlib.mlab.specgram: one-sided spectrum (every bin but DC
+    and Nyquist doubled), divided by the sampling rate and by the energy of the window.
+
+    :param wsize: FFT windows size.
+    :param Fs: audio sampling rate.
+    :return: a tuple with the float32 window and the float32 per-frequency scaling.
+    """
+    window = np.hanning(wsize)
+
+    scaling = np.full(wsize // 2 + 1, 1 / (Fs * (window ** 2).sum()))
+    # if we have an even window size the last bin is the Nyquist one, so we don't scale it.
+    scaling[1:None if wsize % 2 else -1] *= 2
+
+    window = window.astype(np.float32)
+    scaling = scaling.astype(np.float32)
+    window.flags.writeable = False
+    scaling.flags.writeable = False
+    return window, scaling
+
+
+def specgram(channel_samples: List[int],
+             Fs: int = DEFAULT_FS,
+             wsize: int = DEFAULT_WINDOW_SIZE,
+             wratio: float = DEFAULT_OVERLAP_RATIO,
+             workers: int = DEFAULT_FFT_WORKERS) -> np.ndarray:
+    """
+    Log-magnitude spectrogram in dB, equivalent to 10 * log10(mlab.specgram(...)) with a Hanning window
+    but computed in float32. Frames are strided views over the samples and are transformed in blocks,
+    so the only full size buffer is the returned spectrogram itself.
+
+    :param channel_samples: channel samples.
+    :param Fs: audio sampling rate.
+    :param wsize: FFT windows size.
+    :param wratio: ratio by which each sequential window overlaps the last and the next window.
+    :param workers: number of threads used by scipy.fft, None means a single one.
+    :return: a float32 matrix of shape (frequencies, times); bins with no energy are left as 0.
+    """
+    samples = np.asarray(channel_samples)
+
+    # zero pad the samples up to wsize if they are shorter, as mlab does.
+    if len(samples) < wsize:
+        samples = np.concatenate((samples, np.zeros(wsize - len(samples), dtype=samples.dtype)))
+
+    hop = wsize - int(wsize * wratio)
+    frames = sliding_window_view(samples, wsize)[::hop]
+
+    return log_power_spectrum(frames, Fs=Fs, workers=workers)
+
+
+def log_power_spectrum(frames: np.ndarray, Fs: int = DEFAULT_FS, workers: int = DEFAULT_FFT_WORKERS) -> np.ndarray:
+    """
+    Windowed power spectral density in dB of the given frames, transformed in blocks of FRAMES_PER_BLOCK.
+
+    :param frames: matrix of shape (number of frames, window size), usually a strided view over the samples.
+    :param Fs: audio sampling rate.
+    :param workers: number of threads used by scipy.fft, None means a single one.
+    :return: a float32 matrix of shape (frequencies, number of frames); bins with no energy are left as 0.
+    """
+    n_frames, wsize = frames.shape
+    window, scaling = psd_window(wsize, Fs)
+
+    arr2D = np.empty((wsize // 2 + 1, n_frames), dtype=np.float32)
+    for start in range(0, n_frames, FRAMES_PER_BLOCK):
+        block = frames[start:start + FRAMES_PER_BLOCK].astype(np.float32)
+        block *= window
+        spectrum = fft.rfft(block, axis=1, workers=workers)
+
+        power = np.square(spectrum.real)
+        power += np.square(spectrum.imag)
+        power *= scaling
+        arr2D[:, start:start + len(block)] = power.T
+
+    # Apply log transform in place. 0s are excluded to avoid np warning and stay as 0.
+    np.log10(arr2D, out=arr2D, where=(arr2D != 0))
+    arr2D *= 10
+
+    return arr2D
@@ -0,0 +1,226 @@
+from math import gcd
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from dejavu.config.settings import (DEFAULT_AMP_MIN, DEFAULT_FAN_VALUE,
+                                    DEFAULT_FFT_WORKERS, DEFAULT_FS,
+                                    DEFAULT_OVERLAP_RATIO, DEFAULT_WINDOW_SIZE,
+                                    MAX_HASH_TIME_DELTA,
+                                    PEAK_NEIGHBORHOOD_SIZE, PEAK_SORT)
+from dejavu.logic.fingerprint import (FINGERPRINT_DTYPE, get_2D_peaks,
+                                      hash_pairs, pair_indices, sort_peaks)
+from dejavu.logic.spectrogram import log_power_spectrum
+
+
+class StreamingFingerprinter:
+    """
+    Incremental version of fingerprint() for audio that arrives in chunks, e.g. a live stream or a
+    recording too long to be held in memory as a whole spectrogram.
+
+    Only the state needed to continue is kept between chunks: the samples of the window in progress,
+    the spectrogram columns within PEAK_NEIGHBORHOOD_SIZE of the columns still to be searched for peaks,
+    and the last peaks that can still be paired with peaks to come. The hashes produced for a whole
+    stream are the same ones fingerprint() produces for the concatenated samples (the order in which
+    they come out differs).
+
+    # Use as
+    fingerprinter = StreamingFingerprinter(Fs=fs)
+    for chunk in chunks:
+        hashes = fingerprinter.feed(chunk)
+        ...
+    hashes = fingerprinter.flush()
+    """
+    def __init__(self,
+                 Fs: int = DEFAULT_FS,
+                 wsize: int = DEFAULT_WINDOW_SIZE,
+                 wratio: float = DEFAULT_OVERLAP_RATIO,
+                 fan_value: int = DEFAULT_FAN_VALUE,
+                 amp_min: int = DEFAULT_AMP_MIN,
+                 workers: int = DEFAULT_FFT_WORKERS):
+        """
+        :param Fs: audio sampling rate.
+        :param wsize: FFT windows size.
+        :param wratio: ratio by which each sequential window overlaps the last and the next window.
+        :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+        :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
+        :param workers: number of threads used by the FFT.
+        """
+        # peaks can only be paired as they arrive if they are paired in time order.
+        if not PEAK_SORT:
+            raise ValueError("Streaming fingerprinting requires PEAK_SORT to be enabled.")
+
+        self.Fs = Fs
+        self.wsize = wsize
+        self.hop = wsize - int(wsize * wratio)
+        self.fan_value = fan_value
+        self.amp_min = amp_min
+        self.workers = workers
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Drops any state, the next sample fed is considered the start of a new stream.
+        """
+        self.total_samples = 0
+        # samples from the start of the next window on.
+        self._samples = np.empty(0, dtype=np.float32)
+        # spectrogram columns still needed, the first one being column number self._columns_start.
+        self._columns = np.empty((self.wsize // 2 + 1, 0), dtype=np.float32)
+        self._columns_start = 0
+        # first column not searched for peaks yet.
+        self._next_column = 0
+        # last (frequency, time) peaks, which can still be paired with upcoming ones.
+        self._peaks = np.empty((0, 2), dtype=np.int64)
+
+    def feed(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Adds a chunk of samples to the stream.
+
+        :param samples: next samples of the channel.
+        :return: an array of FINGERPRINT_DTYPE records with the hashes that could be completed, offsets
+        are counted from the start of the stream.
+        """
+        samples = np.asarray(samples, dtype=np.float32)
+        self.total_samples += len(samples)
+        self._samples = np.concatenate((self._samples, samples))
+
+        if len(self._samples) >= self.wsize:
+            frames = sliding_window_view(self._samples, self.wsize)[::self.hop]
+            columns = log_power_spectrum(frames, Fs=self.Fs, workers=self.workers)
+            self._columns = np.concatenate((self._columns, columns), axis=1)
+            self._samples = self._samples[len(frames) * self.hop:]
+
+        # columns closer than PEAK_NEIGHBORHOOD_SIZE to the last one still depend on upcoming columns.
+        return self._extract_hashes(self._columns_start + self._columns.shape[1] - PEAK_NEIGHBORHOOD_SIZE)
+
+    def flush(self) -> np.ndarray:
+        """
+        Ends the stream, returning the hashes that were waiting for more audio, and resets the state.
+
+        :return: an array of FINGERPRINT_DTYPE records with the remaining hashes.
+        """
+        # as fingerprint() does, a stream shorter than a window is zero padded up to a single window.
+        if 0 < self.total_samples < self.wsize:
+            self.feed(np.zeros(self.wsize - self.total_samples, dtype=np.float32))
+
+        hashes = self._extract_hashes(self._columns_start + self._columns.shape[1])
+        self.reset()
+        return hashes
+
+    def _extract_hashes(self, stop: int) -> np.ndarray:
+        """
+        Finds the peaks of the columns up to the given one and hashes every pair they complete.
+
+        :param stop: column before which peaks are final.
+        :return: an array of FINGERPRINT_DTYPE records with the new hashes.
+        """
+        if stop <= self._next_column:
+            return np.empty(0, dtype=FINGERPRINT_DTYPE)
+
+        # the kept columns reach PEAK_NEIGHBORHOOD_SIZE back, so peaks from self._next_column on
+        # see the same neighbourhood they would see in the whole spectrogram.
+        peaks = np.asarray(get_2D_peaks(self._columns, amp_min=self.amp_min), dtype=np.int64).reshape(-1, 2)
+        peaks[:, 1] += self._columns_start
+        peaks = sort_peaks(peaks[(self._next_column <= peaks[:, 1]) & (peaks[:, 1] < stop)])
+
+        # only the pairs having a new peak as neighbour were not hashed before.
+        peaks = np.concatenate((self._peaks, peaks))
+        anchors, neighbours = pair_indices(len(peaks), self.fan_value)
+        is_new = neighbours >= len(self._peaks)
+        hashes = hash_pairs(peaks, anchors[is_new], neighbours[is_new])
+
+        # a peak can be paired with the next fan_value - 1 peaks as long as they are close enough in time.
+        self._peaks = peaks[max(len(peaks) - self.fan_value + 1, 0):]
+        self._peaks = self._peaks[self._peaks[:, 1] >= stop - MAX_HASH_TIME_DELTA]
+
+        columns_start = max(stop - PEAK_NEIGHBORHOOD_SIZE, 0)
+        self._columns = self._columns[:, columns_start - self._columns_start:]
+        self._columns_start = columns_start
+        self._next_column = stop
+
+        return hashes
+
+
+class StreamingResampler:
+    """
+    Incremental version of the resampling of prepare_channels() for audio that arrives in chunks. The
+    samples produced for a whole stream are the ones resample_poly() gives for the concatenated samples,
+    up to rounding.
+
+    Each output sample only depends on the input samples within the reach of the polyphase filter, so
+    every chunk is resampled together with the last few blocks of samples before it, and the output
+    samples that still depend on upcoming ones are held back until the next chunk.
+
+    # Use as
+    resampler = StreamingResampler(44100, 11025)
+    for chunk in chunks:
+        samples = resampler.feed(chunk)
+        ...
+    samples = resampler.flush()
+    """
+    def __init__(self, Fs: int, target_Fs: int):
+        """
+        :param Fs: sampling rate of the stream.
+        :param target_Fs: sampling rate to resample the stream to.
+        """
+        factor = gcd(Fs, target_Fs)
+        self.up = target_Fs // factor
+        self.down = Fs // factor
+
+        # input samples are handled in blocks of self.down samples, which give self.up output samples each.
+        # resample_poly() uses a filter of 10 * max(up, down) taps on each side, at the upsampled rate.
+        reach = 10 * max(self.up, self.down) / self.up
+        self._context = int(np.ceil(reach / self.down)) + 1
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Drops any state, the next sample fed is considered the start of a new stream.
+        """
+        # input samples from the start of block self._start on.
+        self._samples = np.empty(0, dtype=np.float32)
+        self._start = 0
+        # first block whose output was not returned yet.
+        self._next_block = 0
+
+    def feed(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Adds a chunk of samples to the stream.
+
+        :param samples: next samples of the channel.
+        :return: the resampled samples that could be completed.
+        """
+        self._samples = np.concatenate((self._samples, np.asarray(samples, dtype=np.float32)))
+
+        # blocks closer than self._context blocks to the last sample still depend on upcoming samples.
+        stop = self._start + len(self._samples) // self.down - self._context
+        if stop <= self._next_block:
+            return np.empty(0, dtype=np.float32)
+
+        resampled = self._resample()[(self._next_block - self._start) * self.up:(stop - self._start) * self.up]
+        self._next_block = stop
+
+        # the blocks kept before the next one reach as far back as its filter does.
+        start = max(stop - self._context, self._start)
+        self._samples = self._samples[(start - self._start) * self.down:]
+        self._start = start
+
+        return resampled
+
+    def flush(self) -> np.ndarray:
+        """
+        Ends the stream, returning the samples that were waiting for more audio, and resets the state.
+
+        :return: the remaining resampled samples.
+        """
+        resampled = self._resample()[(self._next_block - self._start) * self.up:] if len(self._samples) else \
+            np.empty(0, dtype=np.float32)
+        self.reset()
+        return resampled
+
+    def _resample(self) -> np.ndarray:
+        # scipy.signal takes a while to import, as in prepare_channels().
+        from scipy.signal import resample_poly
+
+        return resample_poly(self._samples, self.up, self.down).astype(np.float32)
@@ -0,0 +1,37 @@
+"""
+Converts an existing catalog from the former hexadecimal fingerprint format (BYTEA/BINARY(10) hash column)
+into the 64 bits integer one (BIGINT hash column).
+
+Usage:
+    python -m dejavu.migrate --config dejavu.cnf
+"""
+import argparse
+import json
+
+from dejavu.base_classes.base_database import get_database
+
+
+def migrate(config: dict) -> bool:
+    """
+    Migrates the fingerprints table of the database described by the given dejavu config.
+
+    :param config: dejavu configuration dictionary.
+    :return: True if the table was migrated, False if it was already in the integer format.
+    """
+    db_cls = get_database(config.get("database_type", "mysql").lower())
+    db = db_cls(**config.get("database", {}))
+    return db.migrate_fingerprints()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migrates a dejavu catalog to 64 bits integer fingerprints.")
+    parser.add_argument("-c", "--config", required=True, help="path to the dejavu JSON config file.")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    if migrate(config):
+        print("Fingerprints table migrated to the integer hash format.")
+    else:
+        print("Fingerprints table already uses the integer hash format, nothing to do.")
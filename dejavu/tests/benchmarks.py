@@ -0,0 +1,566 @@
+"""
+Micro-benchmarks for the fingerprinting and matching hot paths.
+
+Run them from the repository root, i.e.:
+    python -m dejavu.tests.benchmarks generate_hashes --minutes 60 --fan-value 15
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import wave
+from itertools import groupby
+from time import perf_counter
+from typing import List
+
+import numpy as np
+
+from dejavu.base_classes.base_database import get_database
+from dejavu.base_classes.common_database import CommonDatabase
+from dejavu.config.settings import (CONNECTIVITY_MASK, DEFAULT_AMP_MIN,
+                                    DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
+                                    DEFAULT_WINDOW_SIZE, FIELD_FINGERPRINTED,
+                                    FIELD_HASH, FIELD_OFFSET, FIELD_SONG_ID,
+                                    FIELD_SONGNAME, FINGERPRINTS_TABLENAME,
+                                    MAX_HASH_TIME_DELTA, MIN_HASH_TIME_DELTA,
+                                    PEAK_NEIGHBORHOOD_SIZE, PEAK_SORT,
+                                    SONGS_TABLENAME)
+from dejavu.logic.alignment import best_offsets
+from dejavu.logic.fingerprint import (FINGERPRINT_DTYPE, generate_hashes,
+                                      get_2D_peaks)
+from dejavu.logic.spectrogram import specgram
+from dejavu.tests.test_fingerprint import legacy_as_int, legacy_generate_hashes
+
+
+def timeit(func, *args, repeat: int = 3, **kwargs):
+    """
+    Runs the given function several times and keeps the best wall time.
+
+    :param func: function to benchmark.
+    :param repeat: number of runs.
+    :return: a tuple with the best time in seconds and the result of the last run.
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        t = perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, perf_counter() - t)
+    return best, result
+
+
+def synthetic_peaks(minutes: float, peaks_per_second: int = 30, seed: int = 0) -> np.ndarray:
+    """
+    Generates random spectrogram peaks with a density similar to real broadcast audio.
+
+    :param minutes: length of the simulated clip.
+    :param peaks_per_second: average number of peaks per second of audio.
+    :param seed: random seed.
+    :return: an array of (frequency, time) rows.
+    """
+    rng = np.random.default_rng(seed)
+    frames_per_second = DEFAULT_FS / (DEFAULT_WINDOW_SIZE - int(DEFAULT_WINDOW_SIZE * DEFAULT_OVERLAP_RATIO))
+    n_frames = int(minutes * 60 * frames_per_second)
+    n_peaks = int(minutes * 60 * peaks_per_second)
+    freqs = rng.integers(0, DEFAULT_WINDOW_SIZE // 2 + 1, n_peaks)
+    times = rng.integers(0, n_frames, n_peaks)
+    return np.column_stack((freqs, times))
+
+
+def synthetic_audio(minutes: float, Fs: int = DEFAULT_FS, seed: int = 0) -> np.ndarray:
+    """
+    Generates a mono int16 signal made of short random tones over a noise floor.
+
+    :param minutes: length of the clip.
+    :param Fs: sampling rate.
+    :param seed: random seed.
+    :return: the generated samples.
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = int(minutes * 60 * Fs)
+    samples = rng.normal(0, 0.05, n_samples)
+    tone_length = Fs // 4
+    t = np.arange(tone_length) / Fs
+    for start in range(0, n_samples - tone_length, tone_length):
+        samples[start:start + tone_length] += np.sin(2 * np.pi * rng.uniform(100, 5000) * t)
+    samples *= 32767 * 0.8 / np.abs(samples).max()
+    return samples.astype(np.int16)
+
+
+def benchmark_generate_hashes(minutes: float = 60, fan_value: int = 15, repeat: int = 1) -> None:
+    peaks = synthetic_peaks(minutes)
+    print(f"generate_hashes: {len(peaks)} peaks ({minutes} min), fan_value={fan_value}")
+
+    legacy_time, legacy_hashes = timeit(legacy_generate_hashes, peaks.tolist(), fan_value, repeat=repeat)
+    print(f"  legacy loop: {legacy_time:.3f}s ({len(legacy_hashes)} hashes)")
+
+    vector_time, hashes = timeit(generate_hashes, peaks, fan_value, repeat=repeat)
+    print(f"  vectorized:  {vector_time:.3f}s ({len(hashes)} hashes)")
+    print(f"  speedup:     {legacy_time / vector_time:.1f}x, "
+          f"identical output: {hashes.tolist() == legacy_as_int(legacy_hashes)}")
+
+
+def mlab_specgram(samples: np.ndarray, Fs: int = DEFAULT_FS, wsize: int = DEFAULT_WINDOW_SIZE,
+                  wratio: float = DEFAULT_OVERLAP_RATIO) -> np.ndarray:
+    """
+    float64 matplotlib spectrogram used before the dedicated engine, kept as a baseline.
+    """
+    import matplotlib.mlab as mlab
+
+    arr2D = mlab.specgram(samples, NFFT=wsize, Fs=Fs, window=mlab.window_hanning, noverlap=int(wsize * wratio))[0]
+    return 10 * np.log10(arr2D, out=np.zeros_like(arr2D), where=(arr2D != 0))
+
+
+def benchmark_specgram(minutes: float = 5, repeat: int = 3, workers: int = None) -> None:
+    samples = synthetic_audio(minutes)
+    print(f"specgram: {len(samples)} samples ({minutes} min), window={DEFAULT_WINDOW_SIZE}, workers={workers}")
+
+    mlab_time, mlab_arr2D = timeit(mlab_specgram, samples, repeat=repeat)
+    print(f"  mlab float64:   {mlab_time:.3f}s ({mlab_arr2D.nbytes / 2 ** 20:.0f} MB)")
+
+    engine_time, arr2D = timeit(specgram, samples, workers=workers, repeat=repeat)
+    print(f"  engine float32: {engine_time:.3f}s ({arr2D.nbytes / 2 ** 20:.0f} MB)")
+
+    same_peaks = np.array_equal(get_2D_peaks(mlab_arr2D), get_2D_peaks(arr2D))
+    print(f"  speedup:        {mlab_time / engine_time:.1f}x, identical peaks: {same_peaks}")
+
+
+def legacy_get_2D_peaks(arr2D: np.ndarray, amp_min: int = DEFAULT_AMP_MIN) -> np.ndarray:
+    """
+    Generic footprint maximum filter plus full background erosion used before the separable
+    detector, kept as a baseline.
+    """
+    from scipy.ndimage import (binary_erosion, generate_binary_structure,
+                               iterate_structure, maximum_filter)
+
+    neighborhood = iterate_structure(generate_binary_structure(2, CONNECTIVITY_MASK), PEAK_NEIGHBORHOOD_SIZE)
+    local_max = maximum_filter(arr2D, footprint=neighborhood) == arr2D
+    eroded_background = binary_erosion((arr2D == 0), structure=neighborhood, border_value=1)
+    detected_peaks = local_max != eroded_background
+
+    amps = arr2D[detected_peaks]
+    freqs, times = np.where(detected_peaks)
+    filter_idxs = np.where(amps > amp_min)
+    return np.column_stack((freqs[filter_idxs], times[filter_idxs]))
+
+
+def benchmark_peaks(minutes: float = 5, repeat: int = 3) -> None:
+    arr2D = specgram(synthetic_audio(minutes))
+    print(f"get_2D_peaks: spectrogram of {arr2D.shape} ({minutes} min), connectivity={CONNECTIVITY_MASK}")
+
+    legacy_time, legacy_peaks = timeit(legacy_get_2D_peaks, arr2D, repeat=repeat)
+    print(f"  footprint filter + erosion: {legacy_time:.3f}s ({len(legacy_peaks)} peaks)")
+
+    fast_time, peaks = timeit(get_2D_peaks, arr2D, repeat=repeat)
+    print(f"  separable detector:         {fast_time:.3f}s ({len(peaks)} peaks)")
+    print(f"  speedup: {legacy_time / fast_time:.1f}x, identical peaks: {np.array_equal(legacy_peaks, peaks)}")
+
+
+# modules dejavu.logic.fingerprint used to import eagerly, imported up front to time the former startup.
+LEGACY_IMPORTS = ("matplotlib.mlab", "matplotlib.pyplot", "scipy.ndimage.filters", "scipy.ndimage.morphology",
+                  "scipy.signal")
+
+# what a fresh service process does up to answering its first recognition (minus the database round trip).
+FIRST_REQUEST = """
+import numpy as np
+from dejavu import Dejavu
+from dejavu.logic.fingerprint import fingerprint
+from dejavu.logic.recognizer.file_recognizer import FileRecognizer
+fingerprint(np.random.default_rng(0).normal(0, 3000, 5 * 44100).astype(np.int16))
+"""
+
+
+def import_legacy_modules() -> None:
+    """
+    Pool initializer that loads the modules which used to be imported along with dejavu.
+    """
+    for module in LEGACY_IMPORTS:
+        __import__(module)
+
+
+def child_ready(_) -> bool:
+    """
+    Trivial pool task, the time goes into starting the child and unpickling it (which imports dejavu).
+    """
+    return True
+
+
+def run_python(statement: str) -> None:
+    subprocess.run([sys.executable, "-c", statement], check=True, stderr=subprocess.DEVNULL)
+
+
+def spawn_pool(processes: int, initializer=None) -> None:
+    # spawn is the default start method on Windows and macOS, and it makes every child import dejavu again.
+    with multiprocessing.get_context("spawn").Pool(processes, initializer=initializer) as pool:
+        pool.map(child_ready, range(processes))
+
+
+def benchmark_startup(repeat: int = 3, processes: int = 4) -> None:
+    legacy_imports = "".join(f"import {module}; " for module in LEGACY_IMPORTS)
+    print(f"startup: fresh interpreters, {processes} spawned children, former imports: {', '.join(LEGACY_IMPORTS)}")
+
+    for label, statement in (("import dejavu", "import dejavu"), ("first request", FIRST_REQUEST)):
+        legacy_time, _ = timeit(run_python, legacy_imports + statement, repeat=repeat)
+        lazy_time, _ = timeit(run_python, statement, repeat=repeat)
+        print(f"  {label + ':':15} {legacy_time:.3f}s before, {lazy_time:.3f}s after "
+              f"({legacy_time / lazy_time:.1f}x)")
+
+    legacy_time, _ = timeit(spawn_pool, processes, import_legacy_modules, repeat=repeat)
+    lazy_time, _ = timeit(spawn_pool, processes, repeat=repeat)
+    print(f"  {'pool spawn:':15} {legacy_time:.3f}s before, {lazy_time:.3f}s after ({legacy_time / lazy_time:.1f}x)")
+
+
+# decodes the file given as argument with one of the readers below and reports the times and peak RSS,
+# run in a fresh interpreter per measure so the peak RSS of every reader is its own.
+DECODE = """
+import resource, sys, time
+import numpy as np
+from pydub import AudioSegment
+from dejavu.logic import decoder
+t = time.perf_counter()
+{read}
+decode_time = time.perf_counter() - t
+max(int(channel.max()) for channel in channels)
+print(decode_time, time.perf_counter() - t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+DECODE_READERS = {
+    # the whole file decoded by pydub (ffmpeg), as files were read before.
+    "pydub": """
+audio = AudioSegment.from_file(sys.argv[1])
+data = np.frombuffer(audio.raw_data, np.int16)
+channels = [data[chn::audio.channels] for chn in range(audio.channels)]
+""",
+    # the file memory mapped and hashed, and its samples exposed as views, as ingested files are.
+    "load + decode": """
+contents, _ = decoder.load(sys.argv[1])
+channels, fs = decoder.decode(contents)
+"""
+}
+
+
+def write_wav(path: str, minutes: float, n_channels: int = 2, Fs: int = DEFAULT_FS) -> None:
+    """
+    Writes a 16-bit PCM wav file made of a repeated minute of synthetic audio.
+    """
+    minute = synthetic_audio(1, Fs=Fs)
+    frames = np.repeat(minute, n_channels).tobytes()
+    with wave.open(path, "wb") as f:
+        f.setnchannels(n_channels)
+        f.setsampwidth(2)
+        f.setframerate(Fs)
+        for start in range(0, int(minutes * 60 * Fs), len(minute)):
+            f.writeframes(frames[0:min(len(minute), int(minutes * 60 * Fs) - start) * 2 * n_channels])
+
+
+def benchmark_decode(minutes: float = 60, repeat: int = 1) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.wav")
+        write_wav(path, minutes)
+        print(f"decode: {minutes} min stereo 16-bit wav ({os.path.getsize(path) / 2 ** 20:.0f} MB), "
+              f"peak RSS in a fresh interpreter (Unix only)")
+
+        for label, read in DECODE_READERS.items():
+            results = []
+            for _ in range(repeat):
+                output = subprocess.run([sys.executable, "-c", DECODE.format(read=read), path], check=True,
+                                        capture_output=True, text=True).stdout
+                results.append([float(value) for value in output.split()])
+            decode_time, pass_time, max_rss = min(results)
+            # ru_maxrss is in KB on Linux.
+            print(f"  {label + ':':14} decode {decode_time:.3f}s, decode + first pass over the samples "
+                  f"{pass_time:.3f}s, peak RSS {max_rss / 2 ** 10:.0f} MB")
+
+
+def legacy_align(matches, topn: int):
+    sorted_matches = sorted(matches, key=lambda m: (m[0], m[1]))
+    counts = [(*key, len(list(group))) for key, group in groupby(sorted_matches, key=lambda m: (m[0], m[1]))]
+    songs_matches = sorted(
+        [max(list(group), key=lambda g: g[2]) for key, group in groupby(counts, key=lambda count: count[0])],
+        key=lambda count: count[2], reverse=True
+    )
+    return songs_matches[0:topn]
+
+
+def benchmark_align(matches: int = 3000000, songs: int = 5000, topn: int = 2, repeat: int = 1, seed: int = 0) -> None:
+    # random (song, offset difference) pairs, with a single song agreeing on one offset as a real match does.
+    rng = np.random.default_rng(seed)
+    song_ids = rng.integers(1, songs + 1, matches)
+    differences = rng.integers(-200000, 200000, matches)
+    song_ids[0:matches // 20] = 1
+    differences[0:matches // 20] = 1234
+    print(f"align: {matches} matches over {songs} songs, topn={topn}")
+
+    legacy_time, legacy_result = timeit(legacy_align, list(zip(song_ids.tolist(), differences.tolist())), topn,
+                                        repeat=repeat)
+    print(f"  legacy groupby: {legacy_time:.3f}s")
+
+    vector_time, result = timeit(best_offsets, song_ids, differences, topn, repeat=repeat)
+    print(f"  vectorized:     {vector_time:.3f}s")
+    print(f"  speedup:        {legacy_time / vector_time:.1f}x, "
+          f"identical output: {legacy_result == list(zip(*[column.tolist() for column in result]))}")
+
+
+def benchmark_insert(config_path: str, minutes: float = 10, fan_value: int = 15) -> None:
+    # fingerprints are inserted for throwaway songs, deleted afterwards.
+    with open(config_path) as f:
+        config = json.load(f)
+    db = get_database(config.get("database_type", "mysql").lower())(**config.get("database", {}))
+    db.setup()
+
+    hashes = generate_hashes(synthetic_peaks(minutes), fan_value)
+    print(f"insert: {len(hashes)} fingerprints ({minutes} min) into {db.type}")
+
+    handler_insert = type(db).insert_hashes
+    for label, insert in (("executemany", CommonDatabase.insert_hashes), (f"{db.type} handler", handler_insert)):
+        song_id = db.insert_song(f"benchmark {label}", hashlib.sha1(label.encode()).hexdigest(), len(hashes))
+        try:
+            t = perf_counter()
+            insert(db, song_id, hashes)
+            insert_time = perf_counter() - t
+
+            # inserting them again only hits the unique constraint.
+            t = perf_counter()
+            insert(db, song_id, hashes)
+            duplicates_time = perf_counter() - t
+        finally:
+            db.delete_songs_by_id([song_id])
+
+        print(f"  {label + ':':20} {insert_time:.3f}s ({len(hashes) / insert_time:,.0f} rows/s), "
+              f"duplicates {duplicates_time:.3f}s ({len(hashes) / duplicates_time:,.0f} rows/s)")
+
+
+# The match benchmark builds its stand-in catalog in this schema, kept between runs.
+STAND_IN_SCHEMA = "dejavu_benchmark"
+
+# By default every hash of the stand-in catalog is stored for this many fingerprints.
+STAND_IN_HASH_REPEATS = 4
+
+STAND_IN_SONGS = f"""
+    INSERT INTO "{SONGS_TABLENAME}" ("{FIELD_SONGNAME}", "{FIELD_FINGERPRINTED}")
+    SELECT 'benchmark ' || i, 1 FROM generate_series(1, %(songs)s) i;
+"""
+
+# hashes are the first 64 bits of the md5 of a number, which stand_in_hash computes as well.
+STAND_IN_FINGERPRINTS = f"""
+    INSERT INTO "{FINGERPRINTS_TABLENAME}" ("{FIELD_HASH}", "{FIELD_SONG_ID}", "{FIELD_OFFSET}")
+    SELECT ('x' || md5((i %% %(hashes)s)::text))::bit(64)::bigint, 1 + i %% %(songs)s, i / %(songs)s
+    FROM generate_series(%(start)s, %(stop)s - 1) i;
+"""
+
+
+def stand_in_hash(number: int) -> int:
+    return int.from_bytes(hashlib.md5(str(number).encode()).digest()[0:8], "big", signed=True)
+
+
+def build_stand_in(db, rows: int, hash_repeats: int, chunk_size: int = 10000000) -> None:
+    """
+    Fills the fingerprints table with synthetic rows generated by the server itself. Only the hash
+    index is kept, as it is the only one match queries use and inserting into the others is what makes
+    building a big catalog slow.
+    """
+    songs = max(rows // 5000, 1)
+    db.empty()
+    with db.cursor() as cur:
+        cur.execute(f'ALTER TABLE "{FINGERPRINTS_TABLENAME}" DROP CONSTRAINT "uq_{FINGERPRINTS_TABLENAME}";')
+        cur.execute(f'DROP INDEX "ix_{FINGERPRINTS_TABLENAME}_{FIELD_HASH}";')
+        cur.execute(STAND_IN_SONGS, {"songs": songs})
+
+    for start in range(0, rows, chunk_size):
+        t = perf_counter()
+        with db.cursor() as cur:
+            cur.execute(STAND_IN_FINGERPRINTS, {"hashes": max(rows // hash_repeats, 1), "songs": songs,
+                                                "start": start, "stop": min(start + chunk_size, rows)})
+        print(f"  {min(start + chunk_size, rows)} rows inserted ({perf_counter() - t:.1f}s)")
+
+    t = perf_counter()
+    db.setup()
+    with db.cursor() as cur:
+        cur.execute(f'ANALYZE "{FINGERPRINTS_TABLENAME}";')
+    print(f"  hash index built ({perf_counter() - t:.1f}s)")
+    db.set_setting("stand_in", stand_in_description(rows, hash_repeats))
+
+
+def stand_in_description(rows: int, hash_repeats: int) -> str:
+    return f"{rows} rows, {hash_repeats} per hash"
+
+
+def benchmark_match(config_path: str, rows: int = 100000000, hashes: int = 6000, repeat: int = 3,
+                    hash_repeats: int = STAND_IN_HASH_REPEATS, seed: int = 0) -> None:
+    with open(config_path) as f:
+        config = json.load(f)
+    if config.get("database_type", "mysql").lower() != "postgres":
+        raise SystemExit("The match benchmark compares the PostgreSQL match strategies.")
+
+    db_cls = get_database("postgres")
+    with db_cls(**config["database"]).cursor() as cur:
+        cur.execute(f'CREATE SCHEMA IF NOT EXISTS "{STAND_IN_SCHEMA}";')
+
+    # the handlers connect to the stand-in schema instead of the configured catalog.
+    options = dict(config["database"], options=f"-c search_path={STAND_IN_SCHEMA}")
+    db = db_cls(**options)
+    db.setup()
+    if db.get_setting("stand_in") != stand_in_description(rows, hash_repeats):
+        print(f"match: building a {stand_in_description(rows, hash_repeats)} stand-in catalog "
+              f"in the {STAND_IN_SCHEMA} schema")
+        build_stand_in(db, rows, hash_repeats)
+
+    # half of the hashes of a recording are in the catalog, the other half aren't.
+    rng = np.random.default_rng(seed)
+    query = np.empty(hashes, dtype=FINGERPRINT_DTYPE)
+    numbers = rng.integers(0, max(rows // hash_repeats, 1), hashes // 2)
+    query[FIELD_HASH][0:hashes // 2] = [stand_in_hash(number) for number in numbers.tolist()]
+    query[FIELD_HASH][hashes // 2:] = rng.integers(-2 ** 63, 2 ** 63 - 1, hashes - hashes // 2, dtype=np.int64)
+    query[FIELD_OFFSET] = rng.integers(0, 2000, hashes)
+    print(f"match: {hashes} hashes against {stand_in_description(rows, hash_repeats)}")
+
+    results = {}
+    for strategy in db_cls.MATCH_STRATEGIES:
+        handler = db_cls(**options, match_strategy=strategy)
+        query_time, (matches, _) = timeit(handler.return_matches, query, repeat=repeat)
+        results[strategy] = sorted(map(tuple, matches.tolist()))
+        print(f"  {strategy + ':':11} {query_time:.3f}s ({len(matches)} matches)")
+    print(f"  identical output: {all(result == results['in'] for result in results.values())}")
+
+    # the whole recognition query, i.e. matches and their alignment.
+    handler = db_cls(**options)
+    client_time, client = timeit(CommonDatabase.return_best_offsets, handler, query, repeat=repeat)
+    print(f"  aligned by the client:   {client_time:.3f}s")
+    database_time, aligned = timeit(handler.return_best_offsets, query, repeat=repeat)
+    print(f"  aligned by the database: {database_time:.3f}s")
+    print(f"  identical output: {all(np.array_equal(a, b) for a, b in zip(client[0:3], aligned[0:3]))}")
+
+
+def benchmark_memory(rows: int = 10000000, songs: int = 5000, hashes: int = 6000, repeat: int = 3,
+                     path: str = None, seed: int = 0) -> None:
+    # songs of random fingerprints, queried as in the match benchmark: half of the hashes are in the catalog.
+    rng = np.random.default_rng(seed)
+    db = get_database("memory")(path)
+    db.setup()
+    db.empty()
+    print(f"memory: {rows} fingerprints over {songs} songs" + (f", persisted to {path}" if path else ""))
+
+    start = perf_counter()
+    for song in range(songs):
+        fingerprints = np.empty(rows // songs, dtype=FINGERPRINT_DTYPE)
+        fingerprints[FIELD_HASH] = rng.integers(-2 ** 63, 2 ** 63 - 1, len(fingerprints), dtype=np.int64)
+        fingerprints[FIELD_OFFSET] = rng.integers(0, 20000, len(fingerprints))
+        song_id = db.insert_song(f"song {song}", hashlib.sha1(str(song).encode()).hexdigest(), len(fingerprints))
+        db.insert_hashes(song_id, fingerprints)
+        db.set_song_fingerprinted(song_id)
+        if song == 0:
+            catalog = fingerprints[FIELD_HASH]
+    print(f"  insert:       {perf_counter() - start:.3f}s ({len(db._segments)} segments)")
+
+    query = np.empty(hashes, dtype=FINGERPRINT_DTYPE)
+    query[FIELD_HASH][0:hashes // 2] = rng.choice(catalog, hashes // 2)
+    query[FIELD_HASH][hashes // 2:] = rng.integers(-2 ** 63, 2 ** 63 - 1, hashes - hashes // 2, dtype=np.int64)
+    query[FIELD_OFFSET] = rng.integers(0, 2000, hashes)
+
+    match_time, (matches, _) = timeit(db.return_matches, query, repeat=repeat)
+    print(f"  match:        {match_time * 1000:.3f}ms ({len(matches)} matches of {hashes} hashes)")
+    align_time, _ = timeit(db.return_best_offsets, query, repeat=repeat)
+    print(f"  match+align:  {align_time * 1000:.3f}ms")
+
+
+def benchmark_backends(config_paths: List[str], songs: int = 20, minutes: float = 1, hashes: int = 6000,
+                       repeat: int = 3, seed: int = 0) -> None:
+    # the same throwaway songs are ingested into every database and then looked up, deleted afterwards.
+    catalog = [generate_hashes(synthetic_peaks(minutes, seed=seed + song)) for song in range(songs)]
+    rows = sum(len(fingerprints) for fingerprints in catalog)
+
+    # half of the hashes of a recording are in the catalog (from a few seconds of one song), the other half aren't.
+    rng = np.random.default_rng(seed)
+    query = np.empty(hashes, dtype=FINGERPRINT_DTYPE)
+    query[0:hashes // 2] = catalog[0][0:hashes // 2]
+    query[FIELD_HASH][hashes // 2:] = rng.integers(-2 ** 63, 2 ** 63 - 1, hashes - hashes // 2, dtype=np.int64)
+    print(f"backends: {songs} songs, {rows} fingerprints, queried with {hashes} hashes")
+
+    results = {}
+    for config_path in config_paths:
+        with open(config_path) as f:
+            config = json.load(f)
+        db = get_database(config.get("database_type", "mysql").lower())(**config.get("database", {}))
+        db.setup()
+
+        song_ids = []
+        try:
+            t = perf_counter()
+            for song, fingerprints in enumerate(catalog):
+                song_ids.append(db.insert_song(f"benchmark {song}", hashlib.sha1(str(song).encode()).hexdigest(),
+                                               len(fingerprints)))
+                db.insert_hashes(song_ids[-1], fingerprints)
+                db.set_song_fingerprinted(song_ids[-1])
+            insert_time = perf_counter() - t
+
+            match_time, (matches, _) = timeit(db.return_matches, query, repeat=repeat)
+        finally:
+            db.delete_songs_by_id(song_ids)
+
+        # song ids differ between databases, matches are compared by song.
+        songs_index = {song_id: song for song, song_id in enumerate(song_ids)}
+        results[config_path] = sorted((songs_index[song_id], difference) for song_id, difference in
+                                      matches.tolist() if song_id in songs_index)
+        print(f"  {db.type + ':':10} insert {insert_time:.3f}s ({rows / insert_time:,.0f} rows/s), "
+              f"match {match_time * 1000:.1f}ms ({hashes / match_time:,.0f} hashes/s, "
+              f"{len(results[config_path])} matches)")
+
+    print(f"  identical output: {all(result == results[config_paths[0]] for result in results.values())}")
+
+
+BENCHMARKS = {
+    "generate_hashes": benchmark_generate_hashes,
+    "specgram": benchmark_specgram,
+    "peaks": benchmark_peaks,
+    "startup": benchmark_startup,
+    "decode": benchmark_decode,
+    "align": benchmark_align,
+    "insert": benchmark_insert,
+    "match": benchmark_match,
+    "memory": benchmark_memory,
+    "backends": benchmark_backends,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Dejavu micro-benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument("--minutes", type=float, default=60)
+    parser.add_argument("--fan-value", type=int, default=15)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--matches", type=int, default=3000000)
+    parser.add_argument("--songs", type=int, default=5000)
+    parser.add_argument("--config", help="Dejavu JSON config of the database to benchmark, for insert and match")
+    parser.add_argument("--rows", type=int, default=100000000)
+    parser.add_argument("--hashes", type=int, default=6000)
+    parser.add_argument("--hash-repeats", type=int, default=STAND_IN_HASH_REPEATS)
+    parser.add_argument("--configs", nargs="+", help="Dejavu JSON configs of the databases compared by backends")
+    parser.add_argument("--path", help="directory the memory catalog is persisted to, kept in memory if not given")
+    args = parser.parse_args()
+
+    if args.benchmark == "generate_hashes":
+        benchmark_generate_hashes(args.minutes, args.fan_value, args.repeat)
+    elif args.benchmark == "specgram":
+        benchmark_specgram(args.minutes, args.repeat, args.workers)
+    elif args.benchmark == "peaks":
+        benchmark_peaks(args.minutes, args.repeat)
+    elif args.benchmark == "startup":
+        benchmark_startup(args.repeat, args.processes)
+    elif args.benchmark == "decode":
+        benchmark_decode(args.minutes, args.repeat)
+    elif args.benchmark == "align":
+        benchmark_align(args.matches, args.songs, repeat=args.repeat)
+    elif args.benchmark == "insert":
+        benchmark_insert(args.config, args.minutes, args.fan_value)
+    elif args.benchmark == "match":
+        benchmark_match(args.config, args.rows, args.hashes, args.repeat, args.hash_repeats)
+    elif args.benchmark == "memory":
+        benchmark_memory(args.rows, args.songs, args.hashes, args.repeat, args.path)
+    elif args.benchmark == "backends":
+        benchmark_backends(args.configs, args.songs, args.minutes, args.hashes, args.repeat)
@@ -0,0 +1,64 @@
+import asyncio
+from concurrent.futures import Executor, Future
+
+import pytest
+
+from core.executor import ExecutorBusy, FingerprintExecutor
+from dejavu import Dejavu
+
+
+class BusyExecutor(Executor):
+    """
+    Executor taking a given number of tasks, which never start, and rejecting the next ones.
+    """
+    def __init__(self, accepted):
+        self.accepted = accepted
+        self.futures = []
+
+    def submit(self, fn, /, *args, **kwargs):
+        if len(self.futures) == self.accepted:
+            raise ExecutorBusy(5)
+        future = Future()
+        self.futures.append(future)
+        return future
+
+
+@pytest.fixture
+def djv():
+    return Dejavu({"database_type": "memory"})
+
+
+def test_batch_cancels_submitted_tasks_when_the_executor_is_busy(djv):
+    djv.executor = BusyExecutor(accepted=2)
+
+    with pytest.raises(ExecutorBusy):
+        asyncio.run(djv.recognize_batch_async([b""] * 4))
+
+    assert len(djv.executor.futures) == 2
+    assert all(future.cancelled() for future in djv.executor.futures)
+
+
+def test_submit_all_takes_all_the_calls_or_none():
+    executor = FingerprintExecutor(1, 1, 5)
+    try:
+        with pytest.raises(ExecutorBusy):
+            executor.submit_all([int] * 3)
+        assert executor.stats()["submitted"] == 0
+        assert executor.stats()["rejected"] == 1
+
+        assert [future.result() for future in executor.submit_all([int] * 2)] == [0, 0]
+        assert executor.stats()["submitted"] == 2
+    finally:
+        executor.shutdown()
+
+
+def test_batch_submits_all_the_tasks_at_once(djv):
+    executor = FingerprintExecutor(1, 1, 5)
+    djv.executor = executor
+    try:
+        with pytest.raises(ExecutorBusy):
+            asyncio.run(djv.recognize_batch_async([b""] * 3))
+        # none of the tasks ran.
+        assert executor.stats()["submitted"] == 0
+    finally:
+        executor.shutdown()
@@ -0,0 +1,75 @@
+import asyncio
+import io
+import pickle
+import wave
+
+import numpy as np
+import pytest
+
+from core.executor import FingerprintExecutor
+from dejavu import Dejavu
+from dejavu.logic.cache import FingerprintCache
+
+
+def make_wav(seed, seconds=3, fs=44100):
+    """
+    :param seed: seed of the noise, different seeds giving different files.
+    :return: the bytes of a mono 16-bit wav file of noise.
+    """
+    samples = np.random.default_rng(seed).integers(-2 ** 14, 2 ** 14, seconds * fs, dtype=np.int16)
+    data = io.BytesIO()
+    with wave.open(data, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(fs)
+        f.writeframes(samples.tobytes())
+    return data.getvalue()
+
+
+def make_dejavu(tmp_path):
+    return Dejavu({"database_type": "memory", "fingerprint_cache": {"directory": str(tmp_path / "cache")}})
+
+
+def test_unpickled_caches_are_shared_by_the_process(tmp_path):
+    cache = FingerprintCache(str(tmp_path))
+    copy = pickle.loads(pickle.dumps(cache))
+
+    assert copy is not cache
+    assert pickle.loads(pickle.dumps(cache)) is copy
+    assert (copy.directory, copy.max_size) == (cache.directory, cache.max_size)
+
+
+def test_ingest_counts_cache_lookups(tmp_path):
+    data = make_wav(0)
+    make_dejavu(tmp_path).ingest(data, "first")
+
+    djv = make_dejavu(tmp_path)
+    djv.ingest(data, "first")
+    djv.ingest(make_wav(1), "second")
+    # already fingerprinted, the cache is not looked up.
+    djv.ingest(data, "first")
+
+    assert (djv.cache.hits, djv.cache.misses) == (1, 1)
+
+
+@pytest.fixture
+def executor():
+    executor = FingerprintExecutor(1, 4, 5)
+    yield executor
+    executor.shutdown()
+
+
+def test_ingest_async_counts_the_lookups_of_the_workers(tmp_path, executor):
+    data = make_wav(0)
+    make_dejavu(tmp_path).ingest(data, "first")
+
+    djv = make_dejavu(tmp_path)
+    djv.executor = executor
+
+    async def ingest():
+        await djv.ingest_async(data, "first")
+        await djv.ingest_async(make_wav(1), "second")
+
+    asyncio.run(ingest())
+
+    assert (djv.cache.hits, djv.cache.misses) == (1, 1)
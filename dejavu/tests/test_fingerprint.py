@@ -0,0 +1,53 @@
+import hashlib
+from operator import itemgetter
+
+import numpy as np
+import pytest
+
+from dejavu.config.settings import (MAX_HASH_TIME_DELTA, MIN_HASH_TIME_DELTA,
+                                    PEAK_SORT)
+from dejavu.logic.fingerprint import generate_hashes
+
+
+def legacy_generate_hashes(peaks, fan_value: int):
+    """
+    Per-pair python loop used before the vectorized engine, kept as a reference (and a benchmark
+    baseline). Its hex strings start with the same 16 chars as the int64 hashes generated now.
+    """
+    peaks = [tuple(p) for p in peaks]
+    if PEAK_SORT:
+        peaks.sort(key=itemgetter(1))
+
+    hashes = []
+    for i in range(len(peaks)):
+        for j in range(1, fan_value):
+            if (i + j) < len(peaks):
+                freq1, t1 = peaks[i]
+                freq2, t2 = peaks[i + j]
+                t_delta = t2 - t1
+
+                if MIN_HASH_TIME_DELTA <= t_delta <= MAX_HASH_TIME_DELTA:
+                    h = hashlib.sha1(f"{str(freq1)}|{str(freq2)}|{str(t_delta)}".encode('utf-8'))
+                    hashes.append((h.hexdigest()[0:20], t1))
+    return hashes
+
+
+def legacy_as_int(hashes):
+    # the first 8 bytes of the hex strings, as the int64 hashes are.
+    return [(int.from_bytes(bytes.fromhex(hsh[0:16]), "big", signed=True), offset) for hsh, offset in hashes]
+
+
+@pytest.mark.parametrize("fan_value", [1, 2, 5, 15])
+def test_generate_hashes_matches_the_legacy_loop(fan_value):
+    rng = np.random.default_rng(fan_value)
+    # times drawn from a short range so peaks often share their time, and pairs fall on both sides
+    # of the time delta bounds.
+    peaks = np.column_stack((rng.integers(0, 2049, 2000), rng.integers(0, 400, 2000)))
+
+    expected = legacy_as_int(legacy_generate_hashes(peaks.tolist(), fan_value))
+    assert generate_hashes(peaks, fan_value).tolist() == expected
+
+
+def test_generate_hashes_without_peaks():
+    assert len(generate_hashes(np.empty((0, 2), dtype=np.int64))) == 0
+    assert legacy_generate_hashes([], 15) == []
@@ -0,0 +1,159 @@
+from hashlib import sha1
+
+import numpy as np
+import pytest
+
+from dejavu.config.settings import FIELD_HASH, FIELD_OFFSET, FIELD_SONG_ID
+from dejavu.database_handler.sharded_database import ShardedDatabase
+from dejavu.logic.fingerprint import FINGERPRINT_DTYPE
+
+# first 32 bits of hashes falling on each of 3 shards of the same weight, the boundaries being at ~1/3 and ~2/3.
+SHARD_PREFIXES = [[0, 10, 2 ** 30], [2 ** 31, 2 ** 31 + 7], [3 * 2 ** 30, 2 ** 32 - 1]]
+
+
+def make_hashes(prefixes, offset=0):
+    """
+    :param prefixes: first 32 bits of every hash.
+    :param offset: offset of the first hash, the next ones having consecutive offsets.
+    :return: an array of FINGERPRINT_DTYPE records, whose offset tells each hash apart.
+    """
+    prefixes = np.asarray(prefixes, dtype=np.uint64)
+    values = ((prefixes << np.uint64(32)) | np.uint64(12345)).view(np.int64)
+    hashes = np.empty(len(values), dtype=FINGERPRINT_DTYPE)
+    hashes[FIELD_HASH] = values
+    hashes[FIELD_OFFSET] = np.arange(offset, offset + len(values))
+    return hashes
+
+
+def sqlite_config(path, weight=1):
+    return {"database_type": "sqlite", "database": {"database": str(path)}, "weight": weight}
+
+
+def memory_config(weight=1):
+    return {"database_type": "memory", "weight": weight}
+
+
+def open_sharded(shards, metadata=None):
+    db = ShardedDatabase(shards, metadata)
+    db.setup()
+    return db
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def sharded(request, tmp_path):
+    if request.param == "sqlite":
+        return open_sharded([sqlite_config(tmp_path / f"shard{i}.db") for i in range(3)],
+                            sqlite_config(tmp_path / "metadata.db"))
+    return open_sharded([memory_config() for _ in range(3)])
+
+
+def file_hash(name):
+    return sha1(name.encode("utf-8")).hexdigest().upper()
+
+
+def insert_song(db, name, hashes):
+    song_id = db.insert_song(name, file_hash(name), len(hashes))
+    db.insert_hashes(song_id, hashes)
+    db.set_song_fingerprinted(song_id)
+    return song_id
+
+
+def test_inserts_are_routed_by_hash_prefix(sharded):
+    hashes = make_hashes([prefix for prefixes in SHARD_PREFIXES for prefix in prefixes])
+    song_id = insert_song(sharded, "song", hashes)
+
+    expected = np.repeat(np.arange(3), [len(prefixes) for prefixes in SHARD_PREFIXES])
+    assert sharded.shard_of(hashes[FIELD_HASH]).tolist() == expected.tolist()
+
+    for shard, db in enumerate(sharded.shards):
+        stored = sorted(db.query(None))
+        assert stored == [(song_id, offset) for offset in hashes[FIELD_OFFSET][expected == shard].tolist()]
+        # shards keep a copy of the songs they have fingerprints of.
+        assert db.get_song_by_id(song_id) is not None
+
+    assert sharded.get_num_fingerprints() == len(hashes)
+
+
+def test_inserts_skip_shards_without_hashes(sharded):
+    song_id = insert_song(sharded, "song", make_hashes(SHARD_PREFIXES[1]))
+
+    assert sharded.shards[0].query(None) == []
+    assert sharded.shards[2].query(None) == []
+    assert len(sharded.shards[1].query(None)) == len(SHARD_PREFIXES[1])
+    assert sharded.get_song_by_id(song_id) is not None
+
+
+def test_fetch_matches_maps_indexes_back_to_the_values(sharded):
+    first = make_hashes([SHARD_PREFIXES[0][0], SHARD_PREFIXES[1][0], SHARD_PREFIXES[2][0]])
+    second = make_hashes([SHARD_PREFIXES[0][2], SHARD_PREFIXES[2][1]], offset=100)
+    first_id = insert_song(sharded, "first", first)
+    second_id = insert_song(sharded, "second", second)
+    # the same hash on two songs.
+    third_id = insert_song(sharded, "third", make_hashes([SHARD_PREFIXES[1][0]], offset=200))
+
+    missing = make_hashes([SHARD_PREFIXES[0][1], SHARD_PREFIXES[1][1]])
+    values = np.unique(np.concatenate((first[FIELD_HASH], second[FIELD_HASH], missing[FIELD_HASH])))
+
+    indexes, song_ids, offsets = sharded._fetch_matches(values)
+
+    found = sorted(zip(values[indexes].tolist(), song_ids.tolist(), offsets.tolist()))
+    expected = sorted([(value, first_id, offset) for value, offset in first.tolist()] +
+                      [(value, second_id, offset) for value, offset in second.tolist()] +
+                      [(int(first[FIELD_HASH][1]), third_id, 200)])
+    assert found == expected
+
+
+def test_fetch_matches_without_hashes(sharded):
+    indexes, song_ids, offsets = sharded._fetch_matches(np.empty(0, dtype=np.int64))
+    assert len(indexes) == len(song_ids) == len(offsets) == 0
+
+
+def test_delete_songs_cascades_to_shards(sharded):
+    all_prefixes = [prefix for prefixes in SHARD_PREFIXES for prefix in prefixes]
+    deleted = insert_song(sharded, "deleted", make_hashes(all_prefixes))
+    kept = insert_song(sharded, "kept", make_hashes(all_prefixes, offset=100))
+
+    sharded.delete_songs_by_id([deleted])
+
+    assert [song[FIELD_SONG_ID] for song in sharded.get_songs()] == [kept]
+    for db in sharded.shards:
+        assert db.get_song_by_id(deleted) is None
+        assert {song_id for song_id, _ in db.query(None)} == {kept}
+    assert sharded.get_num_fingerprints() == len(all_prefixes)
+
+
+def test_shard_mapping_mismatch_is_rejected(tmp_path):
+    shards = [sqlite_config(tmp_path / f"shard{i}.db") for i in range(2)]
+    metadata = sqlite_config(tmp_path / "metadata.db")
+    open_sharded(shards, metadata)
+
+    # the same shards can be opened again.
+    open_sharded(shards, metadata)
+
+    with pytest.raises(ValueError, match="different shard mapping"):
+        open_sharded([shards[0], {**shards[1], "weight": 2}], metadata)
+
+    with pytest.raises(ValueError, match="different shard mapping"):
+        open_sharded(shards + [sqlite_config(tmp_path / "shard2.db")], metadata)
+
+
+def test_setup_drops_songs_left_on_shards(tmp_path):
+    shards = [sqlite_config(tmp_path / f"shard{i}.db") for i in range(3)]
+    metadata = sqlite_config(tmp_path / "metadata.db")
+    db = open_sharded(shards, metadata)
+
+    all_prefixes = [prefix for prefixes in SHARD_PREFIXES for prefix in prefixes]
+    kept = insert_song(db, "kept", make_hashes(all_prefixes))
+
+    # an insertion interrupted after the shards flagged the song, but before the metadata database did.
+    orphan = db.insert_song("orphan", file_hash("orphan"), len(all_prefixes))
+    db.insert_hashes(orphan, make_hashes(all_prefixes, offset=100))
+    for shard in db.shards:
+        shard.set_song_fingerprinted(orphan)
+
+    db = open_sharded(shards, metadata)
+
+    for shard in db.shards:
+        assert [song[FIELD_SONG_ID] for song in shard.get_songs()] == [kept]
+        assert {song_id for song_id, _ in shard.query(None)} == {kept}
+    assert [song[FIELD_SONG_ID] for song in db.get_songs()] == [kept]
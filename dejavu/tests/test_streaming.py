@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from dejavu.config.settings import DEFAULT_FS, DEFAULT_WINDOW_SIZE
+from dejavu.logic.fingerprint import fingerprint
+from dejavu.logic.streaming import StreamingFingerprinter
+
+
+def make_signal(seconds, seed=0):
+    """
+    :return: int16 samples of noise whose loudness changes every tenth of a second, so peaks are spread
+    unevenly over the spectrogram.
+    """
+    rng = np.random.default_rng(seed)
+    samples = rng.normal(0, 1, int(seconds * DEFAULT_FS))
+    loudness = np.repeat(rng.uniform(0.05, 1, len(samples) // (DEFAULT_FS // 10) + 1), DEFAULT_FS // 10)
+    return (samples * loudness[:len(samples)] * 8000).clip(-2 ** 15, 2 ** 15 - 1).astype(np.int16)
+
+
+def chunked(samples, sizes):
+    """
+    :param sizes: sizes of the chunks, repeated until the samples are all taken.
+    :return: the samples cut in chunks of the given sizes.
+    """
+    chunks = []
+    start = 0
+    while start < len(samples):
+        for size in sizes:
+            chunks.append(samples[start:start + size])
+            start += size
+    return chunks
+
+
+def stream(samples, sizes):
+    fingerprinter = StreamingFingerprinter()
+    hashes = [fingerprinter.feed(chunk) for chunk in chunked(samples, sizes)]
+    hashes.append(fingerprinter.flush())
+    return np.sort(np.concatenate(hashes))
+
+
+@pytest.mark.parametrize("sizes", [
+    [10 ** 9],
+    [DEFAULT_WINDOW_SIZE // 2],
+    [DEFAULT_WINDOW_SIZE + 1],
+    [997],
+    [1, 5000, 17, DEFAULT_FS, 333]
+], ids=["one chunk", "hop", "window + 1", "prime", "uneven"])
+def test_streaming_gives_the_hashes_of_fingerprint(sizes):
+    samples = make_signal(5)
+    assert stream(samples, sizes).tolist() == np.sort(fingerprint(samples)).tolist()
+
+
+def test_streams_shorter_than_a_window():
+    samples = make_signal(DEFAULT_WINDOW_SIZE / 2 / DEFAULT_FS)
+    assert stream(samples, [100]).tolist() == np.sort(fingerprint(samples)).tolist()
+
+
+def test_flush_starts_a_new_stream():
+    samples = make_signal(3)
+    fingerprinter = StreamingFingerprinter()
+    fingerprinter.feed(make_signal(2, seed=1))
+    fingerprinter.flush()
+
+    hashes = np.concatenate((fingerprinter.feed(samples), fingerprinter.flush()))
+    assert np.sort(hashes).tolist() == np.sort(fingerprint(samples)).tolist()
@@ -5,20 +5,22 @@ import http
 import requests
 import uvicorn
 
-from core.utils import adv_exists, init_dejavu, create_fingerprint, debug_error_log
+from typing import List
+from concurrent.futures import BrokenExecutor
+from contextlib import asynccontextmanager
+from core.executor import ExecutorBusy, FingerprintExecutor
+from core.utils import init_dejavu, debug_error_log
 from core.utils import get_bitrate, remove_quatation_marks
-from core.db import get_advertisement_id
 from decouple import config
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, Request, UploadFile, File, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
-from dejavu import Dejavu
-from dejavu.logic.recognizer.file_recognizer import FileRecognizer
-
-app = FastAPI(title="Audio-API")
-
+from dejavu.logic.recognizer.bytes_recognizer import BytesRecognizer
+from dejavu.logic.recognizer.stream_recognizer import StreamRecognizer
 
 ROOT_UPLOAD_DIR = config('ROOT_UPLOAD_DIR')
 ROOT_TEMP_DIR = config('ROOT_TEMP_DIR')
@@ -26,18 +28,23 @@ FILE_EXTENSION = config('FILE_EXTENSION')
 CONFIG_DIR = config('CONFIG_DIR')
 CONFIG_PATH = config('CONFIG_PATH')
 
+# uploads and clips are decoded and fingerprinted by a pool of processes, requests beyond the ones the
+# workers run plus the queue are turned away with a Retry-After instead of waiting.
+FINGERPRINT_WORKERS = config('FINGERPRINT_WORKERS', default=os.cpu_count() or 1, cast=int)
+FINGERPRINT_QUEUE_SIZE = config('FINGERPRINT_QUEUE_SIZE', default=4 * FINGERPRINT_WORKERS, cast=int)
+FINGERPRINT_RETRY_AFTER = config('FINGERPRINT_RETRY_AFTER', default=5, cast=int)
 
-@app.get("/")
-def root():
-    return {'message':'Radio API app'}
+# an upload matching a registered advertisement with confidences above these is taken for it.
+DUPLICATE_INPUT_CONFIDENCE = 0.9
+DUPLICATE_FINGERPRINTED_CONFIDENCE = 0.8
 
+# formats accepted for the PCM streams of /match/stream, so a single step of audio stays small.
+STREAM_MAX_SAMPLE_RATE = 192000
+STREAM_MAX_CHANNELS = 8
 
-@app.post("/upload")
-async def upload(
-    name: str, # = Query(..., description="Name of the file"),
-    file:UploadFile = File(...)
-    ):
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
     try:
         assert os.path.exists(ROOT_UPLOAD_DIR)
         assert os.path.exists(CONFIG_PATH)
@@ -46,6 +53,62 @@ async def upload(
         create_dirs()
         read_conf()
 
+    # a single engine serves every request, the database schema is set up and the
+    # songs are loaded once, here, instead of on each request.
+    app.state.djv = init_dejavu(CONFIG_PATH)
+    app.state.executor = FingerprintExecutor(FINGERPRINT_WORKERS, FINGERPRINT_QUEUE_SIZE, FINGERPRINT_RETRY_AFTER)
+    app.state.djv.executor = app.state.executor
+    yield
+
+    if app.state.djv.async_db is not None:
+        await app.state.djv.async_db.close()
+    app.state.executor.shutdown(cancel_futures=True)
+
+
+app = FastAPI(title="Audio-API", lifespan=lifespan)
+
+
+@app.exception_handler(ExecutorBusy)
+async def executor_busy(request: Request, exc: ExecutorBusy):
+    debug_error_log(f"INFO: Request to `{request.url.path}` turned away, every worker is busy.")
+    return JSONResponse(
+        status_code=http.HTTPStatus.TOO_MANY_REQUESTS,
+        headers={"Retry-After": str(exc.retry_after)},
+        content={
+            "success"   : False,
+            "status"    : http.HTTPStatus.TOO_MANY_REQUESTS,
+            "message"   : "Too many requests, retry later."
+        }
+    )
+
+
+@app.exception_handler(BrokenExecutor)
+async def executor_unavailable(request: Request, exc: BrokenExecutor):
+    # a worker died (e.g. out of memory), the pool is replaced on the next request.
+    debug_error_log(f"ERROR: Fingerprinting worker lost while serving `{request.url.path}`: {exc}")
+    return JSONResponse(
+        status_code=http.HTTPStatus.SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(FINGERPRINT_RETRY_AFTER)},
+        content={
+            "success"   : False,
+            "status"    : http.HTTPStatus.SERVICE_UNAVAILABLE,
+            "message"   : "Fingerprinting unavailable, retry later."
+        }
+    )
+
+
+@app.get("/")
+def root():
+    return {'message':'Radio API app'}
+
+
+@app.post("/upload")
+async def upload(
+    request: Request,
+    name: str, # = Query(..., description="Name of the file"),
+    file:UploadFile = File(...)
+    ):
+
     wav_filename = file.filename
     file_ext = wav_filename.split('.').pop()    # type:ignore
     if file_ext != 'wav':
@@ -57,53 +120,49 @@ async def upload(
         }
     name = remove_quatation_marks(name)
     filename = name if name.endswith('.wav') else name + '.wav'
-
-    os.makedirs(ROOT_UPLOAD_DIR, exist_ok=True)     # type:ignore
-    uploaded_filepath = f"{ROOT_UPLOAD_DIR}/{filename}"
     
     debug_error_log(f"INFO: Requested advertisement `{name}` with file {wav_filename}")
     advertisement_name = filename[:-4]
 
-    try:
-        with open(uploaded_filepath, 'wb') as f:
-            content = await file.read()
-            f.write(content)
-    except Exception as e:
-        debug_error_log("ERROR: " + str(e))      # type:ignore
+    # the upload is recognized and fingerprinted from memory, it is never written to disk.
+    content = await file.read()
 
-    djv = init_dejavu(CONFIG_PATH)
-    adv_sts, stored_advert_id, stored_advert_name = adv_exists(djv, uploaded_filepath)
+    # the upload is fingerprinted once, for both the duplicate check and the insert, and identical
+    # files are not even decoded.
+    djv = request.app.state.djv
+    advert_id, advert_name, created = await djv.ingest_async(
+        content, advertisement_name, '.wav',
+        input_confidence=DUPLICATE_INPUT_CONFIDENCE,
+        fingerprinted_confidence=DUPLICATE_FINGERPRINTED_CONFIDENCE
+    )
 
-    if adv_sts:
-        debug_error_log(f"INFO: Advertisement `{stored_advert_name}`  already exists.")
+    if not created:
+        debug_error_log(f"INFO: Advertisement `{advert_name}`  already exists.")
         return {
             "success"   : False, 
             "status"    : http.HTTPStatus.NOT_ACCEPTABLE,
             'message'   : 'Advertisemet already exists',
-            "registered_id" : stored_advert_id,
-            "registered_name" : stored_advert_name
+            "registered_id" : advert_id,
+            "registered_name" : advert_name
         }
-    
-    await create_fingerprint(djv, uploaded_filepath)
-
-    # grab the song/advertisement id 
-    new_advert_id = get_advertisement_id(advertisement_name)
-
-    # # File is already stored in table. 
-    # # Not necessary to store in disk. Just remove
-    try:
-        os.remove(uploaded_filepath)
-    except Exception as e:
-        debug_error_log("ERROR: " + str(e))      # type:ignore
 
     return {
         "success"   : True,
         "status"    : http.HTTPStatus.CREATED,
         "message"   : "Advertisement Created",
-        "registered_id" : new_advert_id,
+        "registered_id" : advert_id,
         "registered_name" : name
     }
 
+@app.get("/metrics")
+def metrics(request: Request):
+    djv = request.app.state.djv
+    pool = getattr(djv.db, 'pool', None)
+    return {
+        "executor"  : request.app.state.executor.stats(),
+        "database_pool" : pool.stats() if pool is not None else None
+    }
+
 @app.get("/valid/channel")
 def test_valid_channel(url):
     # Configure the number of retries and backoff strategy
@@ -134,18 +193,11 @@ def test_valid_channel(url):
 
 @app.post("/match")
 async def match_results(
+    request: Request,
     name: str = '',
     file:UploadFile = File(...)
     ):
     
-    try:
-        assert os.path.exists(ROOT_UPLOAD_DIR)
-        assert os.path.exists(CONFIG_PATH)
-    except Exception as e:
-        debug_error_log("ERROR: " + "Assersion Error")      # type:ignore
-        create_dirs()
-        read_conf()
-    
     wav_filename = file.filename
     file_ext = wav_filename.split('.').pop()    # type:ignore
     if file_ext != 'wav':
@@ -155,34 +207,114 @@ async def match_results(
             "status"    : http.HTTPStatus.NOT_ACCEPTABLE, 
             'message'   : 'File with `.wav` extension is only accepted.'
         }
-    os.makedirs(ROOT_UPLOAD_DIR, exist_ok=True)     # type:ignore
-    uploaded_filepath = f"{ROOT_UPLOAD_DIR}/{wav_filename}"
-
-    try:
-        with open(uploaded_filepath, 'wb') as f:
-            content = await file.read()
-            f.write(content)
-    except Exception as e:
-        debug_error_log("ERROR writing audio: " + str(e))      # type:ignore
+    # the clip is matched from memory, it is never written to disk.
+    content = await file.read()
     
-    djv = init_dejavu(CONFIG_PATH)
+    djv = request.app.state.djv
     results_check = {}
     try:
-        if isinstance(djv, Dejavu):
-            results_check = djv.recognize(
-                FileRecognizer, 
-                uploaded_filepath
-            )
+        results_check = await djv.recognize_async(
+            BytesRecognizer, 
+            content
+        )
+    except (ExecutorBusy, BrokenExecutor):
+        # answered by the exception handlers, with a Retry-After.
+        raise
     except Exception as e:
         debug_error_log("" + str(e))
         results_check['error'] = str(e)
-    
+
+    return {"results":str(results_check)}
+
+
+@app.post("/match/batch")
+async def match_batch(
+    request: Request,
+    files: List[UploadFile] = File(...)
+    ):
+    # every clip is fingerprinted by the workers, and their hashes are all looked up in one query.
+    results = [None] * len(files)
+    contents = []
+    indexes = []
+    for index, file in enumerate(files):
+        file_ext = file.filename.split('.').pop()    # type:ignore
+        if file_ext != 'wav':
+            results[index] = {'error': 'File with `.wav` extension is only accepted.'}
+            continue
+        contents.append(await file.read())
+        indexes.append(index)
+
+    djv = request.app.state.djv
+    if contents:
+        matches = await djv.recognize_batch_async(contents, '.wav', tasks=request.app.state.executor.max_workers)
+        for index, clip_results in zip(indexes, matches):
+            results[index] = clip_results
+
+    # song names and file hashes are bytes, they are sent as text.
+    return [
+        {"filename": file.filename, **jsonable_encoder(clip_results or {}, custom_encoder={bytes: bytes.decode})}
+        for file, clip_results in zip(files, results)
+    ]
+
+
+@app.websocket("/match/stream")
+async def match_stream(websocket: WebSocket):
+    # one connection per channel, e.g. a radio station. The first message sets the format of the stream,
+    # as {"sample_rate": 44100, "channels": 2}, and the next ones are interleaved 16-bit little-endian PCM.
+    # Every song found is sent back as soon as it is, with the seconds of the stream it was found at.
+    await websocket.accept()
+    djv = websocket.app.state.djv
     try:
-        os.remove(uploaded_filepath)
+        stream_format = await websocket.receive_json()
+        sample_rate = int(stream_format['sample_rate'])
+        channels = int(stream_format['channels'])
+        assert 0 < sample_rate <= STREAM_MAX_SAMPLE_RATE and 0 < channels <= STREAM_MAX_CHANNELS
+    except WebSocketDisconnect:
+        return
     except Exception as e:
-        debug_error_log("ERROR removing file: " + str(e))      # type:ignore
+        debug_error_log(f"INFO: Stream with invalid format rejected: {e}")
+        await websocket.send_json({
+            "success"   : False,
+            "status"    : http.HTTPStatus.NOT_ACCEPTABLE,
+            "message"   : f"Send the stream format first, as `sample_rate` up to {STREAM_MAX_SAMPLE_RATE} "
+                          f"and `channels` up to {STREAM_MAX_CHANNELS}."
+        })
+        await websocket.close(code=1003)
+        return
+
+    recognizer = StreamRecognizer(djv)
+    recognizer.start(sample_rate, channels)
+    await websocket.send_json({
+        "success"   : True,
+        "status"    : http.HTTPStatus.ACCEPTED,
+        "message"   : "Stream accepted",
+        "sample_rate"   : sample_rate,
+        "channels"  : channels
+    })
+    debug_error_log(f"INFO: Stream started at {sample_rate} Hz with {channels} channels.")
 
-    return {"results":str(results_check)}
+    try:
+        while True:
+            # the next data is only read once the previous one is matched, a client sending faster than
+            # it can be matched waits instead of the data piling up.
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is None:
+                debug_error_log("INFO: Stream closed, text sent instead of PCM data.")
+                await websocket.close(code=1003)
+                break
+
+            for detection in await recognizer.feed_async(message["bytes"]):
+                # song names and file hashes are bytes, they are sent as text.
+                await websocket.send_json(jsonable_encoder(detection, custom_encoder={bytes: bytes.decode}))
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        debug_error_log("ERROR: Stream failed: " + str(e))
+        await websocket.close(code=1011)
+        return
+    debug_error_log(f"INFO: Stream ended after {recognizer.total_samples / sample_rate:.1f} seconds.")
 
 
 def read_conf():